@@ -0,0 +1,168 @@
+import os
+import sys
+import csv
+import time
+import random
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+from emulator import Emulator, LinkProfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASE_COLUMNS = ["arq", "cc", "var", "val", "goodput_mbps", "utilization"]
+META_COLUMNS = ["seconds", "kernel_drops", "ok", "rep", "seed", "loss", "delay_ms", "size_kb", "pktSize", "maxWin", "run_id", "timestamp",
+                "source"] # source: "bench" measured here, "sim" from simulate.py, empty for older hand written rows
+# swept variable -> (config key, default values); config keys match the METRIC/run metadata columns
+SWEEPS = {
+    "loss": ("loss", "0,1,3,5"),
+    "delay": ("delay_ms", "0,50,100,200"),
+    "size_kb": ("size_kb", "100,200,300,400"),
+    "pktSize": ("pktSize", "512,1024,1400"),
+    "maxWin": ("maxWin", "16,32,64"),
+}
+
+def freePort() -> int:
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def parseMetric(text: str) -> dict:
+    # last "METRIC,k=v,..." line printed by the sender, plus the client's MD5 verdict
+    metric = {}
+    for line in text.splitlines():
+        if line.startswith("METRIC,"):
+            metric = dict(kv.split("=", 1) for kv in line.split(",")[1:] if "=" in kv)
+    metric["ok"] = 1 if "client: successfully" in text else 0
+    return metric
+
+def makeFile(workDir: str, sizeKB: float, seed: int) -> str:
+    path = os.path.join(workDir, f"bench_{sizeKB:g}KB.dat")
+    if not os.path.exists(path):
+        rng = random.Random(seed)
+        with open(path, "wb") as f:
+            f.write(rng.randbytes(int(sizeKB * 1024)))
+    return path
+
+def startServer(storage: str, port: int, extra: list = ()) -> subprocess.Popen:
+    cmd = [sys.executable, "-u", os.path.join(HERE, "server.py"), "--port", str(port), "--storage", storage, *extra]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(0.5)
+    return proc
+
+def startEmulator(serverPort: int, loss: float, delay: float, seed: int, bothWays: bool):
+    up = LinkProfile(loss=loss, delay=delay, seed=seed)
+    down = LinkProfile(loss=loss, delay=delay, seed=seed + 1) if bothWays else LinkProfile()
+    emu = Emulator("127.0.0.1", 0, "127.0.0.1", serverPort, up, down)
+    thread = threading.Thread(target=emu.serve, daemon=True)
+    thread.start()
+    return emu, thread
+
+def stopEmulator(emu: Emulator, thread: threading.Thread) -> None:
+    emu.stop()
+    thread.join()
+    emu.close()
+
+def runOnce(cfg: dict, serverPort: int, workDir: str, timeout: float, bothWays: bool) -> dict:
+    # one upload through a fresh emulated link, returns the parsed METRIC fields
+    localPath = makeFile(workDir, cfg["size_kb"], int(cfg["size_kb"]))
+    emu, thread = startEmulator(serverPort, cfg["loss"], cfg["delay_ms"], cfg["seed"], bothWays)
+    cmd = [sys.executable, "-u", os.path.join(HERE, "client.py"), "--server", "127.0.0.1", "--port", str(emu.port),
+           "--arq", cfg["arq"], "--cc", cfg["cc"], "--pktSize", str(cfg["pktSize"]), "--maxWin", str(cfg["maxWin"]),
+           "upload", localPath, f"bench_{cfg['run_id']}.dat"]
+    try:
+        out = subprocess.run(cmd, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=timeout).stdout
+    except subprocess.TimeoutExpired:
+        out = ""
+    finally:
+        stopEmulator(emu, thread)
+    return parseMetric(out)
+
+def openResults(path: str) -> None:
+    # make sure the csv carries the metadata columns, older hand written rows keep them empty
+    columns = BASE_COLUMNS + META_COLUMNS
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        with open(path, "w", newline="") as f:
+            csv.writer(f).writerow(columns)
+        return
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        rows = list(reader)
+        header = reader.fieldnames or []
+    if header == columns:
+        return
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+
+def appendRow(path: str, row: dict) -> None:
+    with open(path, "a", newline="") as f:
+        csv.DictWriter(f, fieldnames=BASE_COLUMNS + META_COLUMNS, extrasaction="ignore").writerow(row)
+
+def points(args) -> list:
+    # one-factor sweeps around the base point, crossed with every arq x cc pair
+    base = {"loss": args.baseLoss, "delay_ms": args.baseDelay, "size_kb": args.baseSize, "pktSize": args.basePktSize, "maxWin": args.baseMaxWin}
+    out = []
+    for var in args.vars.split(","):
+        key, _ = SWEEPS[var]
+        for val in getattr(args, var).split(","):
+            for arq in args.arq.split(","):
+                for cc in args.cc.split(","):
+                    cfg = dict(base, arq=arq, cc=cc, var=var, val=float(val))
+                    cfg[key] = type(base[key])(float(val))
+                    out.append(cfg)
+    return out
+
+def main():
+    parser = argparse.ArgumentParser(description="sweep arq x cc x link/file parameters and append METRIC results to a csv")
+    parser.add_argument("--out", type=str, default=os.path.join(HERE, "metric.csv"))
+    parser.add_argument("--arq", type=str, default="gbn,sr")
+    parser.add_argument("--cc", type=str, default="reno,vegas")
+    parser.add_argument("--vars", type=str, default="loss,delay,size_kb", help=f"comma list of {','.join(SWEEPS)}")
+    for var, (_, default) in SWEEPS.items():
+        parser.add_argument(f"--{var}", type=str, default=default, help=f"values swept for {var}")
+    parser.add_argument("--baseLoss", type=float, default=0.0)
+    parser.add_argument("--baseDelay", type=float, default=0.0)
+    parser.add_argument("--baseSize", type=float, default=100.0)
+    parser.add_argument("--basePktSize", type=int, default=1024)
+    parser.add_argument("--baseMaxWin", type=int, default=64)
+    parser.add_argument("--reps", type=int, default=3, help="repetitions of every point")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=180.0, help="seconds before a run counts as failed")
+    parser.add_argument("--bothWays", action="store_true", help="impair ACKs too, not only the data direction")
+    args = parser.parse_args()
+
+    openResults(args.out)
+    workDir = tempfile.mkdtemp(prefix="bench_")
+    serverPort = freePort()
+    server = startServer(os.path.join(workDir, "storage"), serverPort)
+    todo = points(args)
+    runId = time.strftime("%Y%m%d%H%M%S")
+    failed = 0
+    try:
+        for i, cfg in enumerate(todo):
+            for rep in range(args.reps):
+                cfg = dict(cfg, rep=rep, seed=args.seed + rep, run_id=f"{runId}_{i}_{rep}")
+                metric = runOnce(cfg, serverPort, workDir, args.timeout, args.bothWays)
+                row = dict(cfg, timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"), source="bench", **metric)
+                appendRow(args.out, row)
+                if not metric["ok"]:
+                    failed += 1
+                print(f"bench: [{i + 1}/{len(todo)} rep {rep}] {cfg['arq']} {cfg['cc']} {cfg['var']}={cfg['val']:g} "
+                      f"goodput={metric.get('goodput_mbps', '-')} util={metric.get('utilization', '-')} ok={metric['ok']}")
+    except KeyboardInterrupt:
+        print("bench: interrupted, partial results kept")
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workDir, ignore_errors=True)
+    print(f"bench: {len(todo) * args.reps} runs, {failed} failed, results appended to {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -5,30 +5,18 @@ import hashlib
 import os
 import json
 import argparse
-
-def genPacket(seq: int, flag: int, ack: int, data: bytes, ts: float) -> bytes:
-    dataLen = len(data)
-    header = f"{seq}|{flag}|{ack}|{dataLen}|{ts}\n"
-    return header.encode("utf-8") + data
-
-def getPacket(data: bytes):
-    sep = "\n".encode("utf-8")
-    pacSep = data.find(sep)
-
-    if pacSep == -1:
-        return 0, 0, 0, b"", 0.0
-    header = data[: pacSep].decode("utf-8")
-    payload = data[pacSep + len(sep): ]
-    headerSep: list = header.split("|")
-    if len(headerSep) != 5:
-        return 0, 0, 0, b"", 0
-    seq = int(headerSep[0])
-    flag = int(headerSep[1])
-    ack = int(headerSep[2])
-    payloadLen = int(headerSep[3])
-    ts = float(headerSep[4])
-    
-    return seq, flag, ack, payload[: payloadLen], ts
+import tempfile
+
+from tracer import Tracer
+from profiler import Profiler, runProfiled, topFunctions
+from fec import FEC, fecEncoder, fecDecoder, ackPayload, replay
+from codec import CODECS, Deframer, frameLater, resolve
+from delta import makeDelta, parseSignatures
+from store import CHUNK, chunkHashes, packOffer, fromRanges
+from scoreboard import Scoreboard, ModeSwitch
+from pathcache import PathCache
+from netio import (FIN_TIMEOUT, IDLE_TIMEOUT, genPacket, getPacket, finWait, timeWait, drain,
+                   AsyncWriter, tuneSocket, udpDrops)
 
 def getMD5(path: str) -> str:
     md5 = hashlib.md5()
@@ -101,71 +89,65 @@ class vegasContol(CongestControl):
         return max(1.0, cwnd - 1.0)
     
 
-class GBNreceiver:
-    def __init__(self, socket: socket.socket, addr, outPath: str) -> None:
+class ARQreceiver: # one receiver for every sender mode
+    def __init__(self, socket: socket.socket, addr, outPath: str, sizeHint: int = 0) -> None:
         self.socket = socket
         self.addr = addr
         self.outPath = outPath
-    
-    def receive(self):
-        buffer = {}
-        expect = 0
-        with open(self.outPath, "wb") as f:
-            while True:
-                data, addr = self.socket.recvfrom(65546)
-                seq, flag, ackNum, payload, ts = getPacket(data)
-                
-                if seq >= expect:
-                    buffer[seq] = payload
-                    while expect in buffer:
-                        chunk = buffer.pop(expect)
-                        if chunk:
-                            f.write(chunk)
-                        expect += 1
-                    ackPkt = genPacket(0, (1 << 0), expect, "".encode("utf-8"), time.time())
-                    self.socket.sendto(ackPkt, self.addr)
-                else:
-                    ackPkt = genPacket(0, (1 << 0), expect, "".encode("utf-8"), time.time())
-                    self.socket.sendto(ackPkt, self.addr)
-                if flag & (1 << 1):
-                    self.socket.settimeout(5)
-                    for _ in range(20):
-                        ackPkt = genPacket(0, (1 << 0), expect, "".encode("utf-8"), time.time())
-                        self.socket.sendto(ackPkt, self.addr)
-                        time.sleep(0.01)
-                    break
+        self.sizeHint = sizeHint
+        self.clock = time.time # replaced by the virtual clock in simulate.py
+        self.encode = genPacket # instance attributes so --profile can time them per flow
+        self.decode = getPacket
+        self.buffer: dict = {}
+        self.expect = 0
+        self.writer = None
+        self.fec = None # fecDecoder when the transfer negotiated parity packets
+        self.unframe = None # codec.Deframer when the stream is compressed
+
+    def onPacket(self, data: bytes) -> bool: # returns True once FIN arrived
+        # out of order data is held until the gap fills; each ACK carries both the cumulative
+        # next expected seq (ack field, what GBN reads) and the seq it answers + 1 (seq field, SR)
+        seq, flag, ackNum, payload, ts = self.decode(data)
+        if flag & (1 << 0): # stray ACK or FIN-ACK of an earlier transfer on this socket
+            return False
+        if flag & (1 << 1):
+            return True
+        if flag & FEC:
+            if self.fec is not None:
+                replay(self, self.fec.onParity(seq, ackNum, payload, self.expect), ts)
+            return False
+        if seq >= self.expect:
+            self.buffer[seq] = payload
+            while self.expect in self.buffer:
+                chunk = self.buffer.pop(self.expect)
+                if chunk:
+                    self.writer.write(chunk)
+                self.expect += 1
+        ackPkt = self.encode(seq + 1, (1 << 0), self.expect, ackPayload(self.fec), self.clock())
+        self.socket.sendto(ackPkt, self.addr)
+        if self.fec is not None:
+            replay(self, self.fec.onData(seq, payload), ts)
+        return False
 
-class SRreceiver:
-    def __init__(self, socket: socket.socket, addr, outPath: str):
-        self.socket = socket
-        self.addr = addr
-        self.outPath = outPath
-    
     def receive(self):
-        buffer = {}
-        expect = 0
-        with open(self.outPath, "wb") as f:
+        self.socket.settimeout(IDLE_TIMEOUT)
+        self.writer = AsyncWriter(self.outPath, self.sizeHint, transform=self.unframe)
+        try:
             while True:
-                data, addr  = self.socket.recvfrom(65536)
-                seq, flag , ackNum, payload, ts = getPacket(data)
-                ackPkt = genPacket(0, (1 << 0), seq + 1, "".encode("utf-8"), time.time())
-                self.socket.sendto(ackPkt, self.addr)
-                if seq >= expect:
-                    buffer[seq] = payload
-                    while expect in buffer:
-                        chunk = buffer.pop(expect)
-                        if chunk:
-                            f.write(chunk)
-                        expect += 1
-                if flag & (1 << 1):
-                    self.socket.settimeout(5)
-                    for _ in range(20):
-                        ackPkt = genPacket(0, (1 << 0), expect, "".encode("utf-8"), time.time())
-                        self.socket.sendto(ackPkt, self.addr)
-                        time.sleep(0.01)
+                data, addr = self.socket.recvfrom(65536)
+                if self.onPacket(data):
                     break
+            # FIN-ACK before the writer drains, decompressing the tail can outlast the server's FIN_WAIT
+            timeWait(self.socket, self.addr, self.expect)
+        finally:
+            self.writer.close()
+
+class sender: # shared by GBN and SR
+    __slots__ = ("socket", "addr", "inPath", "cc", "pktSize", "maxWin", "clock", "encode", "decode", "data", "tracer", "fec",
+                 "chunks", "unique_payload", "npkt", "base", "nextIdx", "cwnd", "timeout", "board",
+                 "total_sent", "t0", "srtt", "rttvar", "retransmits", "dupAcks", "timeouts", "fecRecovered", "warm",
+                 "progressBase", "progressAt", "stopped")
 
-class GBNsender:
     def __init__(self, socket: socket.socket, addr, inPath: str, cc: CongestControl, pktSize: int, maxWin: int) -> None:
         self.socket = socket
         self.addr = addr
@@ -173,243 +155,507 @@ class GBNsender:
         self.cc = cc
         self.pktSize = pktSize
         self.maxWin = maxWin
-        self.timerLock = threading.Lock()
+        self.clock = time.time # replaced by the virtual clock in simulate.py
+        self.encode = genPacket # instance attributes so --profile can time them per flow
+        self.decode = getPacket
+        self.data = None # send these bytes instead of reading inPath
+        self.tracer = None # Tracer sampling cwnd/rtt/window state, None = off
+        self.fec = None # fecEncoder when the transfer negotiated parity packets
+        self.warm = None # PathCache entry of the last send to this peer, None = cold start
     
-
-    def ackListener(self):
-        while True:
-            try:
-                data, addr = self.socket.recvfrom(4096)
-            except socket.timeout:
-                continue
-            seq, flag, ackNum, payload, ts = getPacket(data)
-            if flag & (1 << 0):
-                if ackNum > self.base:
-                    self.base = ackNum
-                    if ts > 0: 
-                        rtt = (time.time() - ts)
-                    else:
-                        rtt = None
-                    self.cwnd = self.cc.ifACK(ackNum, self.cwnd, rtt)
-                    with self.timerLock:
-                        if self.base != self.nextIdx:
-                            self.timerStart = time.time()
-                        else:
-                            self.timerStart = None
-                    self.dupACK = 0
-                else:
-                    self.dupACK += 1
-                    if self.dupACK >= 3:
-                        self.cwnd = self.cc.ifDupACK(self.cwnd)
-                        self.dupACK = 0
-            if self.base >= self.npkt:
-                return
-
-    def send(self):
-        self.socket.settimeout(None)
-        self.chunks: list = []
+    def loadChunks(self) -> list:
+        if self.data is not None:
+            view = memoryview(self.data)
+            return [view[i: i + self.pktSize] for i in range(0, len(view), self.pktSize)]
+        chunks = []
         with open(self.inPath, "rb") as f:
             while True:
                 chunk = f.read(self.pktSize)
                 if not chunk:
                     break
-                self.chunks.append(chunk)
+                chunks.append(chunk)
+        return chunks
+
+    def resetCounters(self):
+        self.total_sent = 0
+        self.t0 = None
+        self.srtt = None if self.warm is None else self.warm["srtt"]
+        self.rttvar = None if self.warm is None else self.warm["rttvar"]
+        self.retransmits = 0
+        self.dupAcks = 0
+        self.timeouts = 0
+        self.fecRecovered = 0 # packets the receiver rebuilt from parity, from its ACKs
+        self.progressBase = 0
+        self.progressAt = self.clock()
+
+    def checkAlive(self):
+        # the send loop gives up once the window base has not moved for IDLE_TIMEOUT: the server is gone
+        now = self.clock()
+        if self.base != self.progressBase:
+            self.progressBase, self.progressAt = self.base, now
+        elif now - self.progressAt > IDLE_TIMEOUT:
+            raise TimeoutError(f"no ACK progress for {IDLE_TIMEOUT:.0f}s after {self.timeouts} timeouts, server gone")
+
+    def sampleRtt(self, rtt):
+        # RFC 6298 smoothing of the rtt samples the controller sees, reported in the trace
+        if rtt is None:
+            return
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def initialWindow(self) -> float:
+        # half the window the last send to this peer ended with, capped by maxWin; 1 on a cold start
+        if self.warm is None:
+            return 1.0
+        return max(1.0, min(float(self.maxWin), self.warm["cwnd"] / 2))
+
+    def trace(self):
+        if self.tracer is not None:
+            self.tracer.sample(self.clock(), self.cwnd, getattr(self.cc, "ssthresh", float("nan")), self.srtt or 0.0,
+                               self.base, self.nextIdx, self.retransmits, self.dupAcks, self.timeouts)
+
+    def sendParity(self, idx: int):
+        # after the first transmission of idx, send the parity of the FEC block idx closes
+        block = self.fec.onSend(idx, self.chunks)
+        if block is None:
+            return
+        start, k, par = block
+        pkt = self.encode(start, FEC, k, par, self.clock())
+        self.socket.sendto(pkt, self.addr)
+        self.total_sent += len(par) # parity counts against utilization like any resend
+        sent = self.nextIdx + 1 + self.retransmits
+        self.fec.adapt((self.timeouts + self.fecRecovered) / sent)
+
+    def stats(self) -> dict:
+        t0 = self.clock() if self.t0 is None else self.t0
+        dt = max(1e-9, self.clock() - t0)
+        goodput_mbps = self.unique_payload * 8 / dt / 1e6
+        utilization = (self.unique_payload / self.total_sent) if self.total_sent > 0 else 0.0
+        return {"goodput_mbps": goodput_mbps, "utilization": utilization, "seconds": dt}
+
+class GBNsender(sender):
+    __slots__ = ("timerLock", "timerStart", "dupACK")
+
+    def __init__(self, socket: socket.socket, addr, inPath: str, cc: CongestControl, pktSize: int, maxWin: int) -> None:
+        super().__init__(socket, addr, inPath, cc, pktSize, maxWin)
+        self.timerLock = threading.Lock()
 
-        unique_payload = sum(len(c) for c in self.chunks)
-        total_sent = 0
-        t0 = None
+    def setup(self):
+        self.chunks: list = self.loadChunks()
+        self.unique_payload = sum(len(c) for c in self.chunks)
+        self.resetCounters()
 
         self.npkt = len(self.chunks)
         self.base = 0
         self.nextIdx = 0
-        self.cwnd = 1.0
+        self.cwnd = self.initialWindow()
         self.timeout = 0.5
         self.timerStart = None
         self.dupACK = 0
+        self.board = Scoreboard(self.npkt, self.maxWin, selective=False)
+
+    def onAck(self, data: bytes):
+        seq, flag, ackNum, payload, ts = self.decode(data)
+        if flag & (1 << 0):
+            if payload and self.fec is not None:
+                self.fecRecovered = max(self.fecRecovered, int(payload))
+            if ackNum > self.base:
+                self.base = ackNum
+                if ts > 0: 
+                    rtt = (self.clock() - ts)
+                else:
+                    rtt = None
+                self.sampleRtt(rtt)
+                self.cwnd = self.cc.ifACK(ackNum, self.cwnd, rtt)
+                with self.timerLock:
+                    if self.base != self.nextIdx:
+                        self.timerStart = self.clock()
+                    else:
+                        self.timerStart = None
+                self.dupACK = 0
+            else:
+                self.dupACK += 1
+                self.dupAcks += 1
+                if self.dupACK >= 3:
+                    self.cwnd = self.cc.ifDupACK(self.cwnd)
+                    self.dupACK = 0
+            self.trace()
+
+    def ackListener(self):
+        while not self.stopped:
+            try:
+                data, addr = self.socket.recvfrom(4096)
+            except socket.timeout:
+                continue
+            except OSError: # closed under us after an abort
+                return
+            self.onAck(data)
+            if self.base >= self.npkt:
+                return
+
+    def pump(self):
+        # one pass of the send loop: fill the window, then check the retransmission timer
+        window = int(min(self.maxWin, max(1, int(self.cwnd))))
+        while self.nextIdx < min(self.npkt, self.base + window):
+            now = self.clock()
+            pkt = self.encode(self.nextIdx, 0, 0, self.chunks[self.nextIdx], now)
+            self.socket.sendto(pkt, self.addr)
+            self.board.send(self.nextIdx, now)
+
+            if self.t0 is None:
+                self.t0 = self.clock()
+            self.total_sent += len(self.chunks[self.nextIdx])
+            if self.fec is not None:
+                self.sendParity(self.nextIdx)
+
+            if self.base == self.nextIdx:
+                self.timerStart = self.clock()
+            self.nextIdx += 1
+        self.checkTimers()
+
+    def checkTimers(self):
+        window = int(min(self.maxWin, max(1, int(self.cwnd))))
+        with self.timerLock:
+            tstart = self.timerStart
+        if (tstart is not None) and ((self.clock() - tstart) > self.timeout):
+            self.cwnd = self.cc.ifTimeout(self.cwnd)
+            self.timeouts += 1
+            for p in range(self.base, min(self.nextIdx, self.base + window)):
+                now = self.clock()
+                pkt = self.encode(p, 0, 0, self.chunks[p], now)
+                self.socket.sendto(pkt, self.addr)
+                self.board.resend(p, now)
+
+                self.total_sent += len(self.chunks[p])
+                self.retransmits += 1
+            with self.timerLock:
+                self.timerStart = self.clock()
+            self.trace()
+
+    def nextDeadline(self):
+        # when pump() next has timer work to do, None if no timer is running
+        tstart = self.timerStart
+        return None if tstart is None else tstart + self.timeout
+
+    def send(self):
+        self.socket.settimeout(1.0) # the ACK listener wakes up now and then to notice an aborted send
+        self.setup()
+        self.stopped = False
 
         listner = threading.Thread(target=self.ackListener, daemon=True)
         listner.start()
 
-        while self.base < self.npkt:
-            window = int(min(self.maxWin, max(1, int(self.cwnd))))
-            while self.nextIdx < min(self.npkt, self.base + window):
-                pkt = genPacket(self.nextIdx, 0, 0, self.chunks[self.nextIdx], time.time())
-                self.socket.sendto(pkt, self.addr)
+        try:
+            while self.base < self.npkt:
+                self.pump()
+                self.checkAlive()
+        finally:
+            self.stopped = True
+            if self.tracer is not None:
+                self.tracer.close()
 
-                if t0 is None:
-                    t0 = time.time()
-                total_sent += len(self.chunks[self.nextIdx])
+        listner.join(FIN_TIMEOUT)
+        finWait(self.socket, self.addr, self.npkt, "client")
 
-                if self.base == self.nextIdx:
-                    self.timerStart = time.time()
-                self.nextIdx += 1
-            
-            with self.timerLock:
-                tstart = self.timerStart
-            if (tstart is not None) and ((time.time() - tstart) > self.timeout):
-                self.cwnd = self.cc.ifTimeout(self.cwnd)
-                for p in range(self.base, min(self.nextIdx, self.base + window)):
-                    pkt = genPacket(p, 0, 0, self.chunks[p], time.time())
-                    self.socket.sendto(pkt, self.addr)
-
-                    total_sent += len(self.chunks[p])
-                with self.timerLock:
-                    self.timerStart = time.time()
-
-        fin = genPacket(self.npkt, (1 << 1), 0, "".encode("utf-8"), time.time())
-        self.socket.sendto(fin, self.addr)
-        # while True:
-        #     data, addr = self.socket.recvfrom(4096)
-        #     seq, flag, ackNum, payload, ts = getPacket(data)
-        #     if ackNum >= self.npkt and flag & (1 << 0):
-        #         break
-        self.socket.settimeout(2.0)
-        while True:
-            fin = genPacket(self.npkt, (1 << 1), 0, "".encode("utf-8"), time.time())
-            self.socket.sendto(fin, self.addr)
-            try:
-                data, addr = self.socket.recvfrom(4096)
-                seq, flag, ackNum, payload, ts = getPacket(data)
-            
-                if flag & (1 << 0) and self.base >= self.npkt:
-                    break
-            except socket.timeout:
-                continue
-            
-            if (flag & (1 << 0)) and ackNum >= self.npkt:
-                break
-        
-        if t0 is None:
-            t0 = time.time()
-        dt = max(1e-9, time.time() - t0)
-        goodput_mbps = unique_payload * 8 / dt / 1e6
-        utilization = (unique_payload / total_sent) if total_sent > 0 else 0.0
-        print(f"METRIC,mode=gbn,goodput_mbps={goodput_mbps:.3f},utilization={utilization:.4f},seconds={dt:.3f}")
+        m = self.stats()
+        print(f"METRIC,mode=gbn,goodput_mbps={m['goodput_mbps']:.3f},utilization={m['utilization']:.4f},seconds={m['seconds']:.3f},kernel_drops={udpDrops(self.socket)}")
 
 
-class SRsender:
-    def __init__(self, socket: socket.socket, addr, inPath: str, cc: CongestControl, pktSize, maxWin):
-        self.socket = socket
-        self.addr = addr
-        self.inPath = inPath
-        self.cc = cc
-        self.pktSize = pktSize
-        self.maxWin = maxWin
+class SRsender(sender):
+    __slots__ = ()
+
+    def setup(self):
+        self.chunks: list = self.loadChunks()
+        self.unique_payload = sum(len(c) for c in self.chunks)
+        self.resetCounters()
+        
+        self.npkt = len(self.chunks)
+        self.base = 0
+        self.nextIdx = 0
+        self.cwnd = self.initialWindow()
+        self.timeout = 0.5
+        self.board = Scoreboard(self.npkt, self.maxWin)
+
+    def onAck(self, data: bytes):
+        seq, flag, ackNum, payload, ts = self.decode(data)
+        if flag & (1 << 0):
+            if payload and self.fec is not None:
+                self.fecRecovered = max(self.fecRecovered, int(payload))
+            idx = seq - 1 # the seq this ACK answers, ackNum is the receiver's cumulative expect
+            if 0 <= idx < self.npkt:
+                if not self.board.ack(idx):
+                    self.dupAcks += 1
+                self.board.ackThrough(self.base, ackNum) # covers ACKs lost on the way
+                if ts > 0:
+                    rtt = (self.clock() - ts)
+                else:
+                    rtt = None
+                self.sampleRtt(rtt)
+                self.cwnd = self.cc.ifACK(ackNum, self.cwnd, rtt)
+                self.base = self.board.advance(self.base)
+                self.trace()
     
     def ackListener(self):
-        while True:
+        while not self.stopped:
             try:
                 data, addr = self.socket.recvfrom(4046)
             except socket.timeout:
                 continue
-            seq, flag, ackNum, payload, ts = getPacket(data)
-            if flag & (1 << 0):
-                idx = ackNum - 1
-                if 0 <= idx < self.npkt:
-                    self.acked.add(idx)
-                    if ts > 0:
-                        rtt = (time.time() - ts)
-                    else:
-                        rtt = None
-                    self.cwnd = self.cc.ifACK(ackNum, self.cwnd, rtt)
-                    while self.base in self.acked:
-                        self.base += 1
-            
+            except OSError: # closed under us after an abort
+                return
+            self.onAck(data)
             if self.base >= self.npkt:
                 return
+
+    def pump(self):
+        window = int(min(self.maxWin, max(1, int(self.cwnd))))
+        while self.nextIdx < self.npkt and self.nextIdx < self.base + window:
+            now = self.clock()
+            pkt = self.encode(self.nextIdx, 0, 0, self.chunks[self.nextIdx], now)
+            self.socket.sendto(pkt, self.addr)
+
+            if self.t0 is None:
+                self.t0 = self.clock()
+            self.total_sent += len(self.chunks[self.nextIdx])
+            if self.fec is not None:
+                self.sendParity(self.nextIdx)
+            self.board.send(self.nextIdx, now)
+            self.nextIdx += 1
+        self.checkTimers()
+
+    def checkTimers(self):
+        for idx in self.board.expired(self.base, self.nextIdx, self.clock(), self.timeout):
+            self.cwnd = self.cc.ifTimeout(self.cwnd)
+            now = self.clock()
+            pkt = self.encode(idx, 0, 0, self.chunks[idx], now)
+            self.socket.sendto(pkt, self.addr)
+
+            self.total_sent += len(self.chunks[idx])
+            self.retransmits += 1
+            self.timeouts += 1
+
+            self.board.resend(idx, now)
+            self.trace()
+
+    def nextDeadline(self):
+        oldest = self.board.deadline(self.base, self.nextIdx)
+        return None if oldest is None else oldest + self.timeout
     
     def send(self):
-        self.socket.settimeout(None)
-        self.chunks: list = []
-        with open(self.inPath, "rb") as f:
-            while True:
-                chunk = f.read(self.pktSize)
-                if not chunk:
-                    break
-                self.chunks.append(chunk)
+        self.socket.settimeout(1.0) # the ACK listener wakes up now and then to notice an aborted send
+        self.setup()
+        self.stopped = False
+
+        listener = threading.Thread(target=self.ackListener, daemon=True)
+        listener.start()
 
-        unique_payload = sum(len(c) for c in self.chunks)
-        total_sent = 0
-        t01 = None
+        try:
+            while self.base < self.npkt:
+                self.pump()
+                self.checkAlive()
+        finally:
+            self.stopped = True
+            if self.tracer is not None:
+                self.tracer.close()
+            
+        listener.join(FIN_TIMEOUT)
+        print("client: waiting for FIN-ACK")
+        finWait(self.socket, self.addr, self.npkt, "client")
+
+        m = self.stats()
+        print(f"METRIC,mode=sr,goodput_mbps={m['goodput_mbps']:.3f},utilization={m['utilization']:.4f},seconds={m['seconds']:.3f},kernel_drops={udpDrops(self.socket)}")
         
+
+class AUTOsender(sender): # go-back-N or selective repeat, re-picked every epoch from measured loss and reordering
+    __slots__ = ("ackLock", "timerStart", "dupACKcount", "highSel", "switch")
+
+    def __init__(self, socket: socket.socket, addr, inPath: str, cc: CongestControl, pktSize: int, maxWin: int) -> None:
+        super().__init__(socket, addr, inPath, cc, pktSize, maxWin)
+        self.ackLock = threading.Lock()
+
+    def setup(self):
+        self.chunks: list = self.loadChunks()
+        self.unique_payload = sum(len(c) for c in self.chunks)
+        self.resetCounters()
+
         self.npkt = len(self.chunks)
         self.base = 0
         self.nextIdx = 0
-        self.sent: dict = {}
-        self.acked: set = set()
-        self.cwnd = 1.0
+        self.cwnd = self.initialWindow()
         self.timeout = 0.5
-        self.timers: dict = {}
+        self.timerStart = None # the go-back-N timer, on the oldest unacked packet
+        self.dupACKcount = 0
+        self.highSel = -1 # highest seq selectively acked so far
+        self.switch = ModeSwitch()
+        self.board = Scoreboard(self.npkt, self.maxWin)
+
+    def transmit(self, idx: int):
+        now = self.clock()
+        pkt = self.encode(idx, 0, 0, self.chunks[idx], now)
+        self.socket.sendto(pkt, self.addr)
+        if self.t0 is None:
+            self.t0 = self.clock()
+        self.total_sent += len(self.chunks[idx])
+        if idx < self.nextIdx: # pump() sends nextIdx first and advances it afterwards
+            self.board.resend(idx, now)
+        else:
+            self.board.send(idx, now)
+
+    def observe(self, idx: int, late: bool):
+        mode = self.switch.onAcked(late, self.board.retried(idx))
+        if mode is not None:
+            print(f"client: arq auto -> {mode} (loss {self.switch.loss:.2%}, reordering {self.switch.reorder:.2%})")
+            if mode == "gbn": # restart the single timer the per-packet ones stood in for
+                self.timerStart = self.clock() if self.base < self.nextIdx else None
+
+    def onAck(self, data: bytes):
+        seq, flag, ackNum, payload, ts = self.decode(data)
+        if flag & (1 << 0):
+            if payload and self.fec is not None:
+                self.fecRecovered = max(self.fecRecovered, int(payload))
+            rtt = (self.clock() - ts) if ts > 0 else None
+            with self.ackLock:
+                newly = 0
+                idx = seq - 1
+                if 0 <= idx < self.npkt and self.board.ack(idx):
+                    newly += 1
+                    self.observe(idx, idx < self.highSel)
+                self.highSel = max(self.highSel, idx)
+                for covered in self.board.ackThrough(self.base, ackNum):
+                    newly += 1
+                    self.observe(covered, False)
+                if newly:
+                    self.sampleRtt(rtt)
+                    self.cwnd = self.cc.ifACK(ackNum, self.cwnd, rtt)
+                else:
+                    self.dupAcks += 1
+                base = self.board.advance(self.base)
+                if base > self.base:
+                    self.base = base
+                    self.dupACKcount = 0
+                    self.timerStart = self.clock() if self.base != self.nextIdx else None
+                elif self.switch.mode == "gbn" and self.base < self.nextIdx:
+                    self.dupACKcount += 1 # the receiver holds later packets, base is missing
+                    if self.dupACKcount >= 3:
+                        self.cwnd = self.cc.ifDupACK(self.cwnd)
+                        self.dupACKcount = 0
+                        self.transmit(self.base)
+                        self.retransmits += 1
+                        self.timerStart = self.clock()
+                self.trace()
+
+    def ackListener(self):
+        while not self.stopped:
+            try:
+                data, addr = self.socket.recvfrom(4096)
+            except socket.timeout:
+                continue
+            except OSError: # closed under us after an abort
+                return
+            self.onAck(data)
+            if self.base >= self.npkt:
+                return
+
+    def pump(self):
+        window = int(min(self.maxWin, max(1, int(self.cwnd))))
+        while self.nextIdx < min(self.npkt, self.base + window):
+            self.transmit(self.nextIdx)
+            if self.fec is not None:
+                self.sendParity(self.nextIdx)
+            if self.base == self.nextIdx:
+                self.timerStart = self.clock()
+            self.nextIdx += 1
+        self.checkTimers()
+
+    def checkTimers(self):
+        if self.switch.mode == "sr":
+            with self.ackLock:
+                for idx in self.board.expired(self.base, self.nextIdx, self.clock(), self.timeout):
+                    self.cwnd = self.cc.ifTimeout(self.cwnd)
+                    self.transmit(idx)
+                    self.retransmits += 1
+                    self.timeouts += 1
+                    self.trace()
+            return
+        window = int(min(self.maxWin, max(1, int(self.cwnd))))
+        with self.ackLock:
+            tstart = self.timerStart
+        if (tstart is not None) and ((self.clock() - tstart) > self.timeout):
+            self.cwnd = self.cc.ifTimeout(self.cwnd)
+            self.timeouts += 1
+            for p in range(self.base, min(self.nextIdx, self.base + window)):
+                self.transmit(p)
+                self.retransmits += 1
+            self.timerStart = self.clock()
+            self.trace()
+
+    def nextDeadline(self):
+        if self.switch.mode == "sr":
+            with self.ackLock:
+                oldest = self.board.deadline(self.base, self.nextIdx)
+            return None if oldest is None else oldest + self.timeout
+        tstart = self.timerStart
+        return None if tstart is None else tstart + self.timeout
+
+    def send(self):
+        self.socket.settimeout(1.0) # the ACK listener wakes up now and then to notice an aborted send
+        self.setup()
+        self.stopped = False
 
         listener = threading.Thread(target=self.ackListener, daemon=True)
         listener.start()
 
-        while self.base < self.npkt:
-            window = int(min(self.maxWin, max(1, int(self.cwnd))))
-            while self.nextIdx < self.npkt and self.nextIdx < self.base + window:
-                pkt = genPacket(self.nextIdx, 0, 0, self.chunks[self.nextIdx], time.time())
-                self.socket.sendto(pkt, self.addr)
+        try:
+            while self.base < self.npkt:
+                self.pump()
+                self.checkAlive()
+        finally:
+            self.stopped = True
+            if self.tracer is not None:
+                self.tracer.close()
 
-                if t01 is None:
-                    t01 = time.time()
-                total_sent += len(self.chunks[self.nextIdx])
-                
-                self.sent[self.nextIdx] = pkt
-                self.timers[self.nextIdx] = time.time()
-                self.nextIdx += 1
-            
-            now = time.time()
-            for idx in list(self.sent.keys()):
-                if idx in self.acked:
-                    self.sent.pop(idx)
-                    self.timers.pop(idx)
-            for idx, t0 in list(self.timers.items()):
-                if now - t0 > self.timeout and idx not in self.acked:
-                    self.cwnd = self.cc.ifTimeout(self.cwnd)
-                    pkt = genPacket(idx, 0, 0, self.chunks[idx], time.time())
-                    self.socket.sendto(pkt, self.addr)
+        listener.join(FIN_TIMEOUT)
+        finWait(self.socket, self.addr, self.npkt, "client")
 
-                    total_sent += len(self.chunks[idx])
-
-                    self.timers[idx] = time.time()
-            
-        fin = genPacket(self.npkt, (1 << 1), 0, "".encode("utf-8"), time.time())
-        self.socket.sendto(fin, self.addr)
-        # while True:
-        #     data, addr = self.socket.recvfrom(4096)
-        #     seq, flag, ackNum, payload, ts = getPacket(data)
-        #     if flag & (1 << 0) and ackNum >= self.npkt:
-        #         break
-        print("client: waiting for FIN-ACK")
-        self.socket.settimeout(2.0)
-        while True:
-            try:
-                data, addr = self.socket.recvfrom(4096)
-            except socket.timeout:
-                if self.base >= self.npkt:
-                    break
-                else:
-                    continue
-            seq, flag, ackNum, payload, ts = getPacket(data)
-            if (flag & (1 << 0)) and ackNum >= self.npkt:
-                break
-        
-        if t01 is None:
-            t01 = time.time()
-        dt = max(1e-9, time.time() - t01)
-        goodput_mbps = unique_payload * 8 / dt / 1e6
-        utilization = (unique_payload / total_sent) if total_sent > 0 else 0.0
-        print(f"METRIC,mode=sr,goodput_mbps={goodput_mbps:.3f},utilization={utilization:.4f},seconds={dt:.3f}")
-        
+        m = self.stats()
+        print(f"METRIC,mode=auto,goodput_mbps={m['goodput_mbps']:.3f},utilization={m['utilization']:.4f},seconds={m['seconds']:.3f},"
+              f"kernel_drops={udpDrops(self.socket)},arq_switches={self.switch.switches}")
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--server", type=str, required=True)
     parser.add_argument("--port", type=int, default=10000)
-    parser.add_argument("--arq", type=str, choices=["gbn", "sr"], default="gbn")
+    parser.add_argument("--arq", type=str, choices=["gbn", "sr", "auto"], default="gbn",
+                        help="auto = start go-back-N, switch to selective repeat while loss or reordering is high")
     parser.add_argument("--cc", type=str, choices=["reno", "vegas"], default="reno")
     parser.add_argument("--pktSize", type=int, default=1024)
     parser.add_argument("--maxWin", type=int, default=64)
+    parser.add_argument("--weight", type=float, default=1.0, help="bandwidth share requested from the server")
+    parser.add_argument("--busyRetries", type=int, default=5)
+    parser.add_argument("--rcvbuf", type=int, default=0, help="data socket SO_RCVBUF bytes, 0 = auto from maxWin * pktSize")
+    parser.add_argument("--sndbuf", type=int, default=0, help="data socket SO_SNDBUF bytes, 0 = auto from maxWin * pktSize")
+    parser.add_argument("--busyPoll", type=int, default=0, help="SO_BUSY_POLL microseconds, 0 = off")
+    parser.add_argument("--tos", type=int, default=-1, help="IP_TOS byte for data packets, -1 = leave default")
+    parser.add_argument("--trace", type=str, default=None, help="write a cwnd/rtt trace of the upload here (*.csv = text)")
+    parser.add_argument("--fec", type=int, default=0, help="XOR parity every K data packets (K adapts to loss), 0 = off")
+    parser.add_argument("--compress", type=str, choices=["none", "auto", *CODECS], default="none",
+                        help="compress the stream in blocks, incompressible blocks go raw; auto = fastest installed codec")
+    shrink = parser.add_mutually_exclusive_group()
+    shrink.add_argument("--delta", action="store_true",
+                        help="upload only what differs from the server's existing copy (rsync style block matching)")
+    shrink.add_argument("--dedup", action="store_true",
+                        help="offer chunk hashes first and upload only the chunks a --dedup server lacks")
+    parser.add_argument("--session", action="store_true",
+                        help="keep one data socket open on both ends for every transfer of this run")
+    parser.add_argument("--pathTTL", type=float, default=0.0,
+                        help="seconds the last upload's rtt/cwnd/ssthresh seed the next one (e.g. 600 with --session), "
+                             "0 = off, every upload starts cold")
+    parser.add_argument("--profile", action="store_true", help="print per-phase hot path timings after each transfer")
+    parser.add_argument("--cprofile", type=str, default=None, help="also dump cProfile stats of the transfer thread here")
 
     sub = parser.add_subparsers(dest="operation", required=True)
     up = sub.add_parser("upload")
@@ -418,12 +664,138 @@ def main():
     dl = sub.add_parser("download")
     dl.add_argument("localPath", type=str)
     dl.add_argument("remoteName", type=str)
+    sub.add_parser("stats", help="print the server's live transfer stats")
     args = parser.parse_args()
 
+    codecName = resolve(args.compress)
+
     socketControl = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     socketControl.settimeout(10.0)
+    paths = PathCache(args.pathTTL) # metrics of the last upload, the server is this run's only peer
+    sessionId = os.urandom(8).hex() if args.session else None
+    sessionSock = None # the data socket every transfer of the session reuses
+
+    def dataSocket() -> socket.socket:
+        nonlocal sessionSock
+        if sessionSock is not None:
+            return sessionSock
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        tuneSocket(sock, args.pktSize, args.maxWin, args.rcvbuf, args.sndbuf, args.busyPoll, args.tos, who="client")
+        sock.bind(("", 0))
+        if sessionId is not None:
+            sessionSock = sock
+        return sock
+
+    def release(sock: socket.socket) -> None:
+        if sock is not sessionSock:
+            sock.close()
+
+    def request(req: dict):
+        try:
+            socketControl.sendto(json.dumps(req).encode("utf-8"), (args.server, args.port))
+        except Exception as e:
+            print(f"Failed to send control request: {e}")
+            return
+
+        try:
+            data, _ = socketControl.recvfrom(65536)
+        except socket.timeout:
+            print("Control socket recv timeout")
+            return
+        except Exception as e:
+            print(f"Control recv error: {e}")
+            return
+
+        try:
+            return json.loads(data.decode("utf-8"))
+        except Exception as e:
+            print(f"error control response: {e}")
+            return
+
+    def waitDone(operation: str, localPath: str):
+        # the server reports the final md5 on the control channel once its side is closed,
+        # returns the report when it matches the local file
+        try:
+            data, _ = socketControl.recvfrom(65536)
+            resp = json.loads(data.decode("utf-8"))
+        except socket.timeout:
+            print("client: no done report from server")
+            return
+        except Exception as e:
+            print(f"error done report: {e}")
+            return
+        if resp.get("status") != "done":
+            print(f"Server error: {resp}")
+            return False
+        if "kernelDrops" in resp:
+            print(f"client: server kernel drops on data socket = {resp['kernelDrops']}")
+        localMD5 = getMD5(localPath)
+        serverMD5 = resp.get("md5")
+        print(f"client: local MD5 = {localMD5} | server MD5 = {serverMD5}")
+        if localMD5 == serverMD5:
+            print(f"client: successfully {operation}")
+            return resp
+        print(f"client: MD5 mismatch, {operation} corrupted")
+        return False
+
+    def runFlow(flow, run, title: str):
+        prof = None
+        if args.profile:
+            prof = Profiler()
+            prof.instrument(flow)
+        if args.cprofile:
+            runProfiled(args.cprofile, run)
+        else:
+            run()
+        if prof is not None:
+            prof.addWriter(getattr(flow, "writer", None))
+            print(prof.report(title))
+            if args.cprofile:
+                topFunctions(args.cprofile)
+
+    def showStats():
+        resp = request({"cmd": "stats"})
+        if resp is not None:
+            print(json.dumps(resp, indent=2))
+
+    def fetchDelta(localPath: str, remoteName: str):
+        # (delta request fields, delta stream) against the server's copy, None when it has none
+        # or the delta would not be smaller than the file
+        fd, sigPath = tempfile.mkstemp(suffix=".sig")
+        os.close(fd)
+        try:
+            done = do_transaction("signatures", sigPath, remoteName)
+            if not done:
+                return None
+            with open(sigPath, "rb") as f:
+                sigs = parseSignatures(f.read())
+        finally:
+            os.remove(sigPath)
+        with open(localPath, "rb") as f:
+            data = f.read()
+        got = makeDelta(data, sigs, maxLiteral=len(data) - len(data) // 8)
+        if got is None or len(got[0]) >= len(data):
+            print("client: the server's copy shares too little with the file for a delta")
+            return None
+        stream, literal = got
+        blockSize, _, basisMd5, _ = sigs
+        print(f"client: delta {len(stream)} bytes for {len(data)} file bytes ({literal} literal, block {blockSize})")
+        return {"blockSize": blockSize, "basisMd5": basisMd5, "basisVersion": done.get("basisVersion")}, stream
+
+    def offerChunks(localPath: str, remoteName: str):
+        # (file bytes, the server's done report naming the chunks it lacks), None when it can't dedup
+        with open(localPath, "rb") as f:
+            data = f.read()
+        fd, offerPath = tempfile.mkstemp(suffix=".offer")
+        with os.fdopen(fd, "wb") as f:
+            f.write(packOffer(len(data), chunkHashes(data)))
+        try:
+            resp = do_transaction("offer", offerPath, remoteName)
+        finally:
+            os.remove(offerPath)
+        return None if not resp else (data, resp)
 
-    def do_transaction(operation: str, localPath: str, remoteName: str):
+    def do_transaction(operation: str, localPath: str, remoteName: str, whole: bool = False):
         req = {
             "cmd": operation,
             "name": remoteName,
@@ -432,7 +804,15 @@ def main():
             "cc": args.cc,
             "pktSize": args.pktSize,
             "maxWin": args.maxWin,
+            "weight": args.weight,
+            "fec": args.fec,
         }
+        if sessionId is not None:
+            req["session"] = sessionId
+        if codecName and operation in ("upload", "download"):
+            req["compress"] = codecName
+        if operation == "upload" and os.path.isfile(localPath):
+            req["size"] = os.path.getsize(localPath) # lets the server preallocate the file
 
         if operation == "upload":
             if not os.path.exists(localPath):
@@ -442,29 +822,57 @@ def main():
                 print(f"Local path is not a file: {localPath}")
                 return
 
-        try:
-            socketControl.sendto(json.dumps(req).encode("utf-8"), (args.server, args.port))
-        except Exception as e:
-            print(f"Failed to send control request: {e}")
-            return
-
-        try:
-            data, _ = socketControl.recvfrom(4096)
-        except socket.timeout:
-            print("Control socket recv timeout")
-            return
-        except Exception as e:
-            print(f"Control recv error: {e}")
-            return
-
-        try:
-            resp = json.loads(data.decode("utf-8"))
-        except Exception as e:
-            print(f"error control response: {e}")
-            return
+        stream = None
+        if operation == "upload" and args.delta and not whole:
+            got = fetchDelta(localPath, remoteName)
+            if got is None:
+                print("client: no usable delta, uploading the whole file")
+            else:
+                req["delta"], stream = got
+                req["md5"] = getMD5(localPath) # the server checks its rebuilt file against this
+        elif operation == "upload" and args.dedup and not whole:
+            got = offerChunks(localPath, remoteName)
+            if got is None:
+                print("client: server can't deduplicate, uploading the whole file")
+            else:
+                data, done = got
+                req["md5"] = hashlib.md5(data).hexdigest()
+                if "stored" in done: # the server named the file from chunks it already had
+                    if done["stored"] != req["md5"]:
+                        print("client: MD5 mismatch, upload corrupted")
+                        return
+                    print("client: successfully upload, every chunk was already on the server")
+                    return done
+                missing = fromRanges(done["missing"])
+                view = memoryview(data)
+                stream = b"".join(view[i * CHUNK: (i + 1) * CHUNK] for i in missing)
+                req["dedup"] = True
+                print(f"client: server lacks {len(missing)} of {-(-len(data) // CHUNK)} chunks, sending {len(stream)} bytes")
+
+        framed = None
+        if operation == "upload" and codecName:
+            def readAll():
+                if stream is not None:
+                    return stream
+                with open(localPath, "rb") as f:
+                    return f.read()
+            framed = frameLater(readAll, codecName) # compresses while the request is answered
+
+        for attempt in range(args.busyRetries + 1):
+            resp = request(req)
+            if resp is None:
+                return
+            if resp.get("status") != "busy":
+                break
+            wait = float(resp.get("retryAfter", 1.0))
+            print(f"client: server busy, retry after {wait}s ({attempt + 1}/{args.busyRetries})")
+            if attempt < args.busyRetries:
+                time.sleep(wait)
 
         if resp.get("status") != "ok":
             print(f"Server error: {resp}")
+            if stream is not None:
+                return do_transaction(operation, localPath, remoteName, whole=True)
             return
 
         dataPort = resp.get("dataPort")
@@ -472,8 +880,9 @@ def main():
             print("missing dataPort")
             return
 
-        socketData = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        socketData.bind(("", 0))
+        socketData = dataSocket()
+        if socketData is sessionSock:
+            drain(socketData) # the server answered once its side of the last transfer was over
         serverAddr = (args.server, int(dataPort))
 
         if args.cc == "reno":
@@ -481,38 +890,62 @@ def main():
         else:
             cc = vegasContol()
         try:
-            if operation == "upload":
-                print(f"Starting upload: {localPath} -> {remoteName} (arq = {args.arq}, cc = {args.cc})")
-                if args.arq == "gbn":
-                    sender = GBNsender(socketData, serverAddr, localPath, cc, args.pktSize, args.maxWin)
-                else:
-                    sender = SRsender(socketData, serverAddr, localPath, cc, args.pktSize, args.maxWin)
-                sender.send()
+            if operation in ("upload", "offer"):
+                print(f"Starting {operation}: {localPath} -> {remoteName} (arq = {args.arq}, cc = {args.cc})")
+                senderCls = {"sr": SRsender, "auto": AUTOsender}.get(args.arq, GBNsender)
+                sender = senderCls(socketData, serverAddr, localPath, cc, args.pktSize, args.maxWin)
+                if stream is not None:
+                    sender.data = stream
+                if framed is not None:
+                    sender.data = framed.result()
+                    print(f"client: {codecName} stream {len(sender.data)} bytes for {req['size']} file bytes")
+                if args.fec > 0:
+                    sender.fec = fecEncoder(args.fec)
+                if args.trace:
+                    sender.tracer = Tracer(args.trace, meta={"arq": args.arq, "cc": args.cc, "op": "upload", "pktSize": args.pktSize, "maxWin": args.maxWin})
+                warm = paths.seed(args.server, sender)
+                if warm is not None:
+                    print(f"client: warm start (cwnd {sender.initialWindow():.1f}, ssthresh {getattr(cc, 'ssthresh', 0):.1f}, srtt {warm['srtt'] * 1000:.1f}ms)")
+                runFlow(sender, sender.send, f"upload {args.arq}/{args.cc}")
+                paths.remember(args.server, sender)
                 print("Upload finished")
+                done = waitDone(operation, localPath)
+                if not done and stream is not None:
+                    print("client: rebuilt upload failed, uploading the whole file")
+                    release(socketData)
+                    return do_transaction(operation, localPath, remoteName, whole=True)
+                return done
             else:
-                print(f"Starting download: {remoteName} -> {localPath} (arq = {args.arq}, cc = {args.cc})")
+                print(f"Starting {operation}: {remoteName} -> {localPath} (arq = {args.arq}, cc = {args.cc})")
                 try:
                     probe = genPacket(0, 0, 0, b"HELLO", time.time())
                     socketData.sendto(probe, serverAddr)
                 except Exception:
                     pass
-                if args.arq == "gbn":
-                    receiver = GBNreceiver(socketData, serverAddr, localPath)
-                else:
-                    receiver = SRreceiver(socketData, serverAddr, localPath)
-                receiver.receive()
+                sizeHint = int(resp.get("size", 0))
+                receiver = ARQreceiver(socketData, serverAddr, localPath, sizeHint)
+                if args.fec > 0:
+                    receiver.fec = fecDecoder()
+                if "compress" in req:
+                    receiver.unframe = Deframer()
+                runFlow(receiver, receiver.receive, f"{operation} {args.arq}")
                 print("Download finished")
+                print(f"client: kernel drops on data socket = {udpDrops(socketData)}")
+                return waitDone(operation, localPath)
         except KeyboardInterrupt:
             print("Interrupted during data transfer!!!")
         except Exception as e:
             print(f"Transaction error: {e}")
         finally:
             try:
-                socketData.close()
+                release(socketData)
             except:
                 pass
 
-    do_transaction(args.operation, args.localPath, args.remoteName)
+    if args.operation == "stats":
+        showStats()
+    else:
+        do_transaction(args.operation, args.localPath, args.remoteName)
 
     try:
         while True:
@@ -523,6 +956,9 @@ def main():
                 print("Quitting")
                 break
             parts = line.split()
+            if parts == ["stats"]:
+                showStats()
+                continue
             if len(parts) != 3 or parts[0] not in ("upload", "download"):
                 print("input error, try again")
                 continue
@@ -531,6 +967,10 @@ def main():
     except (KeyboardInterrupt, EOFError):
         print("Exiting")
     finally:
+        if sessionSock is not None:
+            socketControl.settimeout(1.0) # best effort, the server also closes idle sessions
+            request({"cmd": "close", "session": sessionId})
+            sessionSock.close()
         try:
             socketControl.close()
         except:
@@ -0,0 +1,123 @@
+import os
+import bz2
+import lzma
+import zlib
+import struct
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+BLOCK = 256 * 1024 # raw bytes per compressed block, many packets each
+PROBE = 4096 # bytes test-compressed to decide whether a block is worth it
+PROBE_RATIO = 0.9 # probe must shrink below this, else the block goes raw
+FRAME = struct.Struct("<BII") # codec id (0 = raw), raw length, stored length
+
+# name -> (id, compress, decompress); the fast codecs only when their module is installed
+CODECS = {
+    "zlib": (1, lambda b: zlib.compress(b, 6), zlib.decompress),
+    "lzma": (2, lambda b: lzma.compress(b, preset=1), lzma.decompress),
+    "bz2": (3, lambda b: bz2.compress(b, 9), bz2.decompress),
+}
+try:
+    import zstandard
+    CODECS["zstd"] = (4, lambda b: zstandard.ZstdCompressor(level=3).compress(b), lambda b: zstandard.ZstdDecompressor().decompress(b))
+except ImportError:
+    pass
+try:
+    import lz4.frame
+    CODECS["lz4"] = (5, lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+DECOMPRESS = {cid: dec for cid, _, dec in CODECS.values()}
+
+_pool = None
+_poolLock = threading.Lock()
+
+def pool() -> ThreadPoolExecutor:
+    # shared block workers, the codecs release the GIL so blocks compress in parallel
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix="codec")
+        return _pool
+
+def resolve(name: str):
+    # "auto" picks the fastest installed codec, None/"none" disables compression
+    if name in (None, "", "none"):
+        return None
+    if name == "auto":
+        return next(c for c in ("lz4", "zstd", "zlib") if c in CODECS)
+    if name not in CODECS:
+        raise ValueError(f"unsupported codec {name}")
+    return name
+
+def packBlock(raw, codec: str) -> bytes:
+    cid, compress, _ = CODECS[codec]
+    raw = bytes(raw)
+    if len(compress(raw[: PROBE])) < PROBE_RATIO * min(len(raw), PROBE):
+        packed = compress(raw)
+        if len(packed) < len(raw):
+            return FRAME.pack(cid, len(raw), len(packed)) + packed
+    return FRAME.pack(0, len(raw), len(raw)) + raw # incompressible, sent as is
+
+def frame(data, codec: str) -> bytes:
+    # the byte stream the ARQ layer sends instead of the file: one frame per BLOCK
+    view = memoryview(data)
+    blocks = [view[i: i + BLOCK] for i in range(0, len(view), BLOCK)]
+    return b"".join(pool().map(packBlock, blocks, [codec] * len(blocks)))
+
+def frameLater(load, codec: str) -> Future:
+    # frame(load()) on its own thread, so it runs while the control handshake is in flight
+    fut: Future = Future()
+    def run() -> None:
+        try:
+            fut.set_result(frame(load(), codec))
+        except Exception as e:
+            fut.set_exception(e)
+    threading.Thread(target=run, daemon=True).start()
+    return fut
+
+class Deframer: # receiver side: in-order stream bytes in, file bytes out
+    def __init__(self) -> None:
+        self.pending = bytearray()
+
+    def __call__(self, data: bytes) -> bytes:
+        self.pending += data
+        out = []
+        pos = 0
+        while len(self.pending) - pos >= FRAME.size:
+            cid, rawLen, size = FRAME.unpack_from(self.pending, pos)
+            end = pos + FRAME.size + size
+            if end > len(self.pending):
+                break
+            body = bytes(self.pending[pos + FRAME.size: end])
+            raw = body if cid == 0 else DECOMPRESS[cid](body)
+            if len(raw) != rawLen:
+                raise ValueError(f"corrupt frame, {len(raw)} bytes instead of {rawLen}")
+            out.append(raw)
+            pos = end
+        del self.pending[: pos]
+        return b"".join(out)
+
+    def finish(self) -> None:
+        if self.pending:
+            raise ValueError(f"stream ended inside a frame, {len(self.pending)} bytes left")
+
+class Chain: # receiver transforms applied in a row, e.g. Deframer then delta.Patcher
+    def __init__(self, *stages) -> None:
+        self.stages = stages
+
+    def __call__(self, data: bytes) -> bytes:
+        for stage in self.stages:
+            data = stage(data)
+        return data
+
+    def finish(self) -> None:
+        for stage in self.stages:
+            if hasattr(stage, "finish"):
+                stage.finish()
+
+def chain(stages: list):
+    # None, the single stage, or a Chain of them
+    if not stages:
+        return None
+    return stages[0] if len(stages) == 1 else Chain(*stages)
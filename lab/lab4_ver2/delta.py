@@ -0,0 +1,165 @@
+import math
+import zlib
+import struct
+import hashlib
+
+MOD = 65521 # adler32 modulus
+SIG_HEADER = struct.Struct("<4sIQ16s") # magic, block size, basis size, basis md5
+SIG_ENTRY = struct.Struct("<I8s") # adler32 weak sum, 8 byte blake2b strong sum
+SIG_MAGIC = b"SIG1"
+COPY = struct.Struct("<cII") # b"C", first block, block count
+LITERAL = struct.Struct("<cI") # b"L", length, then the bytes
+END = b"E"
+MAX_LITERAL = 64 * 1024
+PROBE_BLOCKS = 16 # makeDelta gives up when nothing matched within this many blocks (or 1/16 of the file)
+
+def pickBlockSize(size: int) -> int:
+    # about 2 * sqrt(size), like rsync, so signatures stay small next to the file
+    return max(2048, min(1 << 16, 2 * math.isqrt(max(1, size))))
+
+def sigSize(size: int) -> int:
+    # length of signatures() for a file of this size at the default block size
+    return SIG_HEADER.size + size // pickBlockSize(size) * SIG_ENTRY.size
+
+def strong(block) -> bytes:
+    return hashlib.blake2b(block, digest_size=8).digest()
+
+def signatures(data, blockSize: int = 0) -> bytes:
+    # signature blob of the server's copy: header + one (weak, strong) pair per full block
+    blockSize = blockSize or pickBlockSize(len(data))
+    view = memoryview(data)
+    out = [SIG_HEADER.pack(SIG_MAGIC, blockSize, len(data), hashlib.md5(data).digest())]
+    for i in range(0, len(view) - blockSize + 1, blockSize):
+        block = view[i: i + blockSize]
+        out.append(SIG_ENTRY.pack(zlib.adler32(block), strong(block)))
+    return b"".join(out)
+
+def parseSignatures(blob: bytes) -> tuple:
+    # (blockSize, basis size, basis md5 hex, {weak: [(strong, index), ...]})
+    magic, blockSize, size, md5 = SIG_HEADER.unpack_from(blob)
+    if magic != SIG_MAGIC:
+        raise ValueError("not a signature blob")
+    table: dict = {}
+    for n, (weak, sig) in enumerate(SIG_ENTRY.iter_unpack(blob[SIG_HEADER.size:])):
+        table.setdefault(weak, []).append((sig, n))
+    return blockSize, size, md5.hex(), table
+
+def makeDelta(data, sigs: tuple, maxLiteral: int = -1):
+    # delta stream turning the basis into data, plus how many bytes had to go literally;
+    # sigs is parseSignatures() of the basis. None when the delta isn't worth it: no block of the
+    # basis turns up early on, or more than maxLiteral bytes (-1 = no cap) would go literally
+    blockSize, _, _, table = sigs
+    view = memoryview(data)
+    n = len(view)
+    if not table:
+        return None
+    probe = max(PROBE_BLOCKS * blockSize, n // 16)
+    matched = False
+    ops = []
+    literal = bytearray()
+    literalBytes = 0
+    run = None # [first block, count] of the copy being extended
+    def flushLiteral() -> None:
+        nonlocal literalBytes
+        if literal:
+            ops.append(LITERAL.pack(b"L", len(literal)) + bytes(literal))
+            literalBytes += len(literal)
+            literal.clear()
+    def flushRun() -> None:
+        nonlocal run
+        if run:
+            ops.append(COPY.pack(b"C", run[0], run[1]))
+            run = None
+    pos = 0
+    weak = None
+    while pos + blockSize <= n:
+        if weak is None:
+            weak = zlib.adler32(view[pos: pos + blockSize])
+        match = None
+        candidates = table.get(weak)
+        if candidates:
+            sig = strong(view[pos: pos + blockSize])
+            want = run[0] + run[1] if run else None # prefer continuing the current run
+            for s, idx in candidates:
+                if s == sig:
+                    match = idx
+                    if idx == want:
+                        break
+        if match is not None:
+            matched = True
+            flushLiteral()
+            if run and match == run[0] + run[1]:
+                run[1] += 1
+            else:
+                flushRun()
+                run = [match, 1]
+            pos += blockSize
+            weak = None
+            continue
+        # no match: emit one byte and roll the adler32 window forward
+        if (not matched and pos >= probe) or 0 <= maxLiteral < literalBytes + len(literal):
+            return None
+        flushRun()
+        out = view[pos]
+        literal.append(out)
+        if len(literal) >= MAX_LITERAL:
+            flushLiteral()
+        if pos + blockSize < n:
+            a = weak & 0xFFFF
+            b = weak >> 16
+            new = view[pos + blockSize]
+            a = (a - out + new) % MOD
+            b = (b - blockSize * out + a - 1) % MOD
+            weak = (b << 16) | a
+        else:
+            weak = None
+        pos += 1
+    flushRun()
+    literal += view[pos:]
+    flushLiteral()
+    ops.append(END)
+    return b"".join(ops), literalBytes
+
+class Patcher: # receiver side: delta stream in, rebuilt file bytes out
+    def __init__(self, basis, blockSize: int) -> None:
+        self.basis = memoryview(basis)
+        self.blockSize = blockSize
+        self.pending = bytearray()
+        self.done = False
+
+    def __call__(self, data: bytes) -> bytes:
+        self.pending += data
+        out = []
+        pos = 0
+        while pos < len(self.pending) and not self.done:
+            op = self.pending[pos: pos + 1]
+            if op == b"C":
+                if len(self.pending) - pos < COPY.size:
+                    break
+                _, first, count = COPY.unpack_from(self.pending, pos)
+                start = first * self.blockSize
+                end = start + count * self.blockSize
+                if end > len(self.basis):
+                    raise ValueError(f"delta copies blocks {first}+{count} past the basis")
+                out.append(self.basis[start: end])
+                pos += COPY.size
+            elif op == b"L":
+                if len(self.pending) - pos < LITERAL.size:
+                    break
+                _, size = LITERAL.unpack_from(self.pending, pos)
+                if len(self.pending) - pos < LITERAL.size + size:
+                    break
+                out.append(self.pending[pos + LITERAL.size: pos + LITERAL.size + size])
+                pos += LITERAL.size + size
+            elif op == END:
+                self.done = True
+                pos += 1
+            else:
+                raise ValueError(f"bad delta op {bytes(op)!r}")
+        result = b"".join(out)
+        del self.pending[: pos]
+        return result
+
+    def finish(self) -> None:
+        if not self.done or self.pending:
+            raise ValueError("delta stream ended early")
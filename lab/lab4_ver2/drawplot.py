@@ -1,35 +1,122 @@
 import os
+import json
+import hashlib
+import argparse
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+from tracer import FIELDS, readTrace
+
 CSV_PATH = "metric.csv"
 OUT_DIR = "figs"
+MANIFEST = ".drawplot.json" # 图名 -> 输入数据指纹，指纹没变的图不重画
+CACHE_SCHEMA = 2 # 列式缓存的列变了就加一，旧缓存作废
+METRICS = {"goodput_mbps": ("有效吞吐量", "有效吞吐量（Mbps）"), "utilization": ("流量利用率", "流量利用率")}
+# 双侧 95% t 分位数，自由度 1..30；更大的样本用正态近似
+T975 = np.array([np.nan, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160,
+                 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052,
+                 2.048, 2.045, 2.042])
+
+# 实验声明：筛选条件 + 横轴，每组对 METRICS 里的每个指标各出一张图，编号按顺序排
+# name 里的 {metric} 换成 goodput / utilization；--experiments 可以从 json 读入另一份同样格式的列表
+# where 不写 source 时只用真实测量，simulate.py 的模拟结果要显式写 "source": ["sim"]
+EXPERIMENTS = [
+    {"name": "loss_{metric}_gbn_sr_reno", "kind": "模拟", "who": "GBN/SR + Reno", "how": " 在不同丢包率下",
+     "where": {"var": ["loss"], "cc": ["reno"], "arq": ["gbn", "sr"]}, "xlabel": "丢包率（%）"},
+    {"name": "loss_{metric}_sr_reno_vs_vegas", "kind": "模拟", "who": "SR + Reno/Vegas", "how": " 在不同丢包率下",
+     "where": {"var": ["loss"], "arq": ["sr"], "cc": ["reno", "vegas"]}, "xlabel": "丢包率（%）"},
+    {"name": "delay_{metric}_sr_reno_vs_vegas", "kind": "模拟", "who": "SR + Reno/Vegas", "how": " 在不同时延下",
+     "where": {"var": ["delay"], "arq": ["sr"], "cc": ["reno", "vegas"]}, "xlabel": "时延（ms）"},
+    {"name": "size_{metric}_gbn_vs_sr_reno", "kind": "真实", "who": "GBN/SR + Reno", "how": " 随文件大小",
+     "where": {"var": ["size_kb"], "cc": ["reno"], "arq": ["gbn", "sr"]}, "xlabel": "文件大小（KB）"},
+    {"name": "size_{metric}_sr_reno_vs_vegas", "kind": "真实", "who": "SR + Reno/Vegas", "how": " 随文件大小",
+     "where": {"var": ["size_kb"], "arq": ["sr"], "cc": ["reno", "vegas"]}, "xlabel": "文件大小（KB）"},
+]
 
 sns.set(style="whitegrid", context="notebook", font="Arial Unicode MS")
 
 def ensure_outdir():
     os.makedirs(OUT_DIR, exist_ok=True)
 
+def cache_path(csv_path):
+    # 有 pyarrow/fastparquet 就用 Parquet，否则用 pandas 自己的 pickle，两者都是按列存的 numpy 数组
+    try:
+        import pyarrow # noqa: F401
+        return csv_path + ".parquet"
+    except ImportError:
+        pass
+    try:
+        import fastparquet # noqa: F401
+        return csv_path + ".parquet"
+    except ImportError:
+        return csv_path + ".pkl"
+
 def load_data():
+    # 列式缓存跟着 CSV 的 mtime/大小走，CSV 没变就不再解析文本
+    st = os.stat(CSV_PATH)
+    stamp = f"{CACHE_SCHEMA}:{st.st_mtime_ns}:{st.st_size}"
+    path = cache_path(CSV_PATH)
+    if os.path.exists(path):
+        df = pd.read_parquet(path) if path.endswith(".parquet") else pd.read_pickle(path)
+        if df.attrs.get("stamp") == stamp:
+            return df
     df = pd.read_csv(CSV_PATH)
     # 规范数据类型
-    df["val"] = pd.to_numeric(df["val"], errors="coerce")
-    df["goodput_mbps"] = pd.to_numeric(df["goodput_mbps"], errors="coerce")
-    df["utilization"] = pd.to_numeric(df["utilization"], errors="coerce")
+    for col in ("val", "goodput_mbps", "utilization"):
+        df[col] = pd.to_numeric(df[col], errors="coerce")
+    for col in ("arq", "cc", "var"):
+        df[col] = df[col].astype("category")
     # 便于图例：如 "GBN + Reno" / "SR + Vegas"
-    df["label"] = df["arq"].str.upper() + " + " + df["cc"].str.title()
+    df["label"] = (df["arq"].astype(str).str.upper() + " + " + df["cc"].astype(str).str.title()).astype("category")
+    # 数据来源：没有 source 列的旧文件、或加列之前 simulate.py 写的行，按 run_id 的 sim_ 前缀认出模拟结果
+    source = df["source"].fillna("").astype(str) if "source" in df else pd.Series("", index=df.index)
+    if "run_id" in df:
+        source = source.mask(df["run_id"].astype(str).str.startswith("sim_"), "sim")
+    df["source"] = source.astype("category")
+    df.attrs["stamp"] = stamp
+    if path.endswith(".parquet"):
+        df.to_parquet(path)
+    else:
+        df.to_pickle(path)
     return df
 
-def plot_lines(df, x, y, hue, title, xlabel, ylabel, filename, markers=True):
+def select(df, where):
+    # 模拟结果默认不和真实测量一起平均
+    mask = np.ones(len(df), dtype=bool) if "source" in where else (df["source"] != "sim").to_numpy().copy()
+    for col, values in where.items():
+        mask &= df[col].isin(values).to_numpy()
+    return df[mask]
+
+def aggregate(df, x, y, hue):
+    # 每个 (hue, x) 一行：重复次数、均值、标准差、10/50/90 分位数、均值的 95% 置信区间
+    g = df.dropna(subset=[y]).groupby([hue, x], observed=True)[y]
+    out = g.agg(n="count", mean="mean", std="std", median="median").reset_index()
+    q = g.quantile([0.1, 0.9]).unstack()
+    out["p10"] = q[0.1].to_numpy()
+    out["p90"] = q[0.9].to_numpy()
+    n = out["n"].to_numpy()
+    t = np.where(n - 1 < len(T975), T975[np.clip(n - 1, 0, len(T975) - 1)], 1.96)
+    half = t * out["std"].fillna(0).to_numpy() / np.sqrt(n)
+    out["ci_lo"] = out["mean"] - np.nan_to_num(half)
+    out["ci_hi"] = out["mean"] + np.nan_to_num(half)
+    return out.sort_values([hue, x])
+
+def fingerprint(*parts):
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(pd.util.hash_pandas_object(p, index=False).to_numpy().tobytes() if isinstance(p, pd.DataFrame)
+                 else json.dumps(p, sort_keys=True, ensure_ascii=False).encode())
+    return h.hexdigest()
+
+def plot_lines(stats, x, hue, title, xlabel, ylabel, filename):
+    # 均值折线 + 置信区间阴影；只有一次重复的点没有阴影
     plt.figure(figsize=(7.5, 4.5), dpi=140)
-    # 为了稳定的颜色/顺序
-    hue_order = sorted(df[hue].unique())
-    ax = sns.lineplot(
-        data=df.sort_values(by=x),
-        x=x, y=y, hue=hue, hue_order=hue_order,
-        marker="o" if markers else None
-    )
+    ax = plt.gca()
+    for label, part in stats.groupby(hue, observed=True, sort=True):
+        line, = ax.plot(part[x], part["mean"], marker="o", label=f"{label}（n={int(part['n'].max())}）")
+        ax.fill_between(part[x], part["ci_lo"], part["ci_hi"], color=line.get_color(), alpha=0.2, linewidth=0)
     ax.set_title(title)
     ax.set_xlabel(xlabel)
     ax.set_ylabel(ylabel)
@@ -39,96 +126,119 @@ def plot_lines(df, x, y, hue, title, xlabel, ylabel, filename, markers=True):
     plt.savefig(out_path)
     plt.close()
 
+def figures(experiments):
+    # 展开成 (编号, 实验, 指标)，编号和以前手写的 fig1..fig10 一致
+    n = 0
+    for exp in experiments:
+        for metric in exp.get("metrics", list(METRICS)):
+            n += 1
+            yield n, exp, metric
+
+def draw_experiments(df, experiments, manifest, force=False):
+    drawn = skipped = 0
+    aggregated = {} # 同一份筛选数据只聚合一次，吞吐量和利用率两张图共用
+    for n, exp, y in figures(experiments):
+        short = y.split("_")[0]
+        filename = f"fig{n}_" + exp["name"].format(metric=short) + ".png"
+        sub = select(df, exp["where"])
+        key = fingerprint(sub[["label", "val", y]], exp, y)
+        if not force and manifest.get(filename) == key and os.path.exists(os.path.join(OUT_DIR, filename)):
+            skipped += 1
+            continue
+        name, ylabel = METRICS[y]
+        cache_key = (json.dumps(exp["where"], sort_keys=True), y)
+        if cache_key not in aggregated:
+            aggregated[cache_key] = aggregate(sub, "val", y, "label")
+        plot_lines(aggregated[cache_key], x="val", hue="label",
+                   title=f"实验{n}（{exp['kind']}）：{exp['who']}{exp['how']}的{name}",
+                   xlabel=exp["xlabel"], ylabel=ylabel, filename=filename)
+        manifest[filename] = key
+        drawn += 1
+    return drawn, skipped
+
+def plot_trace(path):
+    # 单条流的时间序列：cwnd/ssthresh、平滑 RTT、在途分组数，竖线标出超时
+    meta, rows = readTrace(path)
+    if not rows:
+        print(f"跳过空 trace: {path}")
+        return
+    df = pd.DataFrame(np.array(rows, dtype=float), columns=FIELDS)
+    df["t"] -= df["t"].iloc[0]
+    # ACK 线程可能先于发送循环更新 nextIdx，短暂为负，截到 0
+    df["inflight"] = (df["nextIdx"] - df["base"]).clip(lower=0)
+    timeouts = df["t"][df["timeouts"].diff().fillna(0) > 0]
+    retx = df[df["retransmits"].diff().fillna(0) > 0]
+
+    fig, axes = plt.subplots(3, 1, figsize=(8, 7.5), dpi=140, sharex=True)
+    axes[0].plot(df["t"], df["cwnd"], label="cwnd")
+    if df["ssthresh"].notna().any():
+        axes[0].plot(df["t"], df["ssthresh"], linestyle="--", label="ssthresh")
+    axes[0].scatter(retx["t"], retx["cwnd"], marker="x", color="red", s=12, label="重传")
+    axes[0].set_ylabel("窗口（分组）")
+    axes[0].legend(loc="best")
+    axes[1].plot(df["t"], df["srtt"] * 1000)
+    axes[1].set_ylabel("平滑 RTT（ms）")
+    axes[2].plot(df["t"], df["inflight"])
+    axes[2].set_ylabel("在途分组数")
+    axes[2].set_xlabel("时间（s）")
+    for ax in axes:
+        ax.vlines(timeouts, 0, 1, transform=ax.get_xaxis_transform(), color="gray", alpha=0.3, linewidth=0.8)
+    label = f"{str(meta.get('arq', '?')).upper()} + {str(meta.get('cc', '?')).title()}"
+    fig.suptitle(f"{label}：{os.path.basename(path)}（超时 {int(df['timeouts'].iloc[-1])} 次，重传 {int(df['retransmits'].iloc[-1])} 个）")
+    fig.tight_layout()
+    out_path = os.path.join(OUT_DIR, os.path.splitext(os.path.basename(path))[0] + ".png")
+    fig.savefig(out_path)
+    plt.close(fig)
+
+def draw_traces(paths, manifest, force=False):
+    # trace 文件写完就不再变，按 mtime/大小判断要不要重画
+    drawn = skipped = 0
+    for path in paths:
+        st = os.stat(path)
+        key = f"{st.st_mtime_ns}:{st.st_size}"
+        name = os.path.splitext(os.path.basename(path))[0] + ".png"
+        if not force and manifest.get(name) == key and os.path.exists(os.path.join(OUT_DIR, name)):
+            skipped += 1
+            continue
+        plot_trace(path)
+        manifest[name] = key
+        drawn += 1
+    return drawn, skipped
+
+def load_manifest():
+    path = os.path.join(OUT_DIR, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+def save_manifest(manifest):
+    with open(os.path.join(OUT_DIR, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1, ensure_ascii=False)
+
 def main():
+    global CSV_PATH, OUT_DIR
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--csv", default=CSV_PATH, help="结果文件，bench.py 追加的数据也在这里")
+    parser.add_argument("--out", default=OUT_DIR)
+    parser.add_argument("--trace", nargs="+", default=None, help="只画这些 trace 文件（client --trace / server --traceDir / simulate --trace）")
+    parser.add_argument("--experiments", default=None, help="实验声明的 json 文件，格式同 EXPERIMENTS，默认用内置的 10 张图")
+    parser.add_argument("--force", action="store_true", help="数据没变的图也重画")
+    args = parser.parse_args()
+    CSV_PATH, OUT_DIR = args.csv, args.out
+
     ensure_outdir()
-    df = load_data()
-
-    # 实验 1：模拟 | GBN/SR + Reno | 丢包率 -> 有效吞吐量
-    exp1 = df[(df["var"] == "loss") & (df["cc"] == "reno") & (df["arq"].isin(["gbn", "sr"]))]
-    plot_lines(
-        exp1, x="val", y="goodput_mbps", hue="label",
-        title="实验1（模拟）：GBN/SR + Reno 在不同丢包率下的有效吞吐量",
-        xlabel="丢包率（%）", ylabel="有效吞吐量（Mbps）",
-        filename="fig1_loss_goodput_gbn_sr_reno.png"
-    )
-
-    # 实验 2：模拟 | GBN/SR + Reno | 丢包率 -> 流量利用率
-    plot_lines(
-        exp1, x="val", y="utilization", hue="label",
-        title="实验2（模拟）：GBN/SR + Reno 在不同丢包率下的流量利用率",
-        xlabel="丢包率（%）", ylabel="流量利用率",
-        filename="fig2_loss_utilization_gbn_sr_reno.png"
-    )
-
-    # 实验 3：模拟 | SR + (Reno/Vegas) | 丢包率 -> 有效吞吐量
-    exp3 = df[(df["var"] == "loss") & (df["arq"] == "sr") & (df["cc"].isin(["reno", "vegas"]))]
-    plot_lines(
-        exp3, x="val", y="goodput_mbps", hue="label",
-        title="实验3（模拟）：SR + Reno/Vegas 在不同丢包率下的有效吞吐量",
-        xlabel="丢包率（%）", ylabel="有效吞吐量（Mbps）",
-        filename="fig3_loss_goodput_sr_reno_vs_vegas.png"
-    )
-
-    # 实验 4：模拟 | SR + (Reno/Vegas) | 丢包率 -> 流量利用率
-    plot_lines(
-        exp3, x="val", y="utilization", hue="label",
-        title="实验4（模拟）：SR + Reno/Vegas 在不同丢包率下的流量利用率",
-        xlabel="丢包率（%）", ylabel="流量利用率",
-        filename="fig4_loss_utilization_sr_reno_vs_vegas.png"
-    )
-
-    # 实验 5：模拟 | SR + (Reno/Vegas) | 延迟 -> 有效吞吐量
-    exp5 = df[(df["var"] == "delay") & (df["arq"] == "sr") & (df["cc"].isin(["reno", "vegas"]))]
-    plot_lines(
-        exp5, x="val", y="goodput_mbps", hue="label",
-        title="实验5（模拟）：SR + Reno/Vegas 在不同时延下的有效吞吐量",
-        xlabel="时延（ms）", ylabel="有效吞吐量（Mbps）",
-        filename="fig5_delay_goodput_sr_reno_vs_vegas.png"
-    )
-
-    # 实验 6：模拟 | SR + (Reno/Vegas) | 延迟 -> 流量利用率
-    plot_lines(
-        exp5, x="val", y="utilization", hue="label",
-        title="实验6（模拟）：SR + Reno/Vegas 在不同时延下的流量利用率",
-        xlabel="时延（ms）", ylabel="流量利用率",
-        filename="fig6_delay_utilization_sr_reno_vs_vegas.png"
-    )
-
-    # 实验 7：真实 | GBN/SR + Reno | 上传文件大小 -> 有效吞吐量
-    exp7 = df[(df["var"] == "size_kb") & (df["cc"] == "reno") & (df["arq"].isin(["gbn", "sr"]))]
-    plot_lines(
-        exp7, x="val", y="goodput_mbps", hue="label",
-        title="实验7（真实）：GBN/SR + Reno 随文件大小的有效吞吐量",
-        xlabel="文件大小（KB）", ylabel="有效吞吐量（Mbps）",
-        filename="fig7_size_goodput_gbn_vs_sr_reno.png"
-    )
-
-    # 实验 8：真实 | GBN/SR + Reno | 上传文件大小 -> 流量利用率
-    plot_lines(
-        exp7, x="val", y="utilization", hue="label",
-        title="实验8（真实）：GBN/SR + Reno 随文件大小的流量利用率",
-        xlabel="文件大小（KB）", ylabel="流量利用率",
-        filename="fig8_size_utilization_gbn_vs_sr_reno.png"
-    )
-
-    # 实验 9：真实 | SR + (Reno/Vegas) | 文件大小 -> 有效吞吐量
-    exp9 = df[(df["var"] == "size_kb") & (df["arq"] == "sr") & (df["cc"].isin(["reno", "vegas"]))]
-    plot_lines(
-        exp9, x="val", y="goodput_mbps", hue="label",
-        title="实验9（真实）：SR + Reno/Vegas 随文件大小的有效吞吐量",
-        xlabel="文件大小（KB）", ylabel="有效吞吐量（Mbps）",
-        filename="fig9_size_goodput_sr_reno_vs_vegas.png"
-    )
-
-    # 实验 10：真实 | SR + (Reno/Vegas) | 文件大小 -> 流量利用率
-    plot_lines(
-        exp9, x="val", y="utilization", hue="label",
-        title="实验10（真实）：SR + Reno/Vegas 随文件大小的流量利用率",
-        xlabel="文件大小（KB）", ylabel="流量利用率",
-        filename="fig10_size_utilization_sr_reno_vs_vegas.png"
-    )
-
-    print(f"图像已输出到: {os.path.abspath(OUT_DIR)}")
+    manifest = load_manifest()
+    if args.trace:
+        drawn, skipped = draw_traces(args.trace, manifest, args.force)
+    else:
+        experiments = EXPERIMENTS
+        if args.experiments:
+            with open(args.experiments, encoding="utf-8") as f:
+                experiments = json.load(f)
+        drawn, skipped = draw_experiments(load_data(), experiments, manifest, args.force)
+    save_manifest(manifest)
+    print(f"重画 {drawn} 张，{skipped} 张数据未变跳过，图像已输出到: {os.path.abspath(OUT_DIR)}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,241 @@
+import socket
+import selectors
+import heapq
+import random
+import time
+import json
+import argparse
+import signal
+
+# impairment name -> (default, help); every one can be set for both directions or per direction
+IMPAIRMENTS = {
+    "loss": (0.0, "packet loss %"),
+    "delay": (0.0, "one way delay ms"),
+    "jitter": (0.0, "delay jitter ms, uniform in [-jitter, +jitter]"),
+    "dup": (0.0, "duplication %"),
+    "reorder": (0.0, "% of packets sent without delay, overtaking delayed ones (netem style)"),
+    "rate": (0.0, "bandwidth Mbps, 0 = unlimited"),
+    "burst": (16.0, "token bucket depth KB"),
+    "queueKB": (256.0, "bottleneck queue KB before tail drop"),
+}
+
+class LinkProfile: # impairments of one direction, decisions drawn from a seeded rng
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0, dup=0.0, reorder=0.0, rate=0.0, burst=16.0, queueKB=256.0, seed=None) -> None:
+        self.loss = loss
+        self.delay = delay / 1000.0
+        self.jitter = jitter / 1000.0
+        self.dup = dup
+        self.reorder = reorder
+        self.rate = rate * 1e6 / 8 # bytes per second
+        self.burst = burst * 1024
+        self.queueBytes = queueKB * 1024
+        self.rng = random.Random(seed)
+        self.tokens = self.burst
+        self.tokenTime = 0.0
+        self.lastDepart = 0.0
+        self.passed = 0
+        self.lost = 0
+        self.queueDrops = 0
+        self.duplicated = 0
+        self.reordered = 0
+
+    def schedule(self, now: float, size: int) -> list:
+        # delivery times for one packet, [] if it is dropped
+        if self.loss > 0 and self.rng.random() * 100 < self.loss:
+            self.lost += 1
+            return []
+        depart = now
+        if self.rate > 0: # token bucket in front of a FIFO bottleneck queue
+            t = max(now, self.lastDepart)
+            if (t - now) * self.rate > self.queueBytes:
+                self.queueDrops += 1
+                return []
+            tokens = min(self.burst, self.tokens + (t - self.tokenTime) * self.rate)
+            if tokens < size:
+                t += (size - tokens) / self.rate
+                tokens = size
+            self.tokens = tokens - size
+            self.tokenTime = t
+            self.lastDepart = t
+            depart = t
+        delay = self.delay
+        if self.jitter > 0:
+            delay = max(0.0, delay + self.rng.uniform(-self.jitter, self.jitter))
+        if self.reorder > 0 and self.rng.random() * 100 < self.reorder:
+            delay = 0.0
+            self.reordered += 1
+        times = [depart + delay]
+        if self.dup > 0 and self.rng.random() * 100 < self.dup:
+            times.append(depart + delay)
+            self.duplicated += 1
+        self.passed += 1
+        return times
+
+    def summary(self) -> str:
+        return f"passed={self.passed},lost={self.lost},queue_drops={self.queueDrops},dup={self.duplicated},reordered={self.reordered}"
+
+class Relay: # one front port forwarding every client behind it to one server address
+    def __init__(self, front: socket.socket, target, control: bool) -> None:
+        self.front = front
+        self.target = target
+        self.control = control # control relays rewrite dataPort replies
+        self.backs: dict = {} # client addr -> socket facing the server
+        self.lastActive = time.time()
+
+class Emulator:
+    def __init__(self, host: str, port: int, serverHost: str, serverPort: int, up: LinkProfile, down: LinkProfile,
+                 impairControl: bool = False, idleTimeout: float = 60.0) -> None:
+        self.host = host
+        self.serverHost = serverHost
+        self.up = up # client -> server
+        self.down = down # server -> client
+        self.clean = LinkProfile()
+        self.impairControl = impairControl
+        self.idleTimeout = idleTimeout
+        self.selector = selectors.DefaultSelector()
+        self.pending: list = [] # heap of (deliverAt, order, socket, payload, addr)
+        self.order = 0
+        self.relays: list = []
+        self.running = False
+        self.control = self.addRelay(port, (serverHost, serverPort), True)
+        self.port = self.control.front.getsockname()[1]
+
+    def addRelay(self, port: int, target, control: bool) -> Relay:
+        front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        front.bind((self.host, port))
+        front.setblocking(False)
+        relay = Relay(front, target, control)
+        self.selector.register(front, selectors.EVENT_READ, (relay, None))
+        self.relays.append(relay)
+        return relay
+
+    def closeRelay(self, relay: Relay) -> None:
+        for back in relay.backs.values():
+            self.selector.unregister(back)
+            back.close()
+        self.selector.unregister(relay.front)
+        relay.front.close()
+        self.relays.remove(relay)
+
+    def rewrite(self, data: bytes) -> bytes:
+        # point the client at a new relay in front of the server's data port
+        try:
+            resp = json.loads(data.decode())
+        except Exception:
+            return data
+        if not isinstance(resp, dict) or resp.get("dataPort") is None:
+            return data
+        relay = self.addRelay(0, (self.serverHost, int(resp["dataPort"])), False)
+        resp["dataPort"] = relay.front.getsockname()[1]
+        return json.dumps(resp).encode()
+
+    def forward(self, now: float, link: LinkProfile, sock: socket.socket, data: bytes, addr) -> None:
+        for t in link.schedule(now, len(data)):
+            heapq.heappush(self.pending, (t, self.order, sock, data, addr))
+            self.order += 1
+
+    def onReadable(self, sock: socket.socket, relay: Relay, client) -> None:
+        now = time.time()
+        relay.lastActive = now
+        while True:
+            try:
+                data, addr = sock.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            if client is None: # from a client, towards the server
+                back = relay.backs.get(addr)
+                if back is None:
+                    back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    back.bind((self.host, 0))
+                    back.setblocking(False)
+                    relay.backs[addr] = back
+                    self.selector.register(back, selectors.EVENT_READ, (relay, addr))
+                link = self.up if (not relay.control or self.impairControl) else self.clean
+                self.forward(now, link, back, data, relay.target)
+            else: # from the server, back to the client
+                if relay.control:
+                    data = self.rewrite(data)
+                link = self.down if (not relay.control or self.impairControl) else self.clean
+                self.forward(now, link, relay.front, data, client)
+
+    def deliver(self, now: float) -> None:
+        while self.pending and self.pending[0][0] <= now:
+            _, _, sock, data, addr = heapq.heappop(self.pending)
+            try:
+                sock.sendto(data, addr)
+            except OSError: # socket closed by idle cleanup or kernel buffer full
+                pass
+
+    def reap(self, now: float) -> None:
+        for relay in list(self.relays):
+            if not relay.control and now - relay.lastActive > self.idleTimeout:
+                self.closeRelay(relay)
+
+    def serve(self) -> None:
+        self.running = True
+        lastReap = time.time()
+        while self.running:
+            now = time.time()
+            timeout = 0.5
+            if self.pending:
+                timeout = min(timeout, max(0.0, self.pending[0][0] - now))
+            for key, _ in self.selector.select(timeout):
+                relay, client = key.data
+                self.onReadable(key.fileobj, relay, client)
+            now = time.time()
+            self.deliver(now)
+            if now - lastReap > 1.0:
+                self.reap(now)
+                lastReap = now
+
+    def stop(self) -> None:
+        self.running = False
+
+    def close(self) -> None:
+        for relay in list(self.relays):
+            self.closeRelay(relay)
+        self.selector.close()
+
+def profiles(args) -> tuple:
+    def pick(direction: str) -> dict:
+        opts = {}
+        for name in IMPAIRMENTS:
+            value = getattr(args, direction + name[0].upper() + name[1:])
+            opts[name] = getattr(args, name) if value is None else value
+        return opts
+    up = LinkProfile(**pick("up"), seed=args.seed)
+    down = LinkProfile(**pick("down"), seed=None if args.seed is None else args.seed + 1)
+    return up, down
+
+def main():
+    parser = argparse.ArgumentParser(description="UDP relay that emulates a lossy link between client.py and server.py")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address the relay binds to")
+    parser.add_argument("--listen", type=int, default=10001, help="port clients use instead of the server port")
+    parser.add_argument("--server", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=None, help="seed the loss/jitter decisions for reproducible runs")
+    parser.add_argument("--impairControl", action="store_true", help="also impair the JSON control channel")
+    for name, (default, text) in IMPAIRMENTS.items():
+        upper = name[0].upper() + name[1:]
+        parser.add_argument(f"--{name}", type=float, default=default, help=f"{text}, both directions".replace("%", "%%"))
+        parser.add_argument(f"--up{upper}", type=float, default=None, help="client -> server override")
+        parser.add_argument(f"--down{upper}", type=float, default=None, help="server -> client override")
+    args = parser.parse_args()
+
+    up, down = profiles(args)
+    emu = Emulator(args.host, args.listen, args.server, args.port, up, down, args.impairControl)
+    signal.signal(signal.SIGTERM, lambda signum, frame: emu.stop())
+    print(f"emulator: {args.host}:{emu.port} -> {args.server}:{args.port}")
+    try:
+        emu.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emu.close()
+        print(f"emulator: up {up.summary()}")
+        print(f"emulator: down {down.summary()}")
+
+if __name__ == "__main__":
+    main()
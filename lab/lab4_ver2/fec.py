@@ -0,0 +1,112 @@
+import struct
+
+try:
+    import numpy as np
+except ImportError: # the big int XOR below is the fallback
+    np = None
+
+FEC = 1 << 2 # flag of a parity packet: seq = first data seq of the block, ack = block length K
+MIN_K = 4
+MAX_K = 32
+KEEP = 2 * MAX_K # receivers hold payloads this far behind expect for rebuilding
+
+def xorPayloads(payloads) -> bytes:
+    # XOR of the payloads, shorter ones zero padded at the end
+    size = max(len(p) for p in payloads)
+    if np is not None:
+        acc = np.zeros(size, dtype=np.uint8)
+        for p in payloads:
+            acc[: len(p)] ^= np.frombuffer(p, dtype=np.uint8)
+        return acc.tobytes()
+    acc = 0
+    for p in payloads:
+        acc ^= int.from_bytes(p, "little")
+    return acc.to_bytes(size, "little")
+
+def parity(payloads) -> bytes:
+    lengths = 0
+    for p in payloads:
+        lengths ^= len(p)
+    return struct.pack("<I", lengths) + xorPayloads(payloads)
+
+def rebuild(par: bytes, others) -> bytes:
+    # the one payload of the block missing from others
+    (length,) = struct.unpack_from("<I", par)
+    for p in others:
+        length ^= len(p)
+    return xorPayloads([par[4:], *others])[: length]
+
+def pickK(lossRate: float) -> int:
+    # keep the expected losses per block around 1/4, one parity only repairs one
+    return max(MIN_K, min(MAX_K, int(0.25 / max(lossRate, 1e-3))))
+
+def ackPayload(dec) -> bytes:
+    # receivers report how many packets parity repaired so the sender sees the real loss rate
+    return b"" if dec is None else str(dec.recovered).encode()
+
+class fecEncoder: # sender side, one parity packet after every K first transmissions
+    def __init__(self, k: int = 8) -> None:
+        self.k = max(MIN_K, min(MAX_K, k))
+        self.start = 0 # first seq of the open block
+        self.parities = 0
+
+    def onSend(self, idx: int, chunks: list):
+        # (start, k, parity payload) once idx closes a block, else None
+        end = idx + 1
+        if end - self.start < self.k and end != len(chunks):
+            return None
+        start = self.start
+        self.start = end
+        self.parities += 1
+        return start, end - start, parity(chunks[start: end])
+
+    def adapt(self, lossRate: float) -> None:
+        self.k = pickK(lossRate)
+
+class fecDecoder: # receiver side, rebuilds a single loss per block from its parity
+    def __init__(self) -> None:
+        self.payloads: dict = {} # seq -> payload, recent data kept for rebuilding
+        self.parity: dict = {} # block start -> (k, parity payload) still waiting for data
+        self.recovered = 0
+
+    def onData(self, seq: int, payload: bytes) -> list:
+        self.payloads[seq] = payload
+        out = []
+        for start in [s for s, (k, _) in self.parity.items() if s <= seq < s + k]:
+            got = self.tryBlock(start)
+            if got:
+                out.append(got)
+        return out
+
+    def onParity(self, start: int, k: int, par: bytes, expect: int) -> list:
+        self.prune(expect)
+        if start + k <= expect:
+            return []
+        self.parity[start] = (k, par)
+        got = self.tryBlock(start)
+        return [got] if got else []
+
+    def tryBlock(self, start: int):
+        k, par = self.parity[start]
+        missing = [s for s in range(start, start + k) if s not in self.payloads]
+        if len(missing) > 1:
+            return None
+        del self.parity[start]
+        if not missing:
+            return None
+        seq = missing[0]
+        payload = rebuild(par, [self.payloads[s] for s in range(start, start + k) if s != seq])
+        self.payloads[seq] = payload
+        self.recovered += 1
+        return seq, payload
+
+    def prune(self, expect: int) -> None:
+        for s in [s for s in self.payloads if s < expect - KEEP]:
+            del self.payloads[s]
+        for s in [s for s, (k, _) in self.parity.items() if s + k <= expect]:
+            del self.parity[s]
+
+def replay(rx, rebuilt: list, ts: float, *args) -> None:
+    # feed rebuilt packets back through rx.onPacket, the receiver buffers past any gap itself
+    for seq, payload in rebuilt:
+        rx.onPacket(rx.encode(seq, 0, 0, payload, ts), *args)
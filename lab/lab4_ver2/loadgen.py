@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+from bench import HERE, freePort, startServer, startEmulator, stopEmulator
+
+PROMPT = b"cmd> "
+SETTLE = 1.0 # seconds for server threads to leave TIME_WAIT before their totals are read
+# op outcome -> substring of the client's output that decides it, checked in this order
+OUTCOMES = (
+    ("ok", "client: successfully"),
+    ("corrupt", "MD5 mismatch"),
+    ("busy", "server busy, retry after"),
+)
+
+def sizeSampler(spec: str, maxKB: int):
+    # "fixed:KB", "uniform:lo:hi", "lognormal:mu:sigma" (of ln KB), "pareto:alpha:minKB", "choice:a,b,c"
+    # -> rng -> size in KB, clamped to [1, maxKB]
+    kind, _, rest = spec.partition(":")
+    vals = [float(v) for v in rest.replace(",", ":").split(":") if v]
+    draw = {
+        "fixed": lambda rng: vals[0],
+        "uniform": lambda rng: rng.uniform(vals[0], vals[1]),
+        "lognormal": lambda rng: rng.lognormvariate(vals[0], vals[1]),
+        "pareto": lambda rng: vals[1] * rng.paretovariate(vals[0]),
+        "choice": lambda rng: rng.choice(vals),
+    }.get(kind)
+    if draw is None:
+        raise ValueError(f"unknown size distribution {spec!r}")
+    return lambda rng: max(1, min(maxKB, int(round(draw(rng)))))
+
+def parseMix(spec: str) -> list:
+    # "upload=3,download=1" -> [(op, cumulative weight), ...]
+    out, total = [], 0.0
+    for part in spec.split(","):
+        op, _, w = part.partition("=")
+        if op not in ("upload", "download"):
+            raise ValueError(f"unknown op {op!r} in mix")
+        total += float(w or 1)
+        out.append((op, total))
+    return [(op, w / total) for op, w in out]
+
+def makeFile(workDir: str, sizeKB: int) -> str:
+    # one random file per size, shared by every op that drew it
+    path = os.path.join(workDir, "files", f"load_{sizeKB}KB.dat")
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(random.Random(sizeKB).randbytes(sizeKB * 1024))
+    return path
+
+def plan(args, workDir: str) -> tuple:
+    # (pool uploads, per-session op lists), drawn up front from the seed so runs repeat exactly
+    rng = random.Random(args.seed)
+    sample = sizeSampler(args.sizes, args.maxSizeKB)
+    mix = parseMix(args.mix)
+    pool = [(makeFile(workDir, sample(rng)), f"pool_{i}.dat") for i in range(args.pool)]
+    sessions = []
+    for s in range(args.sessions):
+        ops = []
+        for n in range(args.ops):
+            r = rng.random()
+            op = next(op for op, w in mix if r <= w)
+            if op == "upload":
+                local = makeFile(workDir, sample(rng))
+                ops.append(("upload", local, f"load_{s}_{n}.dat", os.path.getsize(local)))
+            else:
+                local, remote = rng.choice(pool)
+                ops.append(("download", os.path.join(workDir, "out", f"s{s}.dat"), remote, os.path.getsize(local)))
+        sessions.append(ops)
+    return pool, sessions
+
+def classify(text: str) -> str:
+    for outcome, marker in OUTCOMES:
+        if marker in text:
+            return outcome
+    return "failed"
+
+def serverStats(host: str, port: int):
+    # the server's own stats reply on the control port (cpu, completed/failed totals), None if it's silent
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(2.0)
+    try:
+        sock.sendto(json.dumps({"cmd": "stats"}).encode(), (host, port))
+        data, _ = sock.recvfrom(65536)
+        return json.loads(data.decode())
+    except (OSError, ValueError):
+        return None
+    finally:
+        sock.close()
+
+async def readPrompt(proc) -> str:
+    # client output up to its next "cmd> " prompt
+    buf = b""
+    while not buf.endswith(PROMPT):
+        chunk = await proc.stdout.read(4096)
+        if not chunk:
+            break
+        buf += chunk
+    return buf.decode(errors="replace")
+
+async def runSession(sid: int, ops: list, clientArgs: list, args, results: list, startAt: float) -> None:
+    # one client.py process driven through its cmd> loop; every op is timed from its command line
+    # to the next prompt, so process startup stays out of the latencies
+    rng = random.Random(args.seed * 1000003 + sid)
+    await asyncio.sleep(max(0.0, startAt - time.time()))
+    proc = await asyncio.create_subprocess_exec(sys.executable, "-u", os.path.join(HERE, "client.py"), *clientArgs,
+                                                "stats", stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.STDOUT)
+    try:
+        await asyncio.wait_for(readPrompt(proc), args.opTimeout)
+        for op, local, remote, size in ops:
+            if args.think > 0:
+                await asyncio.sleep(rng.expovariate(1.0 / args.think))
+            t0 = time.time()
+            proc.stdin.write(f"{op} {local} {remote}\n".encode())
+            await proc.stdin.drain()
+            try:
+                out = await asyncio.wait_for(readPrompt(proc), args.opTimeout)
+                outcome = classify(out) if out.endswith(PROMPT.decode()) else "failed"
+            except asyncio.TimeoutError:
+                outcome = "timeout"
+            results.append({"session": sid, "op": op, "bytes": size, "outcome": outcome, "start": t0, "seconds": time.time() - t0})
+            if outcome == "timeout" or proc.returncode is not None: # stuck mid transfer or gone
+                break
+        if proc.returncode is None:
+            proc.stdin.write(b"#quit\n")
+            await proc.stdin.drain()
+            await asyncio.wait_for(proc.wait(), 5.0)
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def report(results: list, wall: float, before, after, args) -> dict:
+    out = {"sessions": args.sessions, "ops": len(results), "wall_s": round(wall, 3), "by_op": {}}
+    for op in ("all", "upload", "download"):
+        rows = [r for r in results if op == "all" or r["op"] == op]
+        if not rows:
+            continue
+        ok = [r for r in rows if r["outcome"] == "ok"]
+        lat = [r["seconds"] for r in ok]
+        moved = sum(r["bytes"] for r in ok)
+        entry = {"ops": len(rows), "ok": len(ok), "throughput_mbps": round(moved * 8 / max(wall, 1e-9) / 1e6, 3),
+                 "p50_s": round(percentile(lat, 0.50), 3), "p90_s": round(percentile(lat, 0.90), 3),
+                 "p99_s": round(percentile(lat, 0.99), 3), "max_s": round(max(lat), 3) if lat else float("nan")}
+        for outcome in ("failed", "timeout", "busy", "corrupt"):
+            entry[f"{outcome}_rate"] = round(sum(r["outcome"] == outcome for r in rows) / len(rows), 4)
+        out["by_op"][op] = entry
+    if before and after:
+        cpu = (after["cpu_user_s"] + after["cpu_system_s"]) - (before["cpu_user_s"] + before["cpu_system_s"])
+        out["server"] = {"cpu_s": round(cpu, 3), "cpu_cores": round(cpu / max(wall, 1e-9), 3),
+                         "completed": after["completed"] - before["completed"], "failed": after["failed"] - before["failed"],
+                         "rejected": after["rejected"] - before["rejected"], "threads": after["threads"]}
+    return out
+
+def printReport(summary: dict) -> None:
+    print(f"loadgen: {summary['sessions']} sessions, {summary['ops']} ops in {summary['wall_s']}s")
+    print(f"{'op':<10}{'ops':>6}{'ok':>6}{'Mbps':>10}{'p50_s':>8}{'p90_s':>8}{'p99_s':>8}{'max_s':>8}"
+          f"{'fail%':>7}{'tmo%':>6}{'busy%':>7}{'bad%':>6}")
+    for op, e in summary["by_op"].items():
+        print(f"{op:<10}{e['ops']:>6}{e['ok']:>6}{e['throughput_mbps']:>10.3f}{e['p50_s']:>8.3f}{e['p90_s']:>8.3f}"
+              f"{e['p99_s']:>8.3f}{e['max_s']:>8.3f}{100 * e['failed_rate']:>7.1f}{100 * e['timeout_rate']:>6.1f}"
+              f"{100 * e['busy_rate']:>7.1f}{100 * e['corrupt_rate']:>6.1f}")
+    srv = summary.get("server")
+    if srv:
+        print(f"server: cpu {srv['cpu_s']}s ({srv['cpu_cores']} cores), {srv['completed']} completed, "
+              f"{srv['failed']} failed, {srv['rejected']} rejected, {srv['threads']} threads")
+    else:
+        print("server: no stats reply")
+
+async def drive(sessions: list, clientArgs: list, args) -> list:
+    results: list = []
+    t0 = time.time()
+    await asyncio.gather(*(runSession(i, ops, clientArgs, args, results, t0 + args.rampUp * i / max(1, len(sessions)))
+                           for i, ops in enumerate(sessions)))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="many concurrent client.py sessions with a mixed upload/download workload",
+                                     allow_abbrev=False) # unknown options pass through to client.py untouched
+    parser.add_argument("--server", type=str, default=None, help="host:port of a running server, default = start one here")
+    parser.add_argument("--serverArgs", type=str, default="--maxActive 256 --maxPerClient 256",
+                        help="extra server.py arguments when loadgen starts the server")
+    parser.add_argument("--sessions", type=int, default=50, help="concurrent client processes")
+    parser.add_argument("--ops", type=int, default=4, help="transfers per session")
+    parser.add_argument("--mix", type=str, default="upload=1,download=1", help="relative op weights")
+    parser.add_argument("--sizes", type=str, default="lognormal:4.6:1.0",
+                        help="file size KB: fixed:KB, uniform:lo:hi, lognormal:mu:sigma, pareto:alpha:minKB, choice:a,b,c")
+    parser.add_argument("--maxSizeKB", type=int, default=8192)
+    parser.add_argument("--pool", type=int, default=8, help="files uploaded first for the downloads to fetch")
+    parser.add_argument("--rampUp", type=float, default=5.0, help="seconds over which the sessions start")
+    parser.add_argument("--think", type=float, default=0.0, help="mean seconds between a session's ops (exponential)")
+    parser.add_argument("--opTimeout", type=float, default=120.0, help="seconds before an op counts as timed out")
+    parser.add_argument("--loss", type=float, default=0.0, help="emulated loss %% between the clients and the server")
+    parser.add_argument("--delay", type=float, default=0.0, help="emulated one way delay ms")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", type=str, default=None, help="also write the summary and every op as json here")
+    args, clientExtra = parser.parse_known_args() # the rest goes to every client.py, e.g. --arq sr --session
+
+    workDir = tempfile.mkdtemp(prefix="loadgen_")
+    os.makedirs(os.path.join(workDir, "files"))
+    os.makedirs(os.path.join(workDir, "out"))
+    server = emu = None
+    try:
+        if args.server:
+            host, _, port = args.server.rpartition(":")
+            port = int(port)
+        else:
+            host, port = "127.0.0.1", freePort()
+            server = startServer(os.path.join(workDir, "storage"), port, args.serverArgs.split())
+        pool, sessions = plan(args, workDir)
+        target = port
+        if args.loss > 0 or args.delay > 0:
+            emu = startEmulator(port, args.loss, args.delay, args.seed, True)
+            target = emu[0].port
+        clientArgs = ["--server", host, "--port", str(target), *clientExtra]
+
+        if pool: # downloads fetch the pool, upload it once through a single session first
+            seed = [[("upload", local, remote, os.path.getsize(local)) for local, remote in pool]]
+            seeded = asyncio.run(drive(seed, clientArgs, argparse.Namespace(**dict(vars(args), rampUp=0.0, think=0.0))))
+            if sum(r["outcome"] == "ok" for r in seeded) < len(pool):
+                print("loadgen: could not upload the download pool, is the server up?")
+                return
+        print(f"loadgen: {len(pool)} pool files, {sum(len(s) for s in sessions)} ops planned over {args.sessions} sessions")
+
+        time.sleep(SETTLE)
+        before = serverStats(host, port)
+        t0 = time.time()
+        results = asyncio.run(drive(sessions, clientArgs, args))
+        wall = time.time() - t0
+        time.sleep(SETTLE)
+        after = serverStats(host, port)
+        summary = report(results, wall, before, after, args)
+        printReport(summary)
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump({"summary": summary, "args": vars(args), "client": clientExtra, "ops": results}, f, indent=1)
+    except KeyboardInterrupt:
+        print("loadgen: interrupted")
+    finally:
+        if emu is not None:
+            stopEmulator(*emu)
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(workDir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import os
+import time
+import socket
+import queue
+import threading
+
+FIN_TIMEOUT = 0.3 # seconds between FIN retransmissions
+FIN_RETRIES = 10 # give up closing after this many unanswered FINs
+TIME_WAIT = 2 * FIN_TIMEOUT # receiver lingers this long after the last FIN
+IDLE_TIMEOUT = 30.0 # receiver aborts if the peer goes silent this long, sender if its window base stops moving
+
+def genPacket(seq: int, flag: int, ack: int, data: bytes, ts: float) -> bytes:
+    dataLen = len(data)
+    header = f"{seq}|{flag}|{ack}|{dataLen}|{ts}\n"
+    return header.encode("utf-8") + data
+
+def getPacket(data: bytes):
+    sep = "\n".encode("utf-8")
+    pacSep = data.find(sep)
+
+    if pacSep == -1:
+        return 0, 0, 0, b"", 0.0
+    header = data[: pacSep].decode("utf-8")
+    payload = data[pacSep + len(sep): ]
+    headerSep: list = header.split("|")
+    if len(headerSep) != 5:
+        return 0, 0, 0, b"", 0
+    seq = int(headerSep[0])
+    flag = int(headerSep[1])
+    ack = int(headerSep[2])
+    payloadLen = int(headerSep[3])
+    ts = float(headerSep[4])
+    
+    return seq, flag, ack, payload[: payloadLen], ts
+
+def finWait(sock: socket.socket, addr, npkt: int, who: str = "ftp") -> bool:
+    # FIN_WAIT: resend FIN until the FIN-ACK (ack | fin) arrives, bounded by FIN_RETRIES
+    for _ in range(FIN_RETRIES):
+        fin = genPacket(npkt, (1 << 1), 0, "".encode("utf-8"), time.time())
+        sock.sendto(fin, addr)
+        deadline = time.time() + FIN_TIMEOUT
+        while True:
+            left = deadline - time.time()
+            if left <= 0:
+                break
+            sock.settimeout(left)
+            try:
+                data, _ = sock.recvfrom(4096)
+            except socket.timeout:
+                break
+            seq, flag, ackNum, payload, ts = getPacket(data)
+            if (flag & (1 << 0)) and (flag & (1 << 1)):
+                return True
+    print(f"{who}: no FIN-ACK after {FIN_RETRIES} FINs, closing anyway")
+    return False
+
+def timeWait(sock: socket.socket, peer, expect: int) -> None:
+    # TIME_WAIT: answer duplicate FINs (our FIN-ACK was lost) until the peer stays quiet
+    finAck = genPacket(0, (1 << 0) | (1 << 1), expect, b"", time.time())
+    sock.sendto(finAck, peer)
+    sock.settimeout(TIME_WAIT)
+    while True:
+        try:
+            data, _ = sock.recvfrom(65536)
+        except (socket.timeout, OSError):
+            break
+        seq, flag, ack, payload, ts = getPacket(data)
+        if flag & (1 << 1):
+            sock.sendto(finAck, peer)
+
+def drain(sock: socket.socket) -> int:
+    # drop datagrams still queued from an earlier transfer on a reused socket, returns how many
+    n = 0
+    sock.setblocking(False)
+    try:
+        while True:
+            sock.recvfrom(65536)
+            n += 1
+    except (BlockingIOError, OSError):
+        pass
+    finally:
+        sock.setblocking(True)
+    return n
+
+def tuneSocket(sock: socket.socket, pktSize: int, maxWin: int, rcvbuf: int = 0, sndbuf: int = 0, busyPoll: int = 0, tos: int = -1, who: str = "ftp") -> None:
+    # 0 = auto: two full windows of packets, so a window burst fits in the kernel queue
+    auto = max(256 * 1024, 2 * maxWin * (pktSize + 64))
+    for opt, size in ((socket.SO_RCVBUF, rcvbuf or auto), (socket.SO_SNDBUF, sndbuf or auto)):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, opt, size) # the kernel clamps to net.core.[rw]mem_max
+        except OSError as e:
+            print(f"{who}: cannot set socket buffer to {size}: {e}")
+    if busyPoll > 0:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, getattr(socket, "SO_BUSY_POLL", 46), busyPoll)
+        except OSError as e:
+            print(f"{who}: cannot set SO_BUSY_POLL: {e}")
+    if tos >= 0:
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, tos)
+        except OSError as e:
+            print(f"{who}: cannot set IP_TOS: {e}")
+
+def udpDrops(sock: socket.socket) -> int:
+    # datagrams the kernel dropped on this socket (full receive buffer), -1 if unknown (non Linux)
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        with open("/proc/net/udp") as f:
+            next(f)
+            for line in f:
+                cols = line.split()
+                if len(cols) > 12 and cols[9] == inode:
+                    return int(cols[12])
+    except (OSError, ValueError, StopIteration):
+        pass
+    return -1
+
+class AsyncWriter: # file writes run on their own thread so disk I/O never delays the ACK path
+    def __init__(self, path: str, sizeHint: int = 0, coalesce: int = 1 << 20, transform=None) -> None:
+        self.f = open(path, "wb")
+        self.transform = transform # e.g. codec.Deframer, maps received stream bytes to file bytes
+        self.queue: queue.Queue = queue.Queue()
+        self.coalesce = coalesce # join queued chunks into writes of up to this many bytes
+        self.written = 0
+        self.error = None
+        self.preallocated = False
+        self.busyNs = 0 # time spent in f.write, reported by --profile
+        self.batches = 0
+        if sizeHint > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.f.fileno(), 0, sizeHint)
+                self.preallocated = True
+            except OSError:
+                pass
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, chunk: bytes) -> None:
+        self.queue.put(chunk)
+
+    def run(self) -> None:
+        stop = False
+        while not stop:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            batch = [chunk]
+            size = len(chunk)
+            while size < self.coalesce:
+                try:
+                    chunk = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if chunk is None:
+                    stop = True
+                    break
+                batch.append(chunk)
+                size += len(chunk)
+            t = time.perf_counter_ns()
+            try:
+                out = b"".join(batch)
+                if self.transform is not None:
+                    out = self.transform(out)
+                self.f.write(out)
+            except Exception as e: # disk errors and corrupt compressed frames alike
+                self.error = e
+                break
+            self.busyNs += time.perf_counter_ns() - t
+            self.batches += 1
+            self.written += len(out)
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is None and self.transform is not None and hasattr(self.transform, "finish"):
+            try:
+                self.transform.finish()
+            except ValueError as e:
+                self.error = e
+        try:
+            if self.preallocated:
+                self.f.truncate(self.written)
+        finally:
+            self.f.close()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,51 @@
+import time
+import threading
+
+TTL = 600.0 # seconds a peer's metrics stay usable, paths drift; client/server --pathTTL default to 0 (off)
+
+class PathCache: # per-peer metrics of the last finished send, seed the next one (like Linux tcp_metrics)
+    def __init__(self, ttl: float = TTL) -> None:
+        self.ttl = ttl # 0 = off, every send starts cold
+        self.entries: dict = {} # peer -> {"at", "srtt", "rttvar", "cwnd", "ssthresh", "minRtt"}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, peer):
+        if self.ttl <= 0:
+            return None
+        with self.lock:
+            entry = self.entries.get(peer)
+            if entry is not None and time.time() - entry["at"] > self.ttl:
+                del self.entries[peer]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(entry)
+
+    def remember(self, peer, flow) -> None:
+        # after a finished send: smoothed rtt, the window it ended with and the controller's state
+        if self.ttl <= 0 or flow.srtt is None:
+            return
+        entry = {"at": time.time(), "srtt": flow.srtt, "rttvar": flow.rttvar, "cwnd": flow.cwnd,
+                 "ssthresh": getattr(flow.cc, "ssthresh", None), "minRtt": getattr(flow.cc, "minRtt", None)}
+        with self.lock:
+            self.entries[peer] = entry
+
+    def seed(self, peer, flow):
+        # start flow from the peer's last metrics instead of cwnd 1 / ssthresh 16, returns the entry used
+        entry = self.lookup(peer)
+        if entry is None:
+            return None
+        flow.warm = entry
+        if entry["ssthresh"] is not None and hasattr(flow.cc, "ssthresh"):
+            flow.cc.ssthresh = max(2.0, entry["ssthresh"])
+        if entry["minRtt"] is not None and hasattr(flow.cc, "minRtt"):
+            flow.cc.minRtt = entry["minRtt"]
+        return entry
+
+    def usage(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
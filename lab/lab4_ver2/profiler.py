@@ -0,0 +1,103 @@
+import time
+import cProfile
+import pstats
+
+# phase -> flow attributes timed under it; only attributes the flow actually has are wrapped
+PHASES = {
+    "encode": ("encode",),
+    "decode": ("decode",),
+    "file_read": ("loadChunks",),
+    "timer_scan": ("checkTimers",),
+}
+CC_CALLBACKS = ("ifACK", "ifTimeout", "ifDupACK")
+LOCKS = ("ackLock", "timerLock")
+
+class profiledSocket: # times sendto/recvfrom, everything else goes to the real socket
+    def __init__(self, sock, prof) -> None:
+        self.sock = sock
+        self.sendto = prof.timed("sendto", sock.sendto)
+        self.recvfrom = prof.timed("recvfrom", sock.recvfrom)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+class timedLock: # counts the time spent waiting to acquire
+    def __init__(self, lock, slot: list) -> None:
+        self.lock = lock
+        self.slot = slot
+
+    def __enter__(self):
+        t = time.perf_counter_ns()
+        self.lock.acquire()
+        self.slot[0] += time.perf_counter_ns() - t
+        self.slot[1] += 1
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.lock.release()
+
+class Profiler: # nanosecond totals per hot-path phase of one or more flows
+    def __init__(self) -> None:
+        self.slots: dict = {} # phase -> [ns, calls]; the ACK thread and send loop add unlocked, totals are approximate
+        self.start = time.perf_counter_ns()
+
+    def timed(self, phase: str, fn):
+        slot = self.slots.setdefault(phase, [0, 0])
+        clock = time.perf_counter_ns
+        def wrapper(*args, **kwargs):
+            t = clock()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                slot[0] += clock() - t
+                slot[1] += 1
+        return wrapper
+
+    def instrument(self, flow) -> None:
+        # wrap the flow's own attributes, other transfers in the process stay untouched; methods
+        # are overridden in a per-flow subclass since senders have __slots__ and no instance dict
+        methods = {}
+        for phase, attrs in PHASES.items():
+            for attr in attrs:
+                if callable(getattr(type(flow), attr, None)):
+                    methods[attr] = self.timed(phase, getattr(type(flow), attr))
+                elif hasattr(flow, attr):
+                    setattr(flow, attr, self.timed(phase, getattr(flow, attr)))
+        if methods:
+            cls = type(flow)
+            flow.__class__ = type(cls.__name__, (cls,), {"__slots__": (), **methods})
+        flow.socket = profiledSocket(flow.socket, self)
+        cc = getattr(flow, "cc", None)
+        if cc is not None:
+            for attr in CC_CALLBACKS:
+                setattr(cc, attr, self.timed("cc", getattr(cc, attr)))
+        for attr in LOCKS:
+            if hasattr(flow, attr):
+                setattr(flow, attr, timedLock(getattr(flow, attr), self.slots.setdefault("lock_wait", [0, 0])))
+
+    def addWriter(self, writer) -> None:
+        # AsyncWriter keeps its own busy time on the writer thread
+        if writer is not None:
+            slot = self.slots.setdefault("file_write", [0, 0])
+            slot[0] += writer.busyNs
+            slot[1] += writer.batches
+
+    def report(self, title: str) -> str:
+        wall = max(1, time.perf_counter_ns() - self.start)
+        lines = [f"PROFILE {title} wall={wall / 1e6:.1f}ms (recvfrom includes blocking wait, file_write runs on its own thread)",
+                 f"{'phase':<12}{'calls':>10}{'total_ms':>12}{'ns/call':>10}{'%wall':>8}"]
+        for phase, (ns, calls) in sorted(self.slots.items(), key=lambda kv: -kv[1][0]):
+            if calls:
+                lines.append(f"{phase:<12}{calls:>10}{ns / 1e6:>12.2f}{ns // calls:>10}{100 * ns / wall:>8.1f}")
+        return "\n".join(lines)
+
+def runProfiled(path: str, fn, *args):
+    # cProfile of one call on the current thread, stats dumped to path, returns fn's result
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(fn, *args)
+    finally:
+        prof.dump_stats(path)
+
+def topFunctions(path: str, n: int = 15) -> None:
+    pstats.Stats(path).sort_stats("tottime").print_stats(n)
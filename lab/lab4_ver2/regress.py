@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+
+from bench import HERE, freePort, makeFile, parseMetric, startEmulator, stopEmulator
+from loadgen import serverStats
+
+# a metric regresses when it moves the wrong way by more than its tolerance:
+# name -> (higher is better, relative tolerance option)
+CHECKS = {
+    "goodput_mbps": (True, "tolerance"),
+    "utilization": (True, "utilTolerance"),
+    "cpu_ns_per_byte": (False, "cpuTolerance"),
+}
+
+def scenarios(args) -> list:
+    # fixed set: every direction x arq x cc x loss, each on a fresh emulated link when loss > 0
+    return [{"op": op, "arq": arq, "cc": cc, "loss": float(loss)}
+            for loss in args.loss.split(",") for op in ("upload", "download")
+            for arq in args.arq.split(",") for cc in args.cc.split(",")]
+
+def key(sc: dict) -> str:
+    return f"{sc['op']}/{sc['arq']}/{sc['cc']}/loss{sc['loss']:g}"
+
+def lastMetric(logPath: str) -> dict:
+    # METRIC line of the server's latest send, downloads are measured on the server side like uploads on the client
+    with open(logPath) as f:
+        return parseMetric(f.read())
+
+def childCpu() -> float:
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ru.ru_utime + ru.ru_stime
+
+def runScenario(sc: dict, rep: int, args, serverPort: int, serverLog: str, workDir: str) -> dict:
+    # one transfer of the scenario, returns its METRIC fields plus client + server cpu per payload byte
+    localPath = makeFile(workDir, args.sizeKB, int(args.sizeKB))
+    remote = f"regress_{sc['arq']}_{sc['cc']}.dat"
+    port, emu = serverPort, None
+    if sc["loss"] > 0:
+        emu = startEmulator(serverPort, sc["loss"], args.delay, args.seed + rep, True)
+        port = emu[0].port
+    cmd = [sys.executable, "-u", os.path.join(HERE, "client.py"), "--server", "127.0.0.1", "--port", str(port),
+           "--arq", sc["arq"], "--cc", sc["cc"], "--pktSize", str(args.pktSize), "--maxWin", str(args.maxWin)]
+    if sc["op"] == "upload":
+        cmd += ["upload", localPath, remote]
+    else:
+        cmd += ["download", os.path.join(workDir, "out.dat"), remote]
+    before = serverStats("127.0.0.1", serverPort)
+    cpu0 = childCpu()
+    try:
+        out = subprocess.run(cmd, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=args.timeout).stdout
+    except subprocess.TimeoutExpired:
+        out = ""
+    finally:
+        if emu is not None:
+            stopEmulator(*emu)
+    clientCpu = childCpu() - cpu0
+    time.sleep(0.8) # the server thread leaves TIME_WAIT before its cpu is read
+    after = serverStats("127.0.0.1", serverPort)
+    metric = parseMetric(out)
+    if sc["op"] == "download":
+        metric = dict(lastMetric(serverLog), ok=metric["ok"])
+    serverCpu = 0.0
+    if before and after:
+        serverCpu = (after["cpu_user_s"] + after["cpu_system_s"]) - (before["cpu_user_s"] + before["cpu_system_s"])
+    metric["cpu_ns_per_byte"] = (clientCpu + serverCpu) * 1e9 / (args.sizeKB * 1024)
+    return metric
+
+def measure(args) -> dict:
+    # scenario key -> best value of each metric over --reps (like timeit, scheduling noise only
+    # ever makes a run worse), or {"ok": 0} when any repetition failed
+    workDir = tempfile.mkdtemp(prefix="regress_")
+    serverPort = freePort()
+    serverLog = os.path.join(workDir, "server.log")
+    log = open(serverLog, "w")
+    server = subprocess.Popen([sys.executable, "-u", os.path.join(HERE, "server.py"), "--port", str(serverPort),
+                               "--storage", os.path.join(workDir, "storage")],
+                              stdout=log, stderr=subprocess.STDOUT)
+    time.sleep(0.5)
+    results = {}
+    try:
+        for sc in scenarios(args):
+            runs = [runScenario(sc, rep, args, serverPort, serverLog, workDir) for rep in range(args.reps)]
+            if not all(r["ok"] and "goodput_mbps" in r for r in runs):
+                results[key(sc)] = {"ok": 0}
+            else:
+                results[key(sc)] = {name: round((max if higher else min)(float(r[name]) for r in runs), 4)
+                                    for name, (higher, _) in CHECKS.items()}
+                results[key(sc)]["ok"] = 1
+            print(f"regress: {key(sc):<28} {results[key(sc)]}")
+    finally:
+        server.terminate()
+        server.wait()
+        log.close()
+        shutil.rmtree(workDir, ignore_errors=True)
+    return results
+
+def compare(base: dict, now: dict, args) -> list:
+    # one row per scenario metric: (scenario, metric, baseline, now, relative change, verdict)
+    rows = []
+    for name, cur in now.items():
+        old = base.get(name)
+        if old is None:
+            rows.append((name, "-", None, None, None, "new"))
+            continue
+        if not cur["ok"] or not old["ok"]:
+            rows.append((name, "ok", old["ok"], cur["ok"], None, "FAIL" if not cur["ok"] else "fixed"))
+            continue
+        for metric, (higher, tolOpt) in CHECKS.items():
+            b, c = old[metric], cur[metric]
+            change = (c - b) / b if b else 0.0
+            worse = -change if higher else change
+            verdict = "REGRESSED" if worse > getattr(args, tolOpt) else ("improved" if worse < -getattr(args, tolOpt) else "ok")
+            rows.append((name, metric, b, c, change, verdict))
+    for name in base.keys() - now.keys():
+        rows.append((name, "-", None, None, None, "missing"))
+    return rows
+
+def printDiff(rows: list, args) -> int:
+    print(f"\n{'scenario':<28}{'metric':<17}{'baseline':>10}{'now':>10}{'change':>9}  verdict")
+    bad = 0
+    for name, metric, b, c, change, verdict in rows:
+        fmt = lambda v: "-" if v is None else f"{v:.4g}"
+        pct = "-" if change is None else f"{100 * change:+.1f}%"
+        print(f"{name:<28}{metric:<17}{fmt(b):>10}{fmt(c):>10}{pct:>9}  {verdict}")
+        bad += verdict in ("REGRESSED", "FAIL")
+    print(f"\nregress: {bad} regressions (tolerance goodput {args.tolerance:.0%}, utilization {args.utilTolerance:.0%}, "
+          f"cpu/byte {args.cpuTolerance:.0%})")
+    return bad
+
+def main():
+    parser = argparse.ArgumentParser(description="run a fixed seeded scenario set and compare it against a stored baseline")
+    parser.add_argument("--baseline", type=str, default=os.path.join(HERE, "baseline.json"))
+    parser.add_argument("--record", action="store_true", help="write the results as the new baseline instead of comparing")
+    parser.add_argument("--arq", type=str, default="gbn,sr")
+    parser.add_argument("--cc", type=str, default="reno,vegas")
+    parser.add_argument("--loss", type=str, default="0", help="comma list, > 0 runs through an emulated lossy link")
+    parser.add_argument("--delay", type=float, default=5.0, help="one way delay ms of the emulated link")
+    parser.add_argument("--sizeKB", type=float, default=2048.0, help="large enough that interpreter startup is not most of the cpu")
+    parser.add_argument("--pktSize", type=int, default=1024)
+    parser.add_argument("--maxWin", type=int, default=64)
+    parser.add_argument("--reps", type=int, default=3, help="repetitions per scenario, the best of them is compared")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--tolerance", type=float, default=0.15, help="relative goodput drop that counts as a regression")
+    parser.add_argument("--utilTolerance", type=float, default=0.02, help="relative utilization drop that counts")
+    parser.add_argument("--cpuTolerance", type=float, default=0.20, help="relative cpu per byte increase that counts")
+    args = parser.parse_args()
+
+    config = {k: getattr(args, k) for k in ("arq", "cc", "loss", "delay", "sizeKB", "pktSize", "maxWin", "reps", "seed")}
+    if not args.record:
+        if not os.path.exists(args.baseline):
+            print(f"regress: no baseline at {args.baseline}, run with --record first")
+            sys.exit(2)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print(f"regress: baseline was recorded with {baseline['config']}, comparing anyway")
+    results = measure(args)
+    if args.record:
+        with open(args.baseline, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "host": platform.node(), "python": platform.python_version(),
+                       "config": config, "scenarios": results}, f, indent=1)
+        print(f"regress: baseline of {len(results)} scenarios written to {args.baseline}")
+        return
+    sys.exit(1 if printDiff(compare(baseline["scenarios"], results, args), args) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+from array import array
+
+# --arq auto thresholds; metric.csv has go-back-N ahead up to ~1% loss and collapsing from 3%
+TO_SR_LOSS = 0.02
+TO_GBN_LOSS = 0.005
+TO_SR_REORDER = 0.05
+EPOCH = 64 # newly acked packets per estimate
+
+class Scoreboard: # per-packet sender state in flat arrays instead of per-packet sets/dicts
+    __slots__ = ("npkt", "mask", "acked", "sentAt", "tries")
+
+    def __init__(self, npkt: int, window: int, selective: bool = True) -> None:
+        size = 1
+        while size < window: # ring slot = seq & mask, the window never spans more than size packets
+            size <<= 1
+        self.npkt = npkt
+        self.mask = size - 1
+        self.acked = bytearray(npkt) if selective else None # one byte per packet, GBN only needs base
+        self.sentAt = array("d", bytes(8 * size)) # last (re)transmission time of each in-flight seq
+        self.tries = array("I", bytes(4 * size)) # transmissions of each in-flight seq
+
+    def send(self, seq: int, now: float) -> None: # first transmission
+        slot = seq & self.mask
+        self.sentAt[slot] = now
+        self.tries[slot] = 1
+
+    def resend(self, seq: int, now: float) -> None:
+        slot = seq & self.mask
+        self.sentAt[slot] = now
+        self.tries[slot] += 1
+
+    def ack(self, seq: int) -> bool:
+        # False when seq was already acked
+        if self.acked[seq]:
+            return False
+        self.acked[seq] = 1
+        return True
+
+    def ackThrough(self, base: int, end: int) -> list:
+        # cumulative ack of everything below end, returns the seqs it newly acked
+        got = self.unacked(base, min(end, self.npkt))
+        for seq in got:
+            self.acked[seq] = 1
+        return got
+
+    def retried(self, seq: int) -> bool:
+        return self.tries[seq & self.mask] > 1
+
+    def advance(self, base: int) -> int:
+        # first unacked seq at or after base
+        idx = self.acked.find(0, base)
+        return self.npkt if idx < 0 else idx
+
+    def unacked(self, base: int, end: int):
+        if self.acked is None:
+            return range(base, end)
+        acked = self.acked
+        return [seq for seq in range(base, end) if not acked[seq]]
+
+    def expired(self, base: int, end: int, now: float, timeout: float) -> list:
+        # unacked seqs in [base, end) whose last transmission is older than timeout
+        sentAt, mask = self.sentAt, self.mask
+        limit = now - timeout
+        return [seq for seq in self.unacked(base, end) if sentAt[seq & mask] < limit]
+
+    def deadline(self, base: int, end: int):
+        # oldest transmission among unacked seqs in [base, end), None if there is none
+        sentAt, mask = self.sentAt, self.mask
+        return min((sentAt[seq & mask] for seq in self.unacked(base, end)), default=None)
+
+    def maxTries(self, base: int, end: int) -> int:
+        tries, mask = self.tries, self.mask
+        return max((tries[seq & mask] for seq in self.unacked(base, end)), default=0)
+
+class ModeSwitch: # --arq auto: go-back-N while the path is clean, selective repeat once loss or reordering shows
+    __slots__ = ("mode", "loss", "reorder", "acked", "lost", "late", "switches")
+
+    def __init__(self, mode: str = "gbn") -> None:
+        self.mode = mode
+        self.loss = 0.0 # EWMA over epochs
+        self.reorder = 0.0
+        self.acked = 0 # counts of the open epoch
+        self.lost = 0
+        self.late = 0
+        self.switches = 0
+
+    def onAcked(self, late: bool, retried: bool):
+        # one newly acked packet: late = its ack came after a higher seq's, retried = it needed a
+        # retransmission; returns the new mode when the estimate crosses a threshold, else None
+        self.acked += 1
+        if retried:
+            self.lost += 1
+        elif late:
+            self.late += 1
+        if self.acked < EPOCH:
+            return None
+        self.loss = 0.7 * self.loss + 0.3 * self.lost / self.acked
+        self.reorder = 0.7 * self.reorder + 0.3 * self.late / self.acked
+        self.acked = self.lost = self.late = 0
+        if self.mode == "gbn" and (self.loss > TO_SR_LOSS or self.reorder > TO_SR_REORDER):
+            self.mode = "sr"
+        elif self.mode == "sr" and self.loss < TO_GBN_LOSS and self.reorder < TO_SR_REORDER / 5:
+            self.mode = "gbn"
+        else:
+            return None
+        self.switches += 1
+        return self.mode
@@ -5,30 +5,20 @@ import hashlib
 import os
 import json
 import argparse
+import itertools
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
-def genPacket(seq: int, flag: int, ack: int, data: bytes, ts: float) -> bytes:
-    dataLen = len(data)
-    header = f"{seq}|{flag}|{ack}|{dataLen}|{ts}\n"
-    return header.encode("utf-8") + data
-
-def getPacket(data: bytes):
-    sep = "\n".encode("utf-8")
-    pacSep = data.find(sep)
-
-    if pacSep == -1:
-        return 0, 0, 0, b"", 0.0
-    header = data[: pacSep].decode("utf-8")
-    payload = data[pacSep + len(sep): ]
-    headerSep: list = header.split("|")
-    if len(headerSep) != 5:
-        return 0, 0, 0, b"", 0
-    seq = int(headerSep[0])
-    flag = int(headerSep[1])
-    ack = int(headerSep[2])
-    payloadLen = int(headerSep[3])
-    ts = float(headerSep[4])
-    
-    return seq, flag, ack, payload[: payloadLen], ts
+from tracer import Tracer
+from profiler import Profiler, runProfiled
+from fec import FEC, fecEncoder, fecDecoder, ackPayload, replay
+from codec import CODECS, Deframer, frame, chain
+from delta import Patcher, signatures, sigSize
+from store import FileStore, DedupStore, Assembler, parseOffer, toRanges
+from scoreboard import Scoreboard, ModeSwitch
+from pathcache import PathCache
+from netio import (FIN_TIMEOUT, TIME_WAIT, IDLE_TIMEOUT, genPacket, getPacket, finWait, timeWait, drain,
+                   AsyncWriter, tuneSocket, udpDrops)
 
 def getMD5(path: str) -> str:
     md5 = hashlib.md5()
@@ -42,6 +32,11 @@ def getMD5(path: str) -> str:
     
     return md5.hexdigest()
 
+OFFER_TTL = 60.0 # seconds a dedup chunk offer waits for its upload
+SESSION_IDLE = 120.0 # seconds an unused session data socket stays open
+MAX_SESSIONS = 256 # beyond this, session requests get a one-off data socket
+TICKET_IDLE = 2 * IDLE_TIMEOUT # an admitted transfer that moved no bytes this long loses its slot
+
 class CongestControl: # virtual class, for reno and vegas
     def ifACK(self, ack: int, cwnd: float, rtt) -> float: # each function return cwnd
         raise NotImplemented
@@ -101,71 +96,99 @@ class vegasContol(CongestControl):
         return max(1.0, cwnd - 1.0)
 
 class receiver: # virtual class, for GBN and SR
-    def __init__(self, socket: socket.socket, addr, outPath: str, mode, pktSize: int) -> None:
+    def __init__(self, socket: socket.socket, addr, outPath: str, mode, pktSize: int, sizeHint: int = 0) -> None:
         self.socket = socket
         self.addr = addr
         self.outPath = outPath
         self.mode = mode
         self.pktSize = pktSize
+        self.sizeHint = sizeHint
         self.filelock = threading.Lock()
-    
-    def handle(self) :
+        self.clock = time.time # replaced by the virtual clock in simulate.py
+        self.encode = genPacket # instance attributes so --profile can time them per flow
+        self.decode = getPacket
+        self.peer = None # data socket of the client, learnt from its first packet
+        self.expect = 0
+        self.writer = None
+        self.t0 = None
+        self.received = 0 # payload bytes delivered in order
+        self.fec = None # fecDecoder when the transfer negotiated parity packets
+        self.unframe = None # stream bytes -> file bytes: codec.Deframer and/or delta.Patcher
+        self.onFin = None # called once FIN arrived, before TIME_WAIT; frees the transfer's scheduler slot
+
+    def onPacket(self, data: bytes, addr1) -> bool: # returns True once FIN arrived
         raise NotImplementedError
     
-
-class GBNreceiver(receiver):
-    def handle(self):
-        expect = 0
-        data_peer = None
-        with open(self.outPath, "wb") as f:
+    def handle(self) :
+        self.socket.settimeout(IDLE_TIMEOUT)
+        self.writer = AsyncWriter(self.outPath, self.sizeHint, transform=self.unframe)
+        try:
             while True:
                 data, addr1 = self.socket.recvfrom(65536)
-                if data_peer is None:
-                    data_peer = addr1
-                seq, flag, ack, payload, ts = getPacket(data)
-                ackFlag = 1 << 0
-                if seq == expect:
-                    if payload:
-                        f.write(payload)
-                        expect += 1
-                    ackPacket = genPacket(0, ackFlag, expect, "".encode("utf-8"), time.time())
-                    self.socket.sendto(ackPacket, data_peer)
-                else:
-                    ackPacket = genPacket(0, ackFlag, expect, "".encode("utf-8"), time.time())
-                    self.socket.sendto(ackPacket, data_peer)
-                if flag & (1 << 1):
-                    ackPacket = genPacket(0, ackFlag, expect, "".encode("utf-8"), time.time())
-                    self.socket.sendto(ackPacket, data_peer)
+                if self.t0 is None:
+                    self.t0 = self.clock()
+                if self.onPacket(data, addr1):
                     break
+            if self.onFin is not None:
+                self.onFin()
+            # FIN-ACK before the writer drains: rebuilding and hashing a large file can outlast the
+            # peer's FIN_WAIT, what goes wrong after this point reaches it in the done report
+            self.timeWait()
+        finally:
+            self.writer.close()
 
-class SRRreveiver(receiver):
-    def handle(self):
-        packetBuff: dict = {}
-        expect = 0
-        data_peer = None
-        with open(self.outPath, "wb") as f:
-            while True:
-                data, addr1 = self.socket.recvfrom(65536)
-                if data_peer is None:
-                    data_peer = addr1
-                seq, flag, ack, payload, ts = getPacket(data)
-                ackFlag = 1 << 0
-                ackPacket = genPacket(0, ackFlag, seq + 1, b"", time.time())
-                self.socket.sendto(ackPacket, data_peer)
-                if seq >= expect:
-                    packetBuff[seq] = payload
-                    while expect in packetBuff:
-                        chunk = packetBuff.pop(expect)
-                        if chunk:
-                            f.write(chunk)
-                        expect += 1
-                
-                if flag & (1 << 1):
-                    ackPacket = genPacket(0, ackFlag, expect, b"", time.time())
-                    self.socket.sendto(ackPacket, data_peer)
-                    break
+    def timeWait(self) -> None:
+        timeWait(self.socket, self.peer or self.addr, self.expect)
+
+    def snapshot(self) -> dict:
+        # live counters for the stats command, read without locking
+        dt = self.clock() - self.t0 if self.t0 else 0.0
+        return {"role": "receive", "mode": self.mode, "bytes": self.received, "size": self.sizeHint,
+                "goodput_mbps": round(self.received * 8 / dt / 1e6, 3) if dt > 0 else 0.0,
+                "reorder_buffer": len(getattr(self, "packetBuff", ())),
+                "write_queue": self.writer.queue.qsize() if self.writer else 0}
+    
+
+class ARQreceiver(receiver): # one receiver for every sender mode
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.packetBuff: dict = {}
+
+    def onPacket(self, data: bytes, addr1) -> bool:
+        # out of order data is held until the gap fills; each ACK carries both the cumulative
+        # next expected seq (ack field, what GBN reads) and the seq it answers + 1 (seq field, SR)
+        if self.peer is None:
+            self.peer = addr1
+        seq, flag, ack, payload, ts = self.decode(data)
+        ackFlag = 1 << 0
+        if flag & ackFlag: # stray ACK or FIN-ACK of an earlier transfer on this socket
+            return False
+        if flag & (1 << 1):
+            return True
+        if flag & FEC:
+            if self.fec is not None:
+                replay(self, self.fec.onParity(seq, ack, payload, self.expect), ts, addr1)
+            return False
+        if seq >= self.expect:
+            self.packetBuff[seq] = payload
+            while self.expect in self.packetBuff:
+                chunk = self.packetBuff.pop(self.expect)
+                if chunk:
+                    self.writer.write(chunk)
+                    self.received += len(chunk)
+                self.expect += 1
+        ackPacket = self.encode(seq + 1, ackFlag, self.expect, ackPayload(self.fec), self.clock())
+        self.socket.sendto(ackPacket, self.peer)
+        if self.fec is not None:
+            replay(self, self.fec.onData(seq, payload), ts, addr1)
+        return False
 
 class sender:
+    __slots__ = ("socket", "addr", "inPath", "mode", "cc", "pktSize", "maxWin", "lock", "ackLock", "clock", "encode", "decode",
+                 "data", "pacer", "tracer", "fec", "chunks", "unique_payload", "npkt", "base", "nextIdx", "cwnd", "timeout",
+                 "board", "total_sent", "t0", "srtt", "rttvar", "retransmits", "dupAcks", "timeouts", "fecRecovered", "warm",
+                 "progressBase", "progressAt", "stopped")
+
     def __init__(self, socket: socket.socket, addr, inPath: str, mode: str, cc: CongestControl, pktSize: int, maxWin: int) -> None:
         self.socket = socket
         self.addr = addr
@@ -175,219 +198,823 @@ class sender:
         self.pktSize = pktSize
         self.maxWin = maxWin
         self.lock = threading.Lock()
+        self.ackLock = threading.Lock()
+        self.clock = time.time # replaced by the virtual clock in simulate.py
+        self.encode = genPacket # instance attributes so --profile can time them per flow
+        self.decode = getPacket
+        self.data = None # file contents served from FileCache, read from inPath if None
+        self.pacer = None # TokenBucket share assigned by the Scheduler, None = unpaced
+        self.tracer = None # Tracer sampling cwnd/rtt/window state, None = off
+        self.fec = None # fecEncoder when the transfer negotiated parity packets
+        self.warm = None # PathCache entry of the last send to this peer, None = cold start
 
-    def send(self) -> None:
+    def loadChunks(self) -> list:
+        if self.data is not None:
+            view = memoryview(self.data) # slices share the cached buffer, no per-packet copy
+            return [view[i: i + self.pktSize] for i in range(0, len(view), self.pktSize)]
+        chunks = []
+        with open(self.inPath, "rb") as f:
+            while True:
+                cur = f.read(self.pktSize)
+                if not cur:
+                    break
+                chunks.append(cur)
+        return chunks
+
+    def transmit(self, idx: int, block: bool = True) -> None:
+        # block=False under ackLock: the tokens are taken, the wait is left to settle() or the next send
+        now = self.clock()
+        pkt = self.encode(idx, 0, 0, self.chunks[idx], now)
+        if self.pacer:
+            wait = self.pacer.reserve(len(pkt))
+            if block and wait > 0:
+                time.sleep(wait)
+        self.socket.sendto(pkt, self.addr)
+        if self.t0 is None:
+            self.t0 = self.clock()
+        self.total_sent += len(self.chunks[idx])
+        if idx < self.nextIdx: # pump() sends nextIdx first and advances it afterwards
+            self.board.resend(idx, now)
+        else:
+            self.board.send(idx, now)
+
+    def sendParity(self, idx: int) -> None:
+        # after the first transmission of idx, send the parity of the FEC block idx closes
+        block = self.fec.onSend(idx, self.chunks)
+        if block is None:
+            return
+        start, k, par = block
+        pkt = self.encode(start, FEC, k, par, self.clock())
+        if self.pacer:
+            self.pacer.consume(len(pkt))
+        self.socket.sendto(pkt, self.addr)
+        self.total_sent += len(par) # parity counts against utilization like any resend
+        sent = self.nextIdx + 1 + self.retransmits
+        self.fec.adapt((self.timeouts + self.fecRecovered) / sent)
+
+    def settle(self) -> None:
+        # sleep off the pacing debt of sends made under ackLock, after releasing it
+        if self.pacer:
+            wait = self.pacer.reserve(0)
+            if wait > 0:
+                time.sleep(wait)
+
+    def resetCounters(self) -> None:
+        self.total_sent = 0
+        self.t0 = None
+        self.srtt = None if self.warm is None else self.warm["srtt"]
+        self.rttvar = None if self.warm is None else self.warm["rttvar"]
+        self.retransmits = 0
+        self.dupAcks = 0
+        self.timeouts = 0
+        self.fecRecovered = 0 # packets the receiver rebuilt from parity, from its ACKs
+        self.progressBase = 0
+        self.progressAt = self.clock()
+
+    def checkAlive(self) -> None:
+        # the send loop gives up once the window base has not moved for IDLE_TIMEOUT: the peer is gone
+        now = self.clock()
+        if self.base != self.progressBase:
+            self.progressBase, self.progressAt = self.base, now
+        elif now - self.progressAt > IDLE_TIMEOUT:
+            raise TimeoutError(f"no ACK progress for {IDLE_TIMEOUT:.0f}s after {self.timeouts} timeouts, peer gone")
+
+    def sampleRtt(self, rtt) -> None:
+        # RFC 6298 smoothing of the rtt samples the controller sees, reported in the trace
+        if rtt is None:
+            return
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def initialWindow(self) -> float:
+        # half the window the last send to this peer ended with, capped by maxWin; 1 on a cold start
+        if self.warm is None:
+            return 1.0
+        return max(1.0, min(float(self.maxWin), self.warm["cwnd"] / 2))
+
+    def trace(self) -> None:
+        if self.tracer is not None:
+            self.tracer.sample(self.clock(), self.cwnd, getattr(self.cc, "ssthresh", float("nan")), self.srtt or 0.0,
+                               self.base, self.nextIdx, self.retransmits, self.dupAcks, self.timeouts)
+
+    def snapshot(self) -> dict:
+        # live counters for the stats command, read without locking
+        if not hasattr(self, "board"): # setup() assigns it last
+            return {"role": "send", "mode": self.mode, "state": "starting"}
+        acked = min(self.base * self.pktSize, self.unique_payload)
+        dt = self.clock() - self.t0 if self.t0 else 0.0
+        return {"role": "send", "mode": self.mode, "bytes": acked, "size": self.unique_payload,
+                "goodput_mbps": round(acked * 8 / dt / 1e6, 3) if dt > 0 else 0.0,
+                "cwnd": round(self.cwnd, 2), "srtt_ms": round(self.srtt * 1000, 3) if self.srtt else None,
+                "inflight": max(0, self.nextIdx - self.base), "sent_bytes": self.total_sent,
+                "max_tries": self.board.maxTries(self.base, self.nextIdx),
+                "retransmits": self.retransmits, "timeouts": self.timeouts, "dupacks": self.dupAcks,
+                "pacer_mbps": round(self.pacer.rate * 8 / 1e6, 3) if self.pacer else 0.0, "warm_start": self.warm is not None}
+
+    def setup(self) -> None:
         raise NotImplemented
 
-class GBNsender(sender):
+    def onAck(self, data: bytes) -> None:
+        raise NotImplemented
+
+    def pump(self) -> None: # one pass of the send loop
+        raise NotImplemented
+
+    def checkTimers(self) -> None: # retransmit whatever timed out, the tail of pump()
+        raise NotImplemented
+
+    def nextDeadline(self): # when pump() next has timer work, None if no timer runs
+        raise NotImplemented
 
     def ackListen(self):
-        while True:
-            data, recAddr = self.socket.recvfrom(2048)
-            seq, flag, ackNum, payload, ts = getPacket(data)
-            if flag & (1 << 0):
-                now = time.time()
-                if ts > 0:
-                    rtt = (now - ts)
-                else:
-                    rtt = None
-                with self.ackLock:
-                    if ackNum > self.base:
-                        self.base = ackNum
-                        self.cwnd = self.cc.ifACK(ackNum, self.cwnd, rtt)
-                        if self.base != self.nextSeq:
-                            self.timerStart = time.time()
-                        else:
-                            self.timerStart = None
-                    else:
-                        self.dupACKcount += 1
-                        if self.dupACKcount >= 3:
-                            self.cwnd = self.cc.ifDupACK(self.cwnd)
-                            self.dupACKcount = 0
-                            if self.base < self.npkt:
-                                pkt = genPacket(self.base, 0, 0, self.chunks[self.base], time.time())
-                                self.socket.sendto(pkt, self.addr)
-                                self.timerStart = time.time()
+        while not self.stopped:
+            try:
+                data, recAddr = self.socket.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except OSError: # closed under us after an abort
+                return
+            self.onAck(data)
             if self.base >= self.npkt:
                 return
 
-    def send(self):
-        self.chunks: list = []
-        with open(self.inPath, "rb") as f:
-            while True:
-                cur = f.read(self.pktSize)
-                if not cur:
-                    break
-                self.chunks.append(cur)
+    def stats(self) -> dict:
+        t0 = self.clock() if self.t0 is None else self.t0
+        dt = max(1e-9, self.clock() - t0)
+        goodput_mbps = self.unique_payload * 8 / dt / 1e6
+        utilization = (self.unique_payload / self.total_sent) if self.total_sent > 0 else 0.0
+        return {"goodput_mbps": goodput_mbps, "utilization": utilization, "seconds": dt}
+
+    def send(self) -> None:
+        self.setup()
+        self.stopped = False
+        self.socket.settimeout(1.0) # the ACK listener wakes up now and then to notice an aborted send
+        listener = threading.Thread(target=self.ackListen, daemon=True)
+        listener.start()
+
+        try:
+            while self.base < self.npkt:
+                self.pump()
+                self.checkAlive()
+        finally:
+            self.stopped = True
+            if self.tracer is not None:
+                self.tracer.close()
+        listener.join(FIN_TIMEOUT)
+        finWait(self.socket, self.addr, self.npkt, "server")
+
+        m = self.stats()
+        print(f"METRIC,mode={self.mode},goodput_mbps={m['goodput_mbps']:.3f},utilization={m['utilization']:.4f},seconds={m['seconds']:.3f},kernel_drops={udpDrops(self.socket)}")
+
+class GBNsender(sender):
+    __slots__ = ("timerStart", "dupACKcount")
+
+    def setup(self):
+        self.chunks: list = self.loadChunks()
         
-        unique_payload = sum(len(c) for c in self.chunks)
-        total_sent = 0
-        t0 = None
+        self.unique_payload = sum(len(c) for c in self.chunks)
+        self.resetCounters()
 
         self.npkt = len(self.chunks)
         self.base = 0
-        self.nextSeq = 0
-        self.cwnd = 1.0
+        self.nextIdx = 0
+        self.cwnd = self.initialWindow()
         self.timeout = 5.0
         self.timerStart = None
         self.dupACKcount = 0
-        self.ackLock = threading.Lock()
+        self.board = Scoreboard(self.npkt, self.maxWin, selective=False)
 
-        listener = threading.Thread(target=self.ackListen, daemon=True)
-        listener.start()
+    def onAck(self, data: bytes):
+        seq, flag, ackNum, payload, ts = self.decode(data)
+        if flag & (1 << 0):
+            if payload and self.fec is not None:
+                self.fecRecovered = max(self.fecRecovered, int(payload))
+            now = self.clock()
+            if ts > 0:
+                rtt = (now - ts)
+            else:
+                rtt = None
+            with self.ackLock:
+                if ackNum > self.base:
+                    self.base = ackNum
+                    self.sampleRtt(rtt)
+                    self.cwnd = self.cc.ifACK(ackNum, self.cwnd, rtt)
+                    if self.base != self.nextIdx:
+                        self.timerStart = self.clock()
+                    else:
+                        self.timerStart = None
+                else:
+                    self.dupACKcount += 1
+                    self.dupAcks += 1
+                    if self.dupACKcount >= 3:
+                        self.cwnd = self.cc.ifDupACK(self.cwnd)
+                        self.dupACKcount = 0
+                        if self.base < self.npkt:
+                            self.transmit(self.base, block=False) # the pump's next send pays the wait
+                            self.retransmits += 1
+                            self.timerStart = self.clock()
+                self.trace()
 
-        while self.base < self.npkt:
-            window = int(min(self.maxWin, max(1, int(self.cwnd))))
-            while self.nextSeq < min(self.base + window, self.npkt):
-                pkt = genPacket(self.nextSeq, 0, 0, self.chunks[self.nextSeq], time.time())
-                self.socket.sendto(pkt, self.addr)
+    def pump(self):
+        window = int(min(self.maxWin, max(1, int(self.cwnd))))
+        while self.nextIdx < min(self.base + window, self.npkt):
+            self.transmit(self.nextIdx)
+            if self.fec is not None:
+                self.sendParity(self.nextIdx)
+            if self.base == self.nextIdx:
+                self.timerStart = self.clock()
+            self.nextIdx += 1
+        self.checkTimers()
 
-                if t0 is None:
-                    t0 = time.time()
-                total_sent += len(self.chunks[self.nextSeq])
+    def checkTimers(self):
+        window = int(min(self.maxWin, max(1, int(self.cwnd))))
+        with self.ackLock:
+            tstart = self.timerStart
+        if tstart and (self.clock() - tstart) > self.timeout:
+            self.cwnd = self.cc.ifTimeout(self.cwnd)
+            self.timeouts += 1
+            for p in range(self.base, min(self.nextIdx, self.base + window)): # resend base -> nextIdx-1
+                self.transmit(p)
+                self.retransmits += 1
+            self.timerStart = self.clock()
+            self.trace()
 
-                if self.base == self.nextSeq:
-                    self.timerStart = time.time()
-                self.nextSeq += 1
-            if self.timerStart and (time.time() - self.timerStart) > self.timeout:
-                self.cwnd = self.cc.ifTimeout(self.cwnd)
-                for p in range(self.base, min(self.nextSeq, self.base + window)): # resend base -> nexSeq-1
-                    pkt = genPacket(p, 0, 0, self.chunks[p], time.time())
-                    self.socket.sendto(pkt, self.addr)
+    def nextDeadline(self):
+        tstart = self.timerStart
+        return tstart + self.timeout if tstart else None
 
-                    total_sent += len(self.chunks[p])
+class SRsender(sender):
+    __slots__ = ()
 
-                self.timerStart = time.time()
-        self.socket.settimeout(self.timeout)
-        
+    def setup(self):
+        self.chunks: list = self.loadChunks()
 
-        while True:
-            finPkt = genPacket(self.npkt, (1 << 1), 0, "".encode("utf-8"), time.time())
-            self.socket.sendto(finPkt, self.addr)
-            try:
-                data, recAddr = self.socket.recvfrom(2048)
-                seq, flag, ackNum, payload, ts = getPacket(data)
-                if flag & (1 << 0) and ackNum > self.npkt:
-                    break
-            except socket.timeout:
-                continue
+        self.unique_payload = sum(len(c) for c in self.chunks)
+        self.resetCounters()
 
-        if t0 is None:
-            t0 = time.time()
-        dt = max(1e-9, time.time() - t0)
-        goodput_mbps = unique_payload * 8 / dt / 1e6
-        utilization = (unique_payload / total_sent) if total_sent > 0 else 0.0
-        print(f"METRIC,mode=gbn,goodput_mbps={goodput_mbps:.3f},utilization={utilization:.4f},seconds={dt:.3f}")
+        self.npkt = len(self.chunks)
+        self.base = 0
+        self.nextIdx = 0
+        self.cwnd = self.initialWindow()
+        self.timeout = 5.0
+        self.board = Scoreboard(self.npkt, self.maxWin)
 
-class SRsender(sender):
-    def ackListen(self):
-        while True:
-            data, revAddr = self.socket.recvfrom(2048)
-            seq, flag, ackNum, payload, ts = getPacket(data)
-            if flag & (1 << 0):
-                idx = ackNum - 1
-                if 0 <= idx < self.npkt:
-                    with self.ackLock:
-                        self.acked.add(idx)
-                        if ts > 0:
-                            rtt = (time.time() - ts)
-                        else:
-                            rtt = None
-                        self.cwnd = self.cc.ifACK(ackNum, self.cwnd, rtt)
-                        while self.base in self.acked:
-                            self.base += 1
-            if self.base >= self.npkt:
-                break
-    
-    def send(self):
-        self.chunks: list = []
-        with open(self.inPath, "rb") as f:
-            while True:
-                p = f.read(self.pktSize)
-                if not p:
-                    break
-                self.chunks.append(p)
+    def onAck(self, data: bytes):
+        seq, flag, ackNum, payload, ts = self.decode(data)
+        if flag & (1 << 0):
+            if payload and self.fec is not None:
+                self.fecRecovered = max(self.fecRecovered, int(payload))
+            idx = seq - 1 # the seq this ACK answers, ackNum is the receiver's cumulative expect
+            if 0 <= idx < self.npkt:
+                with self.ackLock:
+                    if not self.board.ack(idx):
+                        self.dupAcks += 1
+                    self.board.ackThrough(self.base, ackNum) # covers ACKs lost on the way
+                    if ts > 0:
+                        rtt = (self.clock() - ts)
+                    else:
+                        rtt = None
+                    self.sampleRtt(rtt)
+                    self.cwnd = self.cc.ifACK(ackNum, self.cwnd, rtt)
+                    self.base = self.board.advance(self.base)
+                    self.trace()
+
+    def pump(self):
+        window = int(min(self.maxWin, max(1, int(self.cwnd))));
+        while self.nextIdx < self.npkt and self.nextIdx < self.base + window:
+            self.transmit(self.nextIdx)
+            if self.fec is not None:
+                self.sendParity(self.nextIdx)
+            self.nextIdx += 1
+        self.checkTimers()
+
+    def checkTimers(self):
+        now = self.clock()
+        with self.ackLock:
+            for idx in self.board.expired(self.base, self.nextIdx, now, self.timeout):
+                self.cwnd = self.cc.ifTimeout(self.cwnd)
+                self.transmit(idx, block=False)
+                self.retransmits += 1
+                self.timeouts += 1
+                self.trace()
+        self.settle()
 
-        unique_payload = sum(len(c) for c in self.chunks)
-        total_sent = 0
-        t0 = None
+    def nextDeadline(self):
+        with self.ackLock:
+            oldest = self.board.deadline(self.base, self.nextIdx)
+        return None if oldest is None else oldest + self.timeout
+
+class AUTOsender(sender): # go-back-N or selective repeat, re-picked every epoch from measured loss and reordering
+    __slots__ = ("timerStart", "dupACKcount", "highSel", "switch")
+
+    def setup(self):
+        self.chunks: list = self.loadChunks()
+
+        self.unique_payload = sum(len(c) for c in self.chunks)
+        self.resetCounters()
 
         self.npkt = len(self.chunks)
         self.base = 0
-        self.sent: dict = {}
-        self.acked: set = set()
-        self.cwnd = 1.0
+        self.nextIdx = 0
+        self.cwnd = self.initialWindow()
         self.timeout = 5.0
-        self.timers: dict = {}
-        self.ackLock = threading.Lock()
+        self.timerStart = None # the go-back-N timer, on the oldest unacked packet
+        self.dupACKcount = 0
+        self.highSel = -1 # highest seq selectively acked so far
+        self.switch = ModeSwitch()
+        self.board = Scoreboard(self.npkt, self.maxWin)
 
-        listener = threading.Thread(target=self.ackListen, daemon=True)
-        listener.start()
+    def observe(self, idx: int, late: bool) -> None:
+        mode = self.switch.onAcked(late, self.board.retried(idx))
+        if mode is not None:
+            print(f"server: arq auto -> {mode} (loss {self.switch.loss:.2%}, reordering {self.switch.reorder:.2%})")
+            if mode == "gbn": # restart the single timer the per-packet ones stood in for
+                self.timerStart = self.clock() if self.base < self.nextIdx else None
 
-        nextIdx = 0
-        while self.base < self.npkt:
-            window = int(min(self.maxWin, max(1, int(self.cwnd))));
-            while nextIdx < self.npkt and nextIdx < self.base + window:
-                pkt = genPacket(nextIdx, 0, 0, self.chunks[nextIdx], time.time())
-                self.socket.sendto(pkt, self.addr)
-
-                if t0 is None:
-                    t0 = time.time()
-                total_sent += len(self.chunks[nextIdx])
-
-                self.timers[nextIdx] = time.time()
-                self.sent[nextIdx] = self.timers[nextIdx]
-                nextIdx += 1
-            
-            now = time.time()
+    def onAck(self, data: bytes):
+        seq, flag, ackNum, payload, ts = self.decode(data)
+        if flag & (1 << 0):
+            if payload and self.fec is not None:
+                self.fecRecovered = max(self.fecRecovered, int(payload))
+            rtt = (self.clock() - ts) if ts > 0 else None
             with self.ackLock:
-                for idx in list(self.timers.keys()):
-                    if idx in self.acked:
-                        self.timers.pop(idx)
-                        self.sent.pop(idx)
-                
-                for idx, t0 in list(self.timers.items()):
-                    if idx not in self.acked and now - t0 > self.timeout:
-                        self.cwnd = self.cc.ifTimeout(self.cwnd)
-                        pkt = genPacket(idx, 0, 0, self.chunks[idx], time.time())
-                        self.socket.sendto(pkt, self.addr)
-
-                        total_sent += len(self.chunks[idx])
-
-                        self.timers[idx] = time.time()
-        
-        self.socket.settimeout(self.timeout)
+                newly = 0
+                idx = seq - 1
+                if 0 <= idx < self.npkt and self.board.ack(idx):
+                    newly += 1
+                    self.observe(idx, idx < self.highSel)
+                self.highSel = max(self.highSel, idx)
+                for covered in self.board.ackThrough(self.base, ackNum):
+                    newly += 1
+                    self.observe(covered, False)
+                if newly:
+                    self.sampleRtt(rtt)
+                    self.cwnd = self.cc.ifACK(ackNum, self.cwnd, rtt)
+                else:
+                    self.dupAcks += 1
+                base = self.board.advance(self.base)
+                if base > self.base:
+                    self.base = base
+                    self.dupACKcount = 0
+                    self.timerStart = self.clock() if self.base != self.nextIdx else None
+                elif self.switch.mode == "gbn" and self.base < self.nextIdx:
+                    self.dupACKcount += 1 # the receiver holds later packets, base is missing
+                    if self.dupACKcount >= 3:
+                        self.cwnd = self.cc.ifDupACK(self.cwnd)
+                        self.dupACKcount = 0
+                        self.transmit(self.base, block=False) # the pump's next send pays the wait
+                        self.retransmits += 1
+                        self.timerStart = self.clock()
+                self.trace()
+
+    def pump(self):
+        window = int(min(self.maxWin, max(1, int(self.cwnd))))
+        while self.nextIdx < min(self.base + window, self.npkt):
+            self.transmit(self.nextIdx)
+            if self.fec is not None:
+                self.sendParity(self.nextIdx)
+            if self.base == self.nextIdx:
+                self.timerStart = self.clock()
+            self.nextIdx += 1
+        self.checkTimers()
+
+    def checkTimers(self):
+        if self.switch.mode == "sr":
+            with self.ackLock:
+                for idx in self.board.expired(self.base, self.nextIdx, self.clock(), self.timeout):
+                    self.cwnd = self.cc.ifTimeout(self.cwnd)
+                    self.transmit(idx, block=False)
+                    self.retransmits += 1
+                    self.timeouts += 1
+                    self.trace()
+            self.settle()
+            return
+        window = int(min(self.maxWin, max(1, int(self.cwnd))))
+        with self.ackLock:
+            tstart = self.timerStart
+        if tstart and (self.clock() - tstart) > self.timeout:
+            self.cwnd = self.cc.ifTimeout(self.cwnd)
+            self.timeouts += 1
+            for p in range(self.base, min(self.nextIdx, self.base + window)):
+                self.transmit(p)
+                self.retransmits += 1
+            self.timerStart = self.clock()
+            self.trace()
+
+    def nextDeadline(self):
+        if self.switch.mode == "sr":
+            with self.ackLock:
+                oldest = self.board.deadline(self.base, self.nextIdx)
+            return None if oldest is None else oldest + self.timeout
+        tstart = self.timerStart
+        return tstart + self.timeout if tstart else None
+
+    def snapshot(self) -> dict:
+        snap = super().snapshot()
+        if hasattr(self, "board"):
+            snap.update(arq_now=self.switch.mode, loss_est=round(self.switch.loss, 4),
+                        reorder_est=round(self.switch.reorder, 4), arq_switches=self.switch.switches)
+        return snap
+
+class cacheEntry:
+    def __init__(self, version: tuple, data: bytes, md5: str) -> None:
+        self.version = version # FileStore.version() of the file when it was read
+        self.data = data
+        self.md5 = md5
+        self.variants: dict = {} # derived forms of data, e.g. codec name -> compressed stream
+
+    def nbytes(self) -> int:
+        return len(self.data) + sum(len(v) for v in self.variants.values())
+
+class FileCache: # LRU of whole file contents + md5 by stored name, shared by all download threads
+    def __init__(self, maxBytes: int, files: FileStore) -> None:
+        self.maxBytes = maxBytes
+        self.files = files # storage backend the contents are read from
+        self.entries: OrderedDict = OrderedDict()
+        self.loading: dict = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path: str) -> cacheEntry:
+        version = self.files.version(path)
         while True:
-            finalPkt = genPacket(self.npkt, (1 << 1), 0, "".encode("utf-8"), time.time())
-            self.socket.sendto(finalPkt, self.addr)
-            try:
-                data, recAddr = self.socket.recvfrom(2048)
-                seq, flag, ackNum, payload, ts = getPacket(data)
-                if flag & (1 << 0) and ackNum >= self.npkt:
+            with self.lock:
+                entry = self.entries.get(path)
+                if entry is not None and entry.version == version:
+                    self.entries.move_to_end(path)
+                    self.hits += 1
+                    return entry
+                pending = self.loading.get(path)
+                if pending is None: # we read it, concurrent requests wait for our copy
+                    pending = threading.Event()
+                    self.loading[path] = pending
+                    self.misses += 1
                     break
-            except socket.timeout:
-                continue
-            
-        if t0 is None:
-            t0 = time.time()
-        dt = max(1e-9, time.time() - t0)
-        goodput_mbps = unique_payload * 8 / dt / 1e6
-        utilization = (unique_payload / total_sent) if total_sent > 0 else 0.0
-        print(f"METRIC,mode=sr,goodput_mbps={goodput_mbps:.3f},utilization={utilization:.4f},seconds={dt:.3f}")
+            pending.wait()
+
+        try:
+            entry = self.load(path, version)
+            with self.lock:
+                self.store(path, entry)
+        finally:
+            with self.lock:
+                self.loading.pop(path).set()
+        return entry
+
+    def load(self, path: str, version: tuple) -> cacheEntry:
+        data = self.files.read(path)
+        return cacheEntry(version, data, hashlib.md5(data).hexdigest())
+
+    def store(self, path: str, entry: cacheEntry) -> None:
+        old = self.entries.pop(path, None)
+        if old is not None:
+            self.size -= old.nbytes()
+        if entry.nbytes() > self.maxBytes:
+            return
+        self.entries[path] = entry
+        self.size += entry.nbytes()
+        while self.size > self.maxBytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes()
+
+    def variant(self, path: str, entry: cacheEntry, key: str, build):
+        # build(entry.data) once per cached version, kept with the entry and counted in its size
+        with self.lock:
+            got = entry.variants.get(key)
+        if got is not None:
+            return got
+        got = build(entry.data)
+        with self.lock:
+            if self.entries.get(path) is entry and key not in entry.variants:
+                entry.variants[key] = got
+                self.size += len(got)
+                while self.size > self.maxBytes:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.size -= evicted.nbytes()
+        return got
+
+    def invalidate(self, path: str) -> None:
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= old.nbytes()
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = 64 * 1024) -> None:
+        self.rate = rate # bytes per second, <= 0 means unlimited
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def setRate(self, rate: float) -> None:
+        with self.lock:
+            if self.rate > 0:
+                self.refill(time.time())
+            else:
+                self.tokens = self.burst
+                self.last = time.time()
+            self.rate = rate
+
+    def reserve(self, n: int) -> float:
+        # take n tokens now, into debt if short; returns the seconds until the debt is paid off
+        with self.lock:
+            if self.rate <= 0:
+                return 0.0
+            self.refill(time.time())
+            self.tokens -= n
+            return max(0.0, -self.tokens / self.rate)
+
+    def consume(self, n: int) -> None:
+        wait = self.reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+
+class session: # a client's data socket kept open across its transfers, one transfer at a time
+    def __init__(self, sid: str, socketData: socket.socket) -> None:
+        self.id = sid
+        self.socket = socketData
+        self.lock = threading.Lock() # held by a transfer through its TIME_WAIT
+        self.last = time.time()
+        self.transfers = 0
+        self.closing = False # the client said goodbye while a transfer still held the socket
+
+class ticket:
+    ids = itertools.count(1)
+
+    def __init__(self, client: str, weight: float) -> None:
+        self.client = client
+        self.weight = weight
+        self.start = time.time()
+        self.pacer = TokenBucket(0)
+        self.id = next(ticket.ids)
+        self.info: dict = {} # cmd/name/arq/cc of the request, for stats
+        self.flow = None # the sender or receiver once the transfer runs
+        self.moved = 0 # flow bytes at the last liveness check
+        self.seen = self.start # when they last changed
+
+    def alive(self, now: float) -> bool:
+        moved = self.flow.snapshot().get("bytes", 0) if self.flow is not None else 0
+        if moved != self.moved:
+            self.moved, self.seen = moved, now
+        return now - self.seen <= TICKET_IDLE
+
+class Scheduler: # admission control + weighted fair bandwidth shares across active transfers
+    def __init__(self, maxActive: int, maxPerClient: int, rateMbps: float, clientRateMbps: float) -> None:
+        self.maxActive = maxActive
+        self.maxPerClient = maxPerClient
+        self.rate = rateMbps * 1e6 / 8
+        self.clientRate = clientRateMbps * 1e6 / 8
+        self.active: list = []
+        self.avgSeconds = 1.0 # EWMA of transfer duration, used for retryAfter
+        self.rejected = 0
+        self.reaped = 0
+        self.lock = threading.Lock()
+
+    def reap(self) -> None:
+        # drop tickets whose flow stalled, so a stuck transfer thread cannot hold a slot forever;
+        # its own release() later is a no-op
+        now = time.time()
+        stale = [t for t in self.active if not t.alive(now)]
+        for t in stale:
+            self.active.remove(t)
+            self.reaped += 1
+            print(f"server: ticket #{t.id} of {t.client} idle for {now - t.seen:.0f}s, slot freed")
+        if stale:
+            self.rebalance()
+
+    def admit(self, client: str, weight: float):
+        with self.lock:
+            self.reap()
+            perClient = sum(1 for t in self.active if t.client == client)
+            if len(self.active) >= self.maxActive or perClient >= self.maxPerClient:
+                self.rejected += 1
+                return None
+            t = ticket(client, weight)
+            self.active.append(t)
+            self.rebalance()
+            return t
+
+    def release(self, t: ticket) -> None:
+        # at the end of the data phase, again (a no-op) when the transfer thread exits
+        with self.lock:
+            if t not in self.active:
+                return
+            self.active.remove(t)
+            self.avgSeconds = 0.8 * self.avgSeconds + 0.2 * (time.time() - t.start)
+            self.rebalance()
+
+    def retryAfter(self) -> float:
+        with self.lock:
+            return round(max(TIME_WAIT, self.avgSeconds / max(1, len(self.active))), 3)
+
+    def rebalance(self) -> None:
+        # share = global rate * weight / total weight, each client's total capped at clientRate
+        totalWeight = sum(t.weight for t in self.active)
+        clients: dict = {}
+        for t in self.active:
+            clients[t.client] = clients.get(t.client, 0.0) + t.weight
+        for t in self.active:
+            clientWeight = clients[t.client]
+            share = self.rate * clientWeight / totalWeight if self.rate > 0 else 0.0
+            if self.clientRate > 0:
+                share = min(share, self.clientRate) if share > 0 else self.clientRate
+            t.pacer.setRate(share * t.weight / clientWeight)
+
+def promText(stats: dict) -> str:
+    # Prometheus text exposition of FTPserver.stats(), samples grouped per metric family
+    families: dict = {} # name -> (type, sample lines), insertion ordered
+    def metric(name: str, kind: str, value, labels: dict = None) -> None:
+        if value is None:
+            return
+        tag = ",".join(f'{k}="{v}"' for k, v in (labels or {}).items())
+        families.setdefault(name, (kind, []))[1].append(f"{name}{{{tag}}} {value}" if tag else f"{name} {value}")
+    metric("ftp_uptime_seconds", "gauge", stats["uptime_s"])
+    metric("ftp_active_transfers", "gauge", stats["active"])
+    metric("ftp_transfers_completed_total", "counter", stats["completed"])
+    metric("ftp_transfers_failed_total", "counter", stats["failed"])
+    metric("ftp_transfers_rejected_total", "counter", stats["rejected"])
+    metric("ftp_transfers_reaped_total", "counter", stats["reaped"])
+    metric("ftp_bytes_served_total", "counter", stats["bytes_served"])
+    metric("ftp_bytes_received_total", "counter", stats["bytes_received"])
+    metric("ftp_cache_hits_total", "counter", stats["cache"]["hits"])
+    metric("ftp_cache_misses_total", "counter", stats["cache"]["misses"])
+    metric("ftp_cache_bytes", "gauge", stats["cache"]["bytes"])
+    for key, value in stats.get("storage", {}).items(): # dedup store only
+        metric(f"ftp_store_{key}", "gauge", value)
+    metric("ftp_path_cache_entries", "gauge", stats["paths"]["entries"])
+    metric("ftp_path_cache_hits_total", "counter", stats["paths"]["hits"])
+    metric("ftp_path_cache_misses_total", "counter", stats["paths"]["misses"])
+    metric("ftp_sessions", "gauge", stats["sessions"])
+    metric("ftp_process_cpu_seconds_total", "counter", round(stats["cpu_user_s"] + stats["cpu_system_s"], 3))
+    metric("ftp_threads", "gauge", stats["threads"])
+    for flow in stats["flows"]:
+        labels = {"id": flow["id"], "client": flow["client"], "cmd": flow.get("cmd", ""), "arq": flow.get("arq", "")}
+        metric("ftp_flow_bytes", "gauge", flow.get("bytes"), labels)
+        metric("ftp_flow_goodput_mbps", "gauge", flow.get("goodput_mbps"), labels)
+        metric("ftp_flow_cwnd", "gauge", flow.get("cwnd"), labels)
+        metric("ftp_flow_srtt_ms", "gauge", flow.get("srtt_ms"), labels)
+        metric("ftp_flow_inflight", "gauge", flow.get("inflight"), labels)
+        metric("ftp_flow_retransmits_total", "counter", flow.get("retransmits"), labels)
+        metric("ftp_flow_timeouts_total", "counter", flow.get("timeouts"), labels)
+        metric("ftp_flow_reorder_buffer", "gauge", flow.get("reorder_buffer"), labels)
+        metric("ftp_flow_write_queue", "gauge", flow.get("write_queue"), labels)
+    lines = []
+    for name, (kind, samples) in families.items():
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+class statsHandler(BaseHTTPRequestHandler): # GET /stats (json) and /metrics (prometheus)
+    def do_GET(self) -> None:
+        stats = self.server.ftp.stats()
+        if self.path.startswith("/metrics"):
+            body = promText(stats).encode()
+            ctype = "text/plain; version=0.0.4"
+        elif self.path in ("/", "/stats"):
+            body = json.dumps(stats).encode()
+            ctype = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+def checkRequest(req) -> dict:
+    # normalize the fields serverCycle and transfer() read, ValueError on anything malformed so
+    # one bad datagram gets an error reply instead of killing the accept loop
+    if not isinstance(req, dict):
+        raise ValueError("request is not a json object")
+    for key in ("cmd", "arq", "cc", "name", "remoteName", "session", "md5"):
+        if req.get(key) is not None and not isinstance(req[key], str):
+            raise ValueError(f"{key} must be a string")
+    if req.get("compress") and not isinstance(req["compress"], str):
+        raise ValueError("compress must be a codec name")
+    try:
+        for key, default, lo, hi in (("pktSize", 1024, 1, 65000), ("maxWin", 64, 1, 1 << 16), ("fec", 0, 0, 255), ("size", 0, 0, 1 << 62)):
+            value = int(req.get(key, default))
+            if not lo <= value <= hi:
+                raise ValueError(f"{key} {value} out of range {lo}..{hi}")
+            req[key] = value
+        req["weight"] = min(16.0, max(1.0, float(req.get("weight", 1))))
+        delta = req.get("delta")
+        if delta:
+            if not isinstance(delta, dict) or int(delta.get("blockSize", 0)) <= 0:
+                raise ValueError("delta needs a positive blockSize")
+            delta["blockSize"] = int(delta["blockSize"])
+    except (TypeError, OverflowError) as e: # int(None), int([]), float("inf") ...
+        raise ValueError(f"malformed request: {e}")
+    return req
 
 class FTPserver:
-    def __init__(self, port: int, storage: str):
+    def __init__(self, port: int, storage: str, cacheMB: int = 256, scheduler: Scheduler = None, sockOpts: dict = None,
+                 traceDir: str = None, profile: bool = False, cprofileDir: str = None, dedup: bool = False, pathTTL: float = 0.0):
         self.port = port
+        self.sockOpts = sockOpts or {} # tuneSocket keyword arguments for data sockets
+        self.traceDir = traceDir # one Tracer file per download flow, None = off
+        if traceDir:
+            os.makedirs(traceDir, exist_ok=True)
+        self.profile = profile # per-phase timings printed when each transfer ends
+        self.cprofileDir = cprofileDir # one pstats file per transfer thread, None = off
+        if cprofileDir:
+            os.makedirs(cprofileDir, exist_ok=True)
         self.storage = os.path.abspath(storage)
-        os.makedirs(storage, exist_ok=True)
+        self.files = DedupStore(storage) if dedup else FileStore(storage)
+        self.cache = FileCache(cacheMB * 1024 * 1024, self.files)
+        self.scheduler = scheduler or Scheduler(16, 4, 0, 0)
+        self.offers: dict = {} # (client host, name) -> (time, size, hashes, missing) until the chunks arrive
+        self.offersLock = threading.Lock()
+        self.paths = PathCache(pathTTL) # client host -> metrics of the last download it got
+        self.sessions: dict = {} # (client host, session id) -> session
+        self.sessionsLock = threading.Lock()
         self.socketControl = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socketControl.bind(("", port))
         self.socketControl.settimeout(1.0)
+        self.started = time.time()
+        self.totals = {"completed": 0, "failed": 0, "bytes_served": 0, "bytes_received": 0}
+        self.totalsLock = threading.Lock()
         print(f"server is listening on {port}")
 
+    def stats(self) -> dict:
+        # assembled on request from counters the transfers keep anyway, nothing extra on the hot path
+        now = time.time()
+        with self.scheduler.lock:
+            active = list(self.scheduler.active)
+            rejected = self.scheduler.rejected
+            reaped = self.scheduler.reaped
+        flows = []
+        for t in active:
+            flow = {"id": t.id, "client": t.client, "weight": t.weight, "age_s": round(now - t.start, 3), **t.info}
+            if t.flow is not None:
+                flow.update(t.flow.snapshot())
+            flows.append(flow)
+        with self.totalsLock:
+            totals = dict(self.totals)
+        cpu = os.times()
+        return {"uptime_s": round(now - self.started, 3), "active": len(active), "rejected": rejected, "reaped": reaped, **totals,
+                "cache": {"hits": self.cache.hits, "misses": self.cache.misses, "bytes": self.cache.size, "entries": len(self.cache.entries)},
+                "storage": self.files.usage(), "paths": self.paths.usage(), "sessions": len(self.sessions),
+                "cpu_user_s": cpu.user, "cpu_system_s": cpu.system, "threads": threading.active_count(), "flows": flows}
+
+    def startHttp(self, host: str, port: int) -> None:
+        httpd = ThreadingHTTPServer((host, port), statsHandler)
+        httpd.ftp = self
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        print(f"server: stats on http://{host}:{httpd.server_address[1]}/stats and /metrics")
+
+    def openSession(self, addr, sid: str, pktSize: int, maxWin: int):
+        # the client's session, created with its data socket on first use; None when the table is full
+        key = (addr[0], str(sid))
+        with self.sessionsLock:
+            sess = self.sessions.get(key)
+            if sess is None and len(self.sessions) < MAX_SESSIONS:
+                socketData = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                tuneSocket(socketData, pktSize, maxWin, who="server", **self.sockOpts)
+                socketData.bind(("", 0))
+                sess = session(key[1], socketData)
+                self.sessions[key] = sess
+                print(f"server: session {key[1]} of {addr[0]} on data port {socketData.getsockname()[1]}")
+            if sess is not None:
+                sess.last = time.time() # not idle while its transfer waits for the lock
+            return sess
+
+    def closeSessions(self, key=None) -> None:
+        # close the session at key, or every session idle past SESSION_IDLE or closed while busy;
+        # busy ones stay until a later sweep
+        now = time.time()
+        with self.sessionsLock:
+            keys = [key] if key is not None else [k for k, v in self.sessions.items() if v.closing or now - v.last > SESSION_IDLE]
+            for k in keys:
+                sess = self.sessions.get(k)
+                if sess is None:
+                    continue
+                if not sess.lock.acquire(blocking=False):
+                    sess.closing = True
+                    continue
+                del self.sessions[k]
+                sess.socket.close()
+                sess.lock.release()
+
     def serverCycle(self):
         try:
             while True:
+                self.closeSessions()
                 try:
                     data, addr = self.socketControl.recvfrom(2048)
                 except socket.timeout:
@@ -396,78 +1023,266 @@ class FTPserver:
                     req = json.loads(data.decode())
                 except Exception:
                     continue
+                try:
+                    req = checkRequest(req)
+                except ValueError as e:
+                    self.socketControl.sendto(json.dumps({"status": "error", "why": str(e)}).encode(), addr)
+                    continue
 
                 cmd = req.get("cmd")
                 arqMode = req.get("arq")
                 ccName = req.get("cc")
-                pktSize = int(req.get("pktSize", 1024))
-                maxWin = int(req.get("maxWin", 64))
+                pktSize = req["pktSize"]
+                maxWin = req["maxWin"]
+                if cmd == "stats":
+                    body = json.dumps(self.stats())
+                    if len(body) > 60000: # keep the reply in one datagram
+                        body = json.dumps(dict(self.stats(), flows=[], truncated=True))
+                    self.socketControl.sendto(body.encode(), addr)
+                    continue
+                if cmd == "close":
+                    self.closeSessions((addr[0], str(req.get("session"))))
+                    self.socketControl.sendto(json.dumps({"status": "ok"}).encode(), addr)
+                    continue
                 print(f"server: get request from {cmd} | arq mode = {arqMode} | cc = {ccName}")
-                socketData = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                socketData.bind(("", 0))# bind to 0 so udp automatically bind a port
+                remoteName = req.get("remoteName") or req.get("name") or ""
+                why = None
+                if cmd in ("download", "signatures") and not self.files.exists(remoteName):
+                    why = "file not exist"
+                elif cmd == "upload" and req.get("delta"):
+                    # the delta only rebuilds the file against the exact copy its signatures came from;
+                    # compared by store version, hashing the file here would stall every other request
+                    if not self.files.exists(remoteName) or self.basisVersion(remoteName) != req["delta"].get("basisVersion"):
+                        why = "delta basis changed, upload the whole file"
+                elif cmd == "offer" and not self.files.dedup:
+                    why = "server stores plain files, start it with --dedup"
+                elif cmd == "upload" and req.get("dedup"):
+                    with self.offersLock:
+                        if (addr[0], remoteName) not in self.offers:
+                            why = "no pending chunk offer, upload the whole file"
+                if why is not None:
+                    self.socketControl.sendto(json.dumps({"status": "error", "why": why}).encode(), addr)
+                    continue
+                if req.get("compress") and req["compress"] not in CODECS:
+                    resp = {"status": "error", "why": f"unsupported codec {req['compress']}, have {','.join(CODECS)}"}
+                    self.socketControl.sendto(json.dumps(resp).encode(), addr)
+                    continue
+                weight = req["weight"]
+                t = self.scheduler.admit(addr[0], weight)
+                if t is None:
+                    resp = {"status": "busy", "retryAfter": self.scheduler.retryAfter()}
+                    self.socketControl.sendto(json.dumps(resp).encode(), addr)
+                    print(f"server: busy, rejected request from {addr}")
+                    continue
+                t.info = {"cmd": cmd, "name": str(req.get("remoteName") or req.get("name") or ""), "arq": arqMode, "cc": ccName}
+                sess = self.openSession(addr, req["session"], pktSize, maxWin) if req.get("session") else None
+                if sess is not None:
+                    socketData = sess.socket
+                else:
+                    socketData = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    tuneSocket(socketData, pktSize, maxWin, who="server", **self.sockOpts)
+                    socketData.bind(("", 0))# bind to 0 so udp automatically bind a port
                 dataPort = socketData.getsockname()[1]
                 resp = {"status": "ok", "dataPort": dataPort}
-                self.socketControl.sendto(json.dumps(resp).encode(), addr)
-                listener = threading.Thread(target=self.handle, args=(socketData, addr, req), daemon=True)
+                if sess is not None:
+                    resp["session"] = sess.id
+                if cmd == "download":
+                    resp["size"] = self.files.size(remoteName)
+                elif cmd == "signatures":
+                    resp["size"] = sigSize(self.files.size(remoteName))
+                if sess is None:
+                    self.socketControl.sendto(json.dumps(resp).encode(), addr)
+                listener = threading.Thread(target=self.handle, args=(socketData, addr, req, t, sess, resp), daemon=True)
                 listener.start()
         except KeyboardInterrupt:
             print("server: shutting down")
 
 
 
-    def handle(self, socketData: socket.socket, addr, req: dict):
+    def handle(self, socketData: socket.socket, addr, req: dict, t: ticket, sess: session = None, resp: dict = None):
+        ok = False
+        if sess is not None:
+            sess.lock.acquire()
+        try:
+            if sess is not None:
+                # the ok goes out once the session's previous transfer, TIME_WAIT included, is over
+                stale = drain(socketData)
+                if stale:
+                    print(f"server: session {sess.id} dropped {stale} stale datagrams")
+                self.socketControl.sendto(json.dumps(resp).encode(), addr)
+            if self.cprofileDir:
+                path = os.path.join(self.cprofileDir, f"{t.id}_{req.get('cmd')}_{req.get('arq', 'gbn')}.pstats")
+                runProfiled(path, self.transfer, socketData, addr, req, t)
+            else:
+                self.transfer(socketData, addr, req, t)
+            ok = True
+        except Exception as e:
+            print(f"server: transfer from {addr} aborted: {e}")
+            resp = {"status": "error", "why": str(e)}
+            self.socketControl.sendto(json.dumps(resp).encode(), addr)
+        finally:
+            if sess is not None:
+                sess.transfers += 1
+                sess.last = time.time()
+                sess.lock.release()
+            else:
+                socketData.close()
+            self.scheduler.release(t)
+            moved = t.flow.snapshot().get("bytes", 0) if t.flow is not None else 0
+            with self.totalsLock:
+                self.totals["completed" if ok else "failed"] += 1
+                self.totals["bytes_served" if isinstance(t.flow, sender) else "bytes_received"] += moved
+
+    def basisVersion(self, name: str):
+        try:
+            return list(self.files.version(name))
+        except OSError: # removed since exists()
+            return None
+
+    def profiled(self, flow):
+        if not self.profile:
+            return None
+        prof = Profiler()
+        prof.instrument(flow)
+        return prof
+
+    def takeOffer(self, addr, remoteName: str, path: str) -> dict:
+        # chunk hashes offered for remoteName: name them at once if the store has every chunk,
+        # else remember the offer and ask the client for the missing chunks only
+        with open(path, "rb") as f:
+            size, hashes = parseOffer(f.read())
+        missing = self.files.missing(hashes)
+        if not missing:
+            md5 = hashlib.md5(b"".join(self.files.blob(h.hex()) for h in hashes)).hexdigest()
+            self.files.link(remoteName, size, hashes, md5)
+            print(f"server: {remoteName} stored from {len(hashes)} known chunks")
+            return {"missing": [], "stored": md5}
+        ranges = toRanges(missing)
+        if len(json.dumps(ranges)) > 60000: # keep the done report in one datagram, ask for a bit more
+            missing = list(range(missing[0], len(hashes)))
+            ranges = toRanges(missing)
+        now = time.time()
+        with self.offersLock:
+            for key in [k for k, v in self.offers.items() if now - v[0] > OFFER_TTL]:
+                del self.offers[key]
+            self.offers[(addr[0], remoteName)] = (now, size, hashes, missing)
+        print(f"server: {remoteName} needs {len(missing)} of {len(hashes)} chunks")
+        return {"missing": ranges}
+
+    def transfer(self, socketData: socket.socket, addr, req: dict, t: ticket):
         cmd = req.get("cmd")
         name = req.get("name") or ""
         arqMode = req.get("arq", "gbn")
         ccName = req.get("cc")
         pktSize = int(req.get("pktSize", 1024))
         maxWin = int(req.get("maxWin", 64))
+        fecK = int(req.get("fec", 0))
+        codecName = req.get("compress") or None
         if ccName == "vegas":
             cc = vegasContol()
         else:
             cc = renoControl()
-        if cmd == "upload":
+        if cmd in ("upload", "offer"):
             # remoteName = req.get("remoteName") or "./storage"
             remoteName = req.get("remoteName") or req.get("name") or ""
-            outPath = os.path.join(self.storage, str(remoteName))
-            print(f"server: get upload from client, stored at {outPath}")
-            if arqMode == "sr":
-                recv = SRRreveiver(socketData, addr, outPath, arqMode, pktSize)
-            else:
-                recv = GBNreceiver(socketData, addr, outPath, arqMode, pktSize)
-            recv.handle()
-            fileMD5 = getMD5(outPath)
-            resp = {"status": "done", "md5": fileMD5}
+            print(f"server: get {cmd} from client for {remoteName}")
+            delta = req.get("delta")
+            offer = None
+            if req.get("dedup"):
+                with self.offersLock:
+                    offer = self.offers.pop((addr[0], remoteName), None)
+                if offer is None:
+                    raise ValueError("chunk offer expired")
+            # the old copy stays in place until the received file is complete and its md5 checks out
+            basis = self.cache.get(remoteName) if delta else None
+            target = self.files.incoming(remoteName)
+            sizeHint = int(req.get("size", 0))
+            recv = ARQreceiver(socketData, addr, target, arqMode, pktSize, sizeHint)
+            if fecK > 0:
+                recv.fec = fecDecoder()
+            stages = [Deframer()] if codecName else []
+            if delta:
+                stages.append(Patcher(basis.data, int(delta["blockSize"])))
+            if offer is not None:
+                stages.append(Assembler(self.files, *offer[1:]))
+            recv.unframe = chain(stages)
+            recv.onFin = lambda: self.scheduler.release(t)
+            t.flow = recv
+            prof = self.profiled(recv)
+            try:
+                recv.handle()
+                fileMD5 = getMD5(target)
+                if req.get("md5") and fileMD5 != req["md5"]: # delta and dedup uploads are rebuilt, check them
+                    raise ValueError(f"rebuilt md5 {fileMD5}, client has {req['md5']}")
+                if cmd == "offer":
+                    resp = self.takeOffer(addr, remoteName, target)
+                else:
+                    self.files.commit(remoteName, target)
+                    resp = {}
+            finally:
+                if os.path.exists(target):
+                    os.remove(target)
+            self.cache.invalidate(remoteName)
+            if delta or offer:
+                print(f"server: {recv.received} stream bytes rebuilt {self.files.size(remoteName)} file bytes")
+            resp.update({"status": "done", "md5": fileMD5, "kernelDrops": udpDrops(socketData)})
             self.socketControl.sendto(json.dumps(resp).encode(), addr)
-            print(f"server: upload {remoteName} finished | md5 = {fileMD5}")
-        elif cmd == "download":
+            print(f"server: {cmd} {remoteName} finished | md5 = {fileMD5}")
+            if prof is not None:
+                prof.addWriter(recv.writer)
+                print(prof.report(f"#{t.id} {cmd} {arqMode}"))
+        elif cmd in ("download", "signatures"):
             remoteName = req.get("remoteName") or name or ""
-            inPath = os.path.join(self.storage, str(remoteName))
-            if not os.path.exists(inPath):
+            if not self.files.exists(remoteName):
                 resp = {"status": "error", "why": "file not exist"}
                 self.socketControl.sendto(json.dumps(resp).encode(), addr)
-                socketData.close()
                 return
 
+            dataAddr = addr
             try:
                 socketData.settimeout(5.0)
-                _porbe, data_addr = socketData.recvfrom(512)
-                addr = data_addr
+                _porbe, dataAddr = socketData.recvfrom(512)
             except socket.timeout:
                 pass
             finally:
                 socketData.settimeout(None)
 
-            print(f"server: start downloading file {inPath}")
-            if arqMode == "sr":
-                sender = SRsender(socketData, addr, inPath, arqMode, cc, pktSize, maxWin)
-            else:
-                sender = GBNsender(socketData, addr, inPath, arqMode, cc, pktSize, maxWin)
+            print(f"server: start {cmd} of file {remoteName}")
+            entry = self.cache.get(remoteName)
+            senderCls = {"sr": SRsender, "auto": AUTOsender}.get(arqMode, GBNsender)
+            sender = senderCls(socketData, dataAddr, self.files.path(remoteName), arqMode, cc, pktSize, maxWin)
+            sender.data = entry.data
+            fileMD5 = entry.md5
+            if cmd == "signatures": # block checksums of the stored copy, for a delta upload
+                sender.data = self.cache.variant(remoteName, entry, "signatures", signatures)
+                fileMD5 = hashlib.md5(sender.data).hexdigest()
+            elif codecName:
+                sender.data = self.cache.variant(remoteName, entry, codecName, lambda data: frame(data, codecName))
+                print(f"server: {codecName} stream {len(sender.data)} bytes for {len(entry.data)} file bytes")
+            sender.pacer = t.pacer
+            warm = self.paths.seed(addr[0], sender)
+            if warm is not None:
+                print(f"server: warm start for {addr[0]} (cwnd {sender.initialWindow():.1f}, ssthresh {getattr(cc, 'ssthresh', 0):.1f}, "
+                      f"srtt {warm['srtt'] * 1000:.1f}ms)")
+            if fecK > 0:
+                sender.fec = fecEncoder(fecK)
+            t.flow = sender
+            prof = self.profiled(sender)
+            if self.traceDir:
+                stamp = time.strftime("%Y%m%d%H%M%S")
+                path = os.path.join(self.traceDir, f"{arqMode}_{ccName or 'reno'}_{dataAddr[0]}_{dataAddr[1]}_{stamp}.trace")
+                sender.tracer = Tracer(path, meta={"arq": arqMode, "cc": ccName or "reno", "op": cmd, "name": str(remoteName),
+                                                   "pktSize": pktSize, "maxWin": maxWin})
             sender.send()
-            fileMD5 = getMD5(inPath)
+            self.scheduler.release(t) # the data phase is over, the tail below holds no bandwidth share
+            self.paths.remember(addr[0], sender)
             resp = {"status": "done", "md5": fileMD5}
+            if cmd == "signatures": # the copy they describe, a delta upload names it back
+                resp["basisVersion"] = list(entry.version)
             self.socketControl.sendto(json.dumps(resp).encode(), addr)
-            print(f"server: download finished {remoteName} | md5 = {fileMD5}")
+            print(f"server: {cmd} finished {remoteName} | md5 = {fileMD5}")
+            if prof is not None:
+                print(prof.report(f"#{t.id} {cmd} {arqMode}/{ccName or 'reno'}"))
         else:
             resp = {"status": "error", "why": "unknown command"}
             self.socketControl.sendto(json.dumps(resp).encode(), addr)
@@ -476,8 +1291,31 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, default=10000)
     parser.add_argument("--storage", type=str, help="enter local storage file")
+    parser.add_argument("--cacheMB", type=int, default=256, help="memory for cached download files")
+    parser.add_argument("--maxActive", type=int, default=16, help="concurrent transfers before replying busy")
+    parser.add_argument("--maxPerClient", type=int, default=4, help="concurrent transfers per client host")
+    parser.add_argument("--rateMbps", type=float, default=0, help="global send rate shared by weight, 0 = unlimited")
+    parser.add_argument("--clientRateMbps", type=float, default=0, help="send rate cap per client host, 0 = unlimited")
+    parser.add_argument("--rcvbuf", type=int, default=0, help="data socket SO_RCVBUF bytes, 0 = auto from maxWin * pktSize")
+    parser.add_argument("--sndbuf", type=int, default=0, help="data socket SO_SNDBUF bytes, 0 = auto from maxWin * pktSize")
+    parser.add_argument("--busyPoll", type=int, default=0, help="SO_BUSY_POLL microseconds, 0 = off")
+    parser.add_argument("--tos", type=int, default=-1, help="IP_TOS byte for data packets, -1 = leave default")
+    parser.add_argument("--traceDir", type=str, default=None, help="write a cwnd/rtt trace of every download here")
+    parser.add_argument("--httpPort", type=int, default=-1, help="serve /stats and /metrics over HTTP on this port, -1 = off")
+    parser.add_argument("--httpHost", type=str, default="127.0.0.1")
+    parser.add_argument("--profile", action="store_true", help="print per-phase hot path timings after each transfer")
+    parser.add_argument("--cprofileDir", type=str, default=None, help="dump cProfile stats of every transfer thread here")
+    parser.add_argument("--dedup", action="store_true",
+                        help="keep files as deduplicated chunks under storage/.dedup (plain files there are not served)")
+    parser.add_argument("--pathTTL", type=float, default=0.0,
+                        help="seconds a client's rtt/cwnd/ssthresh seed its next download (e.g. 600), 0 = off, every download starts cold")
     args = parser.parse_args()
-    server = FTPserver(args.port, args.storage)
+    scheduler = Scheduler(args.maxActive, args.maxPerClient, args.rateMbps, args.clientRateMbps)
+    sockOpts = {"rcvbuf": args.rcvbuf, "sndbuf": args.sndbuf, "busyPoll": args.busyPoll, "tos": args.tos}
+    server = FTPserver(args.port, args.storage, args.cacheMB, scheduler, sockOpts, args.traceDir, args.profile, args.cprofileDir, args.dedup,
+                          args.pathTTL)
+    if args.httpPort >= 0:
+        server.startHttp(args.httpHost, args.httpPort)
     server.serverCycle()
 
 if __name__ == "__main__":
@@ -0,0 +1,169 @@
+import os
+import time
+import heapq
+import argparse
+
+import client
+import server
+from emulator import LinkProfile
+from bench import openResults, appendRow
+from tracer import Tracer
+from fec import fecEncoder, fecDecoder
+
+class SimSocket: # stands in for the UDP socket, sendto puts the datagram on the simulated link
+    def __init__(self, sim, side: str) -> None:
+        self.sim = sim
+        self.side = side
+
+    def sendto(self, data: bytes, addr) -> None:
+        self.sim.transmit(self.side, data)
+
+    def settimeout(self, timeout) -> None:
+        pass
+
+class NullWriter: # receivers write here instead of an AsyncWriter
+    def __init__(self) -> None:
+        self.written = 0
+
+    def write(self, chunk: bytes) -> None:
+        self.written += len(chunk)
+
+class Simulation:
+    # upload = client.py sender -> server.py receiver, download = server.py sender -> client.py receiver
+    def __init__(self, direction: str, arq: str, cc: str, sizeKB: float, pktSize: int, maxWin: int,
+                 up: LinkProfile, down: LinkProfile, maxTime: float = 600.0, fec: int = 0) -> None:
+        self.now = 0.0
+        self.events: list = [] # heap of (time, order, kind, datagram)
+        self.order = 0
+        self.armed = None
+        self.maxTime = maxTime
+        self.forward = up # sender -> receiver
+        self.backward = down
+        self.processed = 0
+        senderSock = SimSocket(self, "sender")
+        receiverSock = SimSocket(self, "receiver")
+        if direction == "upload":
+            ccObj = client.renoControl() if cc == "reno" else client.vegasContol()
+            cls = {"sr": client.SRsender, "auto": client.AUTOsender}.get(arq, client.GBNsender)
+            self.sender = cls(senderSock, None, None, ccObj, pktSize, maxWin)
+            self.receiver = server.ARQreceiver(receiverSock, None, None, arq, pktSize)
+            self.deliver = lambda data: self.receiver.onPacket(data, "sender")
+        else:
+            ccObj = server.renoControl() if cc == "reno" else server.vegasContol()
+            cls = {"sr": server.SRsender, "auto": server.AUTOsender}.get(arq, server.GBNsender)
+            self.sender = cls(senderSock, None, None, arq, ccObj, pktSize, maxWin)
+            self.receiver = client.ARQreceiver(receiverSock, None, None)
+            self.deliver = self.receiver.onPacket
+        self.sender.clock = self.clock
+        self.sender.data = bytes(int(sizeKB * 1024))
+        self.receiver.clock = self.clock
+        self.receiver.writer = NullWriter()
+        if fec > 0:
+            self.sender.fec = fecEncoder(fec)
+            self.receiver.fec = fecDecoder()
+
+    def clock(self) -> float:
+        return self.now
+
+    def push(self, t: float, kind: str, data: bytes = b"") -> None:
+        heapq.heappush(self.events, (t, self.order, kind, data))
+        self.order += 1
+
+    def transmit(self, side: str, data: bytes) -> None:
+        link = self.forward if side == "sender" else self.backward
+        kind = "data" if side == "sender" else "ack"
+        for t in link.schedule(self.now, len(data)):
+            self.push(t, kind, data)
+
+    def armTimer(self) -> None:
+        # pump() retransmits once clock - start > timeout, so wake just past the deadline
+        deadline = self.sender.nextDeadline()
+        if deadline is not None and deadline != self.armed:
+            self.armed = deadline
+            self.push(deadline + 1e-9, "timer")
+
+    def run(self) -> dict:
+        s = self.sender
+        s.setup()
+        s.pump()
+        self.armTimer()
+        while self.events and s.base < s.npkt:
+            t, _, kind, data = heapq.heappop(self.events)
+            if t > self.maxTime:
+                break
+            self.now = t
+            self.processed += 1
+            if kind == "data":
+                self.deliver(data)
+            elif kind == "ack":
+                s.onAck(data)
+            s.pump()
+            self.armTimer()
+        if s.tracer is not None:
+            s.tracer.close()
+        m = s.stats()
+        m["ok"] = 1 if s.base >= s.npkt and self.receiver.writer.written == s.unique_payload else 0
+        m["events"] = self.processed
+        return m
+
+def main():
+    parser = argparse.ArgumentParser(description="discrete event simulation of the ARQ senders/receivers on a virtual clock")
+    parser.add_argument("--direction", choices=["upload", "download"], default="upload")
+    parser.add_argument("--arq", type=str, default="gbn,sr,auto")
+    parser.add_argument("--cc", type=str, default="reno,vegas")
+    parser.add_argument("--loss", type=str, default="0,1,3,5", help="comma list of loss %% swept")
+    parser.add_argument("--delay", type=float, default=5.0, help="one way delay ms")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate", type=float, default=100.0, help="bottleneck Mbps, 0 = unlimited")
+    parser.add_argument("--size", type=float, default=100.0, help="file size KB")
+    parser.add_argument("--pktSize", type=int, default=1024)
+    parser.add_argument("--maxWin", type=int, default=64)
+    parser.add_argument("--fec", type=str, default="0", help="comma list of initial FEC block sizes, 0 = off")
+    parser.add_argument("--reps", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bothWays", action="store_true", help="lose ACKs too")
+    parser.add_argument("--csv", type=str, default=None, help="append every run to this metric.csv")
+    parser.add_argument("--trace", type=str, default=None, help="directory for one cwnd/rtt trace per transfer")
+    args = parser.parse_args()
+
+    if args.csv:
+        openResults(args.csv)
+    if args.trace:
+        os.makedirs(args.trace, exist_ok=True)
+    runId = time.strftime("%Y%m%d%H%M%S")
+    total = 0
+    wall = time.perf_counter()
+    print("arq,cc,fec,loss,goodput_mbps,utilization,seconds,failed")
+    grid = [(arq, cc, int(fec), float(loss)) for arq in args.arq.split(",") for cc in args.cc.split(",")
+            for fec in args.fec.split(",") for loss in args.loss.split(",")]
+    for arq, cc, fec, loss in grid:
+        goodput = util = secs = 0.0
+        failed = 0
+        for rep in range(args.reps):
+            seed = args.seed + rep
+            up = LinkProfile(loss=loss, delay=args.delay, jitter=args.jitter, rate=args.rate, seed=seed)
+            down = LinkProfile(loss=loss if args.bothWays else 0.0, delay=args.delay, jitter=args.jitter, rate=args.rate, seed=seed + 1)
+            sim = Simulation(args.direction, arq, cc, args.size, args.pktSize, args.maxWin, up, down, fec=fec)
+            if args.trace:
+                path = os.path.join(args.trace, f"{arq}_{cc}_fec{fec}_loss{loss:g}_rep{rep}.trace")
+                sim.sender.tracer = Tracer(path, meta={"arq": arq, "cc": cc, "op": args.direction, "loss": loss, "seed": seed,
+                                                       "fec": fec, "pktSize": args.pktSize, "maxWin": args.maxWin})
+            m = sim.run()
+            total += 1
+            failed += 1 - m["ok"]
+            goodput += m["goodput_mbps"]
+            util += m["utilization"]
+            secs += m["seconds"]
+            if args.csv:
+                appendRow(args.csv, {"arq": arq, "cc": cc, "var": "loss", "val": loss, "goodput_mbps": f"{m['goodput_mbps']:.3f}",
+                                     "utilization": f"{m['utilization']:.4f}", "seconds": f"{m['seconds']:.3f}", "ok": m["ok"],
+                                     "rep": rep, "seed": seed, "loss": loss, "delay_ms": args.delay, "size_kb": args.size,
+                                     "pktSize": args.pktSize, "maxWin": args.maxWin, "run_id": f"sim_{runId}",
+                                     "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "source": "sim"})
+        n = args.reps
+        print(f"{arq},{cc},{fec},{loss:g},{goodput / n:.3f},{util / n:.4f},{secs / n:.3f},{failed}")
+    wall = time.perf_counter() - wall
+    print(f"simulate: {total} transfers in {wall:.2f}s ({total / max(wall, 1e-9):.0f} transfers/s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import os
+import json
+import struct
+import hashlib
+import tempfile
+import threading
+
+CHUNK = 256 * 1024 # dedup granularity, fixed so client and server cut files the same way
+OFFER = struct.Struct("<Q") # file size, followed by one sha256 digest per chunk
+DIGEST = 32
+
+def chunkHashes(data) -> list:
+    view = memoryview(data)
+    return [hashlib.sha256(view[i: i + CHUNK]).digest() for i in range(0, len(view), CHUNK)]
+
+def packOffer(size: int, hashes: list) -> bytes:
+    return OFFER.pack(size) + b"".join(hashes)
+
+def parseOffer(blob: bytes) -> tuple:
+    (size,) = OFFER.unpack_from(blob)
+    body = blob[OFFER.size:]
+    if len(body) % DIGEST or len(body) // DIGEST != -(-size // CHUNK):
+        raise ValueError("offer does not match its file size")
+    return size, [body[i: i + DIGEST] for i in range(0, len(body), DIGEST)]
+
+def toRanges(indices: list) -> list:
+    # sorted chunk indices -> [[start, end), ...], keeps the done report small
+    out: list = []
+    for i in indices:
+        if out and out[-1][1] == i:
+            out[-1][1] = i + 1
+        else:
+            out.append([i, i + 1])
+    return out
+
+def fromRanges(ranges: list) -> list:
+    return [i for start, end in ranges for i in range(start, end)]
+
+class FileStore: # one plain file per name under root
+    dedup = False
+
+    def __init__(self, root: str) -> None:
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, str(name))
+
+    def exists(self, name: str) -> bool:
+        return os.path.isfile(self.path(name))
+
+    def version(self, name: str) -> tuple:
+        # changes whenever the content may have, FileCache keys its entries on it
+        st = os.stat(self.path(name))
+        return st.st_mtime_ns, st.st_size
+
+    def size(self, name: str) -> int:
+        return os.path.getsize(self.path(name))
+
+    def read(self, name: str) -> bytes:
+        with open(self.path(name), "rb") as f:
+            return f.read()
+
+    def incoming(self, name: str) -> str:
+        # uploads land here and only replace the stored copy in commit(); one side file per upload,
+        # so concurrent uploads of the same name never share it
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".", suffix=".part")
+        os.close(fd)
+        return tmp
+
+    def commit(self, name: str, tmp: str) -> None:
+        os.replace(tmp, self.path(name))
+
+    def usage(self) -> dict:
+        return {}
+
+class DedupStore(FileStore): # content addressed: chunk sha256 -> blob, name -> manifest of chunks
+    dedup = True
+
+    def __init__(self, root: str) -> None:
+        super().__init__(root)
+        self.blobs = os.path.join(self.root, ".dedup", "blobs")
+        self.manifests = os.path.join(self.root, ".dedup", "manifests")
+        self.spool = os.path.join(self.root, ".dedup", "incoming")
+        for d in (self.blobs, self.manifests, self.spool):
+            os.makedirs(d, exist_ok=True)
+        self.lock = threading.Lock()
+        self.counts = {"manifests": 0, "blobs": 0, "logical_bytes": 0, "stored_bytes": 0}
+        for dirpath, _, files in os.walk(self.blobs):
+            for f in files:
+                self.counts["blobs"] += 1
+                self.counts["stored_bytes"] += os.path.getsize(os.path.join(dirpath, f))
+        for dirpath, _, files in os.walk(self.manifests):
+            for f in files:
+                with open(os.path.join(dirpath, f)) as fp:
+                    self.counts["logical_bytes"] += json.load(fp)["size"]
+                self.counts["manifests"] += 1
+
+    def blobPath(self, digest: str) -> str:
+        return os.path.join(self.blobs, digest[:2], digest)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.manifests, str(name) + ".json")
+
+    def manifest(self, name: str) -> dict:
+        with open(self.path(name)) as f:
+            return json.load(f)
+
+    def size(self, name: str) -> int:
+        return self.manifest(name)["size"]
+
+    def read(self, name: str) -> bytes:
+        return b"".join(self.blob(d) for d in self.manifest(name)["chunks"])
+
+    def blob(self, digest: str) -> bytes:
+        with open(self.blobPath(digest), "rb") as f:
+            return f.read()
+
+    def has(self, digest: str) -> bool:
+        return os.path.exists(self.blobPath(digest))
+
+    def missing(self, hashes: list) -> list:
+        # indices of offered chunks the store lacks, each digest asked for once
+        seen = set()
+        out = []
+        for i, h in enumerate(hashes):
+            d = h.hex()
+            if d not in seen and not self.has(d):
+                out.append(i)
+            seen.add(d)
+        return out
+
+    def incoming(self, name: str) -> str:
+        fd, tmp = tempfile.mkstemp(dir=self.spool)
+        os.close(fd)
+        return tmp
+
+    def putBlob(self, digest: str, chunk) -> None:
+        path = self.blobPath(digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(chunk)
+        os.replace(tmp, path) # concurrent writers of the same chunk write the same bytes
+        with self.lock:
+            self.counts["blobs"] += 1
+            self.counts["stored_bytes"] += len(chunk)
+
+    def link(self, name: str, size: int, hashes: list, md5: str) -> None:
+        # point name at chunks already in the store
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        old = self.size(name) if os.path.exists(path) else None
+        fd, tmp = tempfile.mkstemp(dir=self.spool)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"size": size, "md5": md5, "chunks": [h.hex() for h in hashes]}, f)
+        os.replace(tmp, path)
+        with self.lock:
+            if old is None:
+                self.counts["manifests"] += 1
+            self.counts["logical_bytes"] += size - (old or 0)
+
+    def commit(self, name: str, tmp: str) -> None:
+        with open(tmp, "rb") as f:
+            data = f.read()
+        view = memoryview(data)
+        hashes = chunkHashes(data)
+        for i, h in enumerate(hashes):
+            self.putBlob(h.hex(), view[i * CHUNK: (i + 1) * CHUNK])
+        self.link(name, len(data), hashes, hashlib.md5(data).hexdigest())
+        os.remove(tmp)
+
+    def usage(self) -> dict:
+        with self.lock:
+            return dict(self.counts)
+
+class Assembler: # receiver side: the missing chunks in offer order in, whole file out
+    def __init__(self, store: DedupStore, size: int, hashes: list, missing: list) -> None:
+        self.store = store
+        self.size = size
+        self.hashes = hashes
+        self.missing = set(missing)
+        # chunks sent once but used again later in the file, not in the store until commit
+        sent = {hashes[i] for i in missing}
+        self.repeated = {h for i, h in enumerate(hashes) if h in sent and i not in self.missing}
+        self.fresh: dict = {}
+        self.idx = 0 # next chunk of the file to emit
+        self.pending = bytearray()
+
+    def __call__(self, data: bytes) -> bytes:
+        self.pending += data
+        out = []
+        pos = 0
+        while self.idx < len(self.hashes):
+            size = min(CHUNK, self.size - self.idx * CHUNK)
+            if self.idx in self.missing:
+                if len(self.pending) - pos < size:
+                    break
+                chunk = bytes(self.pending[pos: pos + size])
+                pos += size
+                if self.hashes[self.idx] in self.repeated:
+                    self.fresh[self.hashes[self.idx]] = chunk
+                out.append(chunk)
+            else:
+                h = self.hashes[self.idx]
+                out.append(self.fresh[h] if h in self.fresh else self.store.blob(h.hex()))
+            self.idx += 1
+        del self.pending[: pos]
+        return b"".join(out)
+
+    def finish(self) -> None:
+        if self.idx != len(self.hashes) or self.pending:
+            raise ValueError(f"dedup stream ended at chunk {self.idx} of {len(self.hashes)}")
@@ -0,0 +1,64 @@
+import csv
+import json
+import struct
+import threading
+
+FIELDS = ("t", "cwnd", "ssthresh", "srtt", "base", "nextIdx", "retransmits", "dupacks", "timeouts")
+RECORD = struct.Struct("<4d5q") # one sample, 72 bytes
+MAGIC = b"LAB4TRC1"
+
+class Tracer: # per-flow ring buffer of sender state samples, written out once when the flow ends
+    def __init__(self, path: str, capacity: int = 65536, meta: dict = None) -> None:
+        self.path = path # *.csv is written as text, anything else in the binary format
+        self.capacity = capacity
+        self.meta = meta or {}
+        self.buf = bytearray(RECORD.size * capacity) # preallocated, sample() never allocates
+        self.count = 0 # samples taken, the ring keeps the newest `capacity`
+        self.lock = threading.Lock() # the ACK listener and the send loop both sample
+
+    def sample(self, t: float, cwnd: float, ssthresh: float, srtt: float, base: int, nextIdx: int,
+               retransmits: int, dupacks: int, timeouts: int) -> None:
+        with self.lock:
+            RECORD.pack_into(self.buf, (self.count % self.capacity) * RECORD.size,
+                             t, cwnd, ssthresh, srtt, base, nextIdx, retransmits, dupacks, timeouts)
+            self.count += 1
+
+    def records(self) -> list:
+        n = min(self.count, self.capacity)
+        start = self.count - n
+        return [RECORD.unpack_from(self.buf, ((start + i) % self.capacity) * RECORD.size) for i in range(n)]
+
+    def close(self) -> None:
+        rows = self.records()
+        meta = dict(self.meta, samples=self.count, dropped=self.count - len(rows))
+        if self.path.endswith(".csv"):
+            with open(self.path, "w", newline="") as f:
+                f.write("# " + json.dumps(meta) + "\n")
+                writer = csv.writer(f)
+                writer.writerow(FIELDS)
+                writer.writerows(rows)
+            return
+        header = json.dumps(meta).encode()
+        with open(self.path, "wb") as f:
+            f.write(MAGIC + struct.pack("<I", len(header)) + header)
+            f.write(b"".join(RECORD.pack(*r) for r in rows))
+
+def readTrace(path: str) -> tuple:
+    # (meta, rows) from either format, rows are tuples in FIELDS order
+    with open(path, "rb") as f:
+        head = f.read(len(MAGIC))
+        if head == MAGIC:
+            (size,) = struct.unpack("<I", f.read(4))
+            meta = json.loads(f.read(size).decode())
+            body = f.read()
+            rows = [RECORD.unpack_from(body, i) for i in range(0, len(body) - RECORD.size + 1, RECORD.size)]
+            return meta, rows
+    with open(path, newline="") as f:
+        first = f.readline()
+        meta = json.loads(first[2:]) if first.startswith("# ") else {}
+        if not first.startswith("# "):
+            f.seek(0)
+        reader = csv.reader(f)
+        next(reader)
+        rows = [tuple(float(v) for v in r[:4]) + tuple(int(v) for v in r[4:]) for r in reader if r]
+    return meta, rows